@@ -1,13 +1,16 @@
-from flask import Flask
+from flask import Flask, Response, jsonify
 import logging
 import os
 from routes.pr_review import pr_review_bp
-import subprocess
-import time
-import requests
-# Configure logging with more details
+from controllers.pr_review import (get_backend_pool, get_bitbucket_client, get_job_queue, get_overload_monitor,
+                                   BITBUCKET_API_BASE, MODEL_TIERS)
+from services.backend_pool import OLLAMA_BACKENDS
+from services import metrics
+from services.health_monitor import HealthMonitor
+from services.startup import StartupManager
+# Configure logging with more details; LOG_LEVEL=DEBUG also logs diffs, prompts and model output
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
@@ -16,82 +19,46 @@ app = Flask(__name__)
 OLLAMA_HOST = os.environ.get('OLLAMA_HOST', 'localhost')
 OLLAMA_PORT = os.environ.get('OLLAMA_PORT', '11434')
 OLLAMA_URL = f"http://{OLLAMA_HOST}:{OLLAMA_PORT}"
-MODEL_NAME = os.environ.get('MODEL_NAME', 'deepseek-coder-v2')
-# Start Ollama server in background
-def start_ollama_server():
-    try:
-        logger.info("Starting Ollama server...")
-        process = subprocess.Popen(
-            ["nohup", "ollama", "serve"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            preexec_fn=os.setsid
-        )
-        time.sleep(5)  # Give some time for server to start
-        return True
-    except Exception as e:
-        logger.error(f"Failed to start Ollama: {e}")
-        return False
-def ensure_model_pulled():
-    """Ensure the model is pulled in Ollama"""
-    try:
-        # Check if model exists
-        response = requests.get(f"{OLLAMA_URL}/api/tags")
-        if response.status_code == 200:
-            models = response.json().get('models', [])
-            if any(model.get('name') == MODEL_NAME for model in models):
-                logger.info(f"Model {MODEL_NAME} is already pulled")
-                return True
-                
-        # Pull the model
-        logger.info(f"Pulling model {MODEL_NAME}...")
-        response = requests.post(
-            f"{OLLAMA_URL}/api/pull",
-            json={"name": MODEL_NAME}
-        )
-        
-        if response.status_code == 200:
-            logger.info(f"Successfully pulled model {MODEL_NAME}")
-            return True
-        else:
-            logger.error(f"Failed to pull model: {response.status_code} - {response.text}")
-            return False
-            
-    except Exception as e:
-        logger.error(f"Error ensuring model is pulled: {str(e)}", exc_info=True)
-        return False
-# Start server on app init
-start_ollama_server()
-logger.info("Attempting to pull model...")
-ensure_model_pulled()
+# Every backend serves every tier's model
+OLLAMA_URLS = OLLAMA_BACKENDS or [OLLAMA_URL]
+TIER_MODELS = [tier.model for tier in MODEL_TIERS]
+# Start Ollama, pull and load the tier models on every backend in the background; import returns immediately
+startup_manager = StartupManager(OLLAMA_URLS, TIER_MODELS,
+                                 local_url=OLLAMA_URL if OLLAMA_URL in OLLAMA_URLS else None).start()
 # Register blueprints
 app.register_blueprint(pr_review_bp)
+# Start review workers; this also recovers jobs left unfinished by a restart
+job_queue = get_job_queue()
+# Degradation level and model latency, for /health and /metrics
+overload_monitor = get_overload_monitor()
+# Poll Ollama (and optionally Bitbucket), queue depth and degradation level in the background for /health
+health_monitor = HealthMonitor(OLLAMA_URLS, bitbucket_url=BITBUCKET_API_BASE, queue_depth=job_queue.depth,
+                               overload=overload_monitor.status if overload_monitor else None,
+                               models=TIER_MODELS).start()
+@app.route('/health/live', methods=['GET'])
+def liveness_check():
+    """Liveness probe: the process is up and startup has not failed"""
+    status = startup_manager.status()
+    return jsonify(status), 200 if status['live'] else 503
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: every tier model is pulled and resident on some backend, so reviews can be served"""
+    status = startup_manager.status()
+    return jsonify(status), 200 if status['ready'] else 503
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint for Kubernetes probes"""
-    try:
-        # Check if Ollama is running
-        response = requests.get(f"{OLLAMA_URL}/api/version")
-        if response.status_code != 200:
-            return jsonify({
-                "status": "unhealthy",
-                "message": "Ollama server is not responding"
-            }), 503
-            
-        # Simply return healthy if server is responding
-        return jsonify({"status": "healthy"})
-        
-    except requests.RequestException as e:
-        logger.error(f"Health check failed: {str(e)}")
-        return jsonify({
-            "status": "unhealthy",
-            "message": f"Connection error: {str(e)}"
-        }), 503
-    except Exception as e:
-        logger.error(f"Health check error: {str(e)}")
-        return jsonify({
-            "status": "unhealthy",
-            "message": str(e)
-        }), 503
+    """Health check endpoint for Kubernetes probes; answers from the monitor's cached state"""
+    health = health_monitor.snapshot()
+    health['startup'] = startup_manager.status()
+    health['model_backends'] = get_backend_pool().status()
+    health['bitbucket_rate_limit'] = get_bitbucket_client().limiter.status()
+    if health['status'] != 'healthy':
+        health['message'] = health['ollama']['error'] or "Ollama server is not responding"
+        return jsonify(health), 503
+    return jsonify(health)
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus scrape endpoint: per-stage latencies, model throughput, cache and error counters"""
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001)
\ No newline at end of file
@@ -0,0 +1,175 @@
+"""Offline batch reviews: run the review pipeline over local diffs or recorded webhooks and write JSONL.
+
+Inputs are diff files (.diff/.patch), directories searched for them, and
+JSONL files of webhook payloads (one Bitbucket webhook body per line, or
+{"event_key": ..., "payload": {...}}); for payloads the diff and file
+contents are fetched from Bitbucket like in the service. Each input is
+reviewed through the same pipeline as the service (review_diff in
+controllers/pr_review.py), so REVIEW_MODE, map-reduce, the findings path
+of inline mode, the pre-filter and hunk context all apply, and the
+review cache is used as usual, so re-runs only pay for changed hunks or
+a new prompt version. Nothing is posted: one JSON line per input is
+written to --output (stdout by default) and throughput to stderr.
+
+Usage: python app/batch_review.py INPUT [INPUT ...] [--workers 4] [--output results.jsonl] [--repo workspace/repo]
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from functools import partial
+
+logger = logging.getLogger('batch_review')
+
+DIFF_EXTENSIONS = ('.diff', '.patch')
+REVIEW_EVENT_KEYS = ('pullrequest:created', 'pullrequest:updated', 'pullrequest:approved', 'pullrequest:unapproved')
+
+
+def load_webhooks(path):
+    """Review inputs from a JSONL file of webhook payloads; events the webhook route ignores are skipped"""
+    items = []
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            event_key, payload = record.get('event_key', 'pullrequest:updated'), record.get('payload', record)
+            pr_data = payload.get('pullrequest') if isinstance(payload, dict) else None
+            if not pr_data or not event_key.startswith(REVIEW_EVENT_KEYS):
+                continue
+            repo_full_name = pr_data.get('destination', {}).get('repository', {}).get('full_name', '')
+            if not pr_data.get('id') or '/' not in repo_full_name:
+                logger.warning(f"{path}:{number}: missing PR id or repository, skipping")
+                continue
+            items.append({'source': f"{path}:{number}", 'repository': repo_full_name, 'pr_id': pr_data['id'],
+                          'source_commit': pr_data.get('source', {}).get('commit', {}).get('hash')})
+    return items
+
+
+def collect_inputs(paths, repo_full_name=None):
+    """Expand the command-line paths into review inputs, in order"""
+    items = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                for name in sorted(names):
+                    if name.endswith(DIFF_EXTENSIONS):
+                        items.append({'source': os.path.join(directory, name), 'repository': repo_full_name})
+        elif path.endswith('.jsonl'):
+            items.extend(load_webhooks(path))
+        else:
+            items.append({'source': path, 'repository': repo_full_name})
+    return items
+
+
+def review_item(item, pr_review):
+    """Review one input through the pipeline process_pr uses, returning the output record instead of posting"""
+    started = time.perf_counter()
+    repo_full_name = item.get('repository')
+    record = {'source': item['source'], 'repository': repo_full_name, 'pr_id': item.get('pr_id'),
+              'source_commit': item.get('source_commit')}
+    trace = []
+    try:
+        fetch_contents = None
+        if item.get('pr_id'):
+            workspace, repo_slug = repo_full_name.split('/')
+            diff_lines = pr_review.open_pr_diff(workspace, repo_slug, item['pr_id'], item.get('source_commit'))
+            if diff_lines is None:
+                raise RuntimeError(f"Could not retrieve the diff of {repo_full_name} PR #{item['pr_id']}")
+            fetch_contents = partial(pr_review.fetch_file_contents, workspace, repo_slug, item['pr_id'],
+                                     source_commit=item.get('source_commit'))
+        else:
+            diff_lines = open(item['source'], encoding='utf-8', errors='replace')
+
+        scheduler = pr_review.get_scheduler()
+        with scheduler.track(item['source'], repo_full_name) if scheduler else nullcontext():
+            review = pr_review.review_diff(diff_lines, repo_full_name, pr_review.NullJobContext(trace),
+                                           fetch_contents=fetch_contents)
+
+        record.update({
+            'files_selected': [file_info['path'] for file_info in review['files_analyzed']],
+            'results': review['results'],
+            'findings': review['mapped']['findings'] if review['mapped'] else None,
+            'incomplete': review['incomplete'],
+            'comment': review['comment'],
+            'cached_hunks': sum(event['cached_hunks'] for event in trace if event.get('event') == 'analysis_plan'),
+            'model_calls': sum(1 for event in trace if event.get('event') == 'model_call'),
+            'error': None
+        })
+    except Exception as e:
+        logger.error(f"Error reviewing {item['source']}: {str(e)}", exc_info=True)
+        record['error'] = str(e)
+    record['seconds'] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help="diff files, directories of them, or JSONL files of webhook payloads")
+    parser.add_argument('--workers', type=int, default=4, help="inputs reviewed at the same time")
+    parser.add_argument('--output', help="JSONL file to write the results to (default: stdout)")
+    parser.add_argument('--repo', help="repository (workspace/repo) of local diffs, for its risk weights and ignore globs")
+    parser.add_argument('--cache-dir', help="review cache directory (default: REVIEW_CACHE_DIR)")
+    parser.add_argument('--no-cache', action='store_true', help="review every hunk, ignoring the review cache")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'WARNING').upper(),
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # Configuration is read when the pipeline is imported. The service's queue depth means nothing
+    # here, and reading it would start the job queue's workers, so there is no backpressure.
+    os.environ['BACKPRESSURE_ENABLED'] = 'false'
+    if args.cache_dir:
+        os.environ['REVIEW_CACHE_DIR'] = args.cache_dir
+    if args.no_cache:
+        os.environ['REVIEW_CACHE_ENABLED'] = 'false'
+    from controllers import pr_review
+
+    items = collect_inputs(args.inputs, args.repo)
+    if not items:
+        parser.error("no diff files or webhook payloads found in the inputs")
+
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    write_lock = threading.Lock()
+    totals = {'inputs': len(items), 'reviewed': 0, 'failed': 0, 'files_selected': 0, 'model_calls': 0,
+              'cached_hunks': 0}
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix='batch') as executor:
+            futures = [executor.submit(review_item, item, pr_review) for item in items]
+            for future in as_completed(futures):
+                record = future.result()
+                with write_lock:
+                    output.write(json.dumps(record) + '\n')
+                    output.flush()
+                if record['error']:
+                    totals['failed'] += 1
+                    continue
+                totals['reviewed'] += 1
+                totals['files_selected'] += len(record['files_selected'])
+                totals['model_calls'] += record['model_calls']
+                totals['cached_hunks'] += record['cached_hunks']
+    finally:
+        if args.output:
+            output.close()
+
+    elapsed = time.perf_counter() - started
+    totals.update({
+        'seconds': round(elapsed, 3),
+        'inputs_per_minute': round(len(items) / elapsed * 60, 1) if elapsed else None,
+        'files_per_second': round(totals['files_selected'] / elapsed, 2) if elapsed else None,
+        'review_cache': pr_review.get_review_cache_stats()
+    })
+    print(f"Reviewed {totals['reviewed']}/{len(items)} inputs ({totals['failed']} failed) in {elapsed:.1f}s: "
+          f"{totals['inputs_per_minute']} inputs/min, {totals['files_per_second']} files/s, "
+          f"{totals['model_calls']} model calls, {totals['cached_hunks']} cached hunks", file=sys.stderr)
+    print(json.dumps(totals), file=sys.stderr)
+    return 1 if totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,41 @@
 import logging
 import os
-import requests
-import json
+import re
 import base64
+import threading
+import time
 import traceback
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from flask import jsonify, request
+from services.backend_pool import BackendPool, ModelTier, OLLAMA_BACKENDS, MODEL_TIERS_SPEC, parse_tiers
+from services.backpressure import (BACKPRESSURE_DEFER_SECONDS, BACKPRESSURE_ENABLED, BACKPRESSURE_FILE_BUDGET_RATIO,
+                                   BACKPRESSURE_MAX_DEFERRALS, LEVEL_FEWER_FILES, LEVEL_NAMES, LEVEL_NORMAL,
+                                   LEVEL_SMALLER_TIER, LEVEL_SUMMARY_ONLY, OverloadMonitor)
+from services.bitbucket_client import BitbucketClient
+from services.comment_writer import INLINE_COMMENTS_ENABLED, InlineCommentWriter, group_inline_findings
+from services.context_extractor import CONTEXT_ENABLED, get_context_extractor
+from services.diff_parser import iter_diff_files
+from services.file_scoring import REVIEW_TOKEN_BUDGET, estimate_file_tokens, select_by_risk
+from services.findings import FINDINGS_SCHEMA, SEVERITIES, join_within_limit, parse_findings, parse_json_findings, reduce_findings
+from services.git_source import GitError, GitMirrorSource
+from services.job_queue import JobQueue, JobCancelled, NullJobContext
+from services.prefilter import PREFILTER_ENABLED, SKIPPED as PREFILTER_SKIPPED, find_syntax_errors, prefilter
+from services.prompt_planner import estimate_output_tokens, estimate_tokens, plan_batches
+from services.review_cache import ReviewCache, get_review_cache, hunk_hash
+from services.scheduler import SCHEDULER_ENABLED, SCHEDULER_SLOTS, ReviewScheduler, bind_job, current_job
 
 logger = logging.getLogger(__name__)
 
+# Ollama config
+OLLAMA_HOST = os.environ.get('OLLAMA_HOST', 'localhost')
+OLLAMA_PORT = os.environ.get('OLLAMA_PORT', '11434')
+OLLAMA_URL = f"http://{OLLAMA_HOST}:{OLLAMA_PORT}"
+MODEL_NAME = os.environ.get('MODEL_NAME', 'deepseek-coder-v2')
+# Model tiers by prompt size; without MODEL_TIERS every request uses MODEL_NAME
+MODEL_TIERS = parse_tiers(MODEL_TIERS_SPEC) or [ModelTier(MODEL_NAME)]
+
 # Bitbucket config
 BITBUCKET_API_BASE = os.environ.get('BITBUCKET_API_BASE', 'YOUR BITBUCKET_API_BASE')
 BITBUCKET_WORKSPACE = os.environ.get('BITBUCKET_WORKSPACE', '')
@@ -20,24 +48,163 @@ if BITBUCKET_USERNAME and BITBUCKET_APP_PASSWORD:
     logger.info(f"Bitbucket authentication configured for user: {BITBUCKET_USERNAME}")
 else:
     logger.warning("Bitbucket authentication not configured. API calls will be unauthenticated.")
+# Where diffs and file contents are read from: 'api' (Bitbucket REST) or 'git' (local bare mirrors)
+REPO_SOURCE = os.environ.get('REPO_SOURCE', 'api').lower()
 
 # Configuration
-MAX_FILES_TO_REVIEW = 10
-MAX_DIFF_SIZE = 50000
+# Files are selected by risk within REVIEW_TOKEN_BUDGET; this is an optional hard cap on top (0 = none)
+MAX_FILES_TO_REVIEW = int(os.environ.get('MAX_FILES_TO_REVIEW', '0'))
 IGNORE_FILE_TYPES = ['.md', '.txt', '.json', '.yaml', '.yml', '.lock', '.svg', '.png', '.jpg', '.jpeg', '.gif']
-MAX_COMMENT_LENGTH = 50000
+MAX_COMMENT_LENGTH = int(os.environ.get('MAX_COMMENT_LENGTH', '50000'))
+# 'full' reviews the selected files with free-form analyses, 'map_reduce' reviews the whole PR as
+# compact findings merged into one ranked list; 'auto' uses map-reduce for PRs too large for a full review
+REVIEW_MODE = os.environ.get('REVIEW_MODE', 'auto').lower()
+MAP_REDUCE_MIN_FILES = int(os.environ.get('MAP_REDUCE_MIN_FILES', '20'))
+MAP_REDUCE_TOKEN_BUDGET = int(os.environ.get('MAP_REDUCE_TOKEN_BUDGET', '200000'))
+# Seconds after which no more map requests are started; the files left are listed as not reviewed
+MAP_REDUCE_TIME_BUDGET = float(os.environ.get('MAP_REDUCE_TIME_BUDGET', '300'))
+MAP_REDUCE_SUMMARY_ENABLED = os.environ.get('MAP_REDUCE_SUMMARY_ENABLED', 'true').lower() == 'true'
+MAP_REDUCE_SUMMARY_TOKENS = int(os.environ.get('MAP_REDUCE_SUMMARY_TOKENS', '200'))
+# Findings shown to the summarization call, and locations listed per merged finding
+SUMMARY_MAX_FINDINGS = 30
+MAX_FINDING_LOCATIONS = 5
+# Riskiest files listed in a summary-only review
+SUMMARY_ONLY_MAX_FILES = 10
+REVIEW_DISCLAIMER = ("Note: This review was generated automatically by an AI assistant. "
+                     "Please consider these suggestions carefully using your own judgment.")
+# Model requests in flight per review; match the server's OLLAMA_NUM_PARALLEL
+ANALYSIS_CONCURRENCY = int(os.environ.get('ANALYSIS_CONCURRENCY', os.environ.get('OLLAMA_NUM_PARALLEL', '4')))
+# The prompt asks the model to end with this marker; generation is cut there
+REVIEW_END_MARKER = '[END OF REVIEW]'
+OLLAMA_STOP_MARKERS = [REVIEW_END_MARKER] + [marker for marker in os.environ.get('OLLAMA_STOP_MARKERS', '').split(',') if marker]
+# Client-side cap on streamed tokens per generation, on top of num_predict
+OLLAMA_OUTPUT_TOKEN_BUDGET = int(os.environ.get('OLLAMA_OUTPUT_TOKEN_BUDGET', '1500'))
+# 'json' asks for findings constrained to FINDINGS_SCHEMA in every mode; 'text' keeps free-form
+# analyses in full mode and one finding per line in map-reduce mode
+REVIEW_OUTPUT_FORMAT = os.environ.get('REVIEW_OUTPUT_FORMAT', 'json').lower()
+STRUCTURED_OUTPUT = REVIEW_OUTPUT_FORMAT == 'json'
+# Output tokens allowed per hunk of a free-form analysis
+FREE_TEXT_TOKENS_PER_HUNK = int(os.environ.get('FREE_TEXT_TOKENS_PER_HUNK', '200'))
+# Bump whenever the review prompt changes so cached reviews from the old prompt are not reused
+PROMPT_TEMPLATE_VERSION = 'hunks-v4'
+FINDINGS_PROMPT_VERSION = 'findings-v3-json' if STRUCTURED_OUTPUT else 'findings-v2'
+# Cached reviews are only reused while the same set of models does the reviewing
+REVIEW_MODELS = ','.join(tier.model for tier in MODEL_TIERS)
+HUNK_LABEL_RE = re.compile(r'^[\s*#>-]*\[HUNK (\d+)\][:.]?', re.MULTILINE)
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+_bitbucket_client = None
+_bitbucket_client_lock = threading.Lock()
+_backend_pool = None
+_backend_pool_lock = threading.Lock()
+_repository_source = None
+_repository_source_lock = threading.Lock()
+_scheduler = None
+_scheduler_lock = threading.Lock()
+_overload_monitor = None
+_overload_monitor_lock = threading.Lock()
+_comment_writer = None
+_comment_writer_lock = threading.Lock()
+
+def get_bitbucket_client():
+    """Return the process-wide Bitbucket API client"""
+    global _bitbucket_client
+    with _bitbucket_client_lock:
+        if _bitbucket_client is None:
+            _bitbucket_client = BitbucketClient(BITBUCKET_API_BASE, BITBUCKET_AUTH)
+        return _bitbucket_client
 
-def process_pr_async(repo_full_name, pr_id):
-    """Start PR processing in a background thread"""
-    thread = threading.Thread(target=process_pr, args=(repo_full_name, pr_id))
-    thread.daemon = True  # Daemon threads exit when the main program exits
-    thread.start()
-    logger.info(f"Started background processing for PR #{pr_id}")
-    return thread
+def get_comment_writer():
+    """Return the process-wide writer of inline review comments"""
+    global _comment_writer
+    with _comment_writer_lock:
+        if _comment_writer is None:
+            _comment_writer = InlineCommentWriter(get_bitbucket_client())
+        return _comment_writer
 
+def get_repository_source():
+    """Return the source of PR diffs and file contents: the Bitbucket client or a git mirror source"""
+    global _repository_source
+    with _repository_source_lock:
+        if _repository_source is None:
+            if REPO_SOURCE == 'git':
+                _repository_source = GitMirrorSource(get_bitbucket_client(), auth_token=BITBUCKET_AUTH)
+            else:
+                _repository_source = get_bitbucket_client()
+        return _repository_source
+
+def get_backend_pool():
+    """Return the process-wide Ollama backend pool, starting its health probes on first use"""
+    global _backend_pool
+    with _backend_pool_lock:
+        if _backend_pool is None:
+            _backend_pool = BackendPool(OLLAMA_BACKENDS or [OLLAMA_URL], MODEL_TIERS).start()
+        return _backend_pool
 
-def process_pr(repo_full_name, pr_id):
-   """Process a pull request"""
+def get_scheduler():
+    """Return the process-wide scheduler of model calls, or None when SCHEDULER_ENABLED is off"""
+    global _scheduler
+    if not SCHEDULER_ENABLED:
+        return None
+    with _scheduler_lock:
+        if _scheduler is None:
+            slots = SCHEDULER_SLOTS or len(OLLAMA_BACKENDS or [OLLAMA_URL]) * int(os.environ.get('OLLAMA_NUM_PARALLEL', '4'))
+            _scheduler = ReviewScheduler(slots)
+        return _scheduler
+
+def get_overload_monitor():
+    """Return the process-wide overload monitor, or None when BACKPRESSURE_ENABLED is off"""
+    global _overload_monitor
+    if not BACKPRESSURE_ENABLED:
+        return None
+    with _overload_monitor_lock:
+        if _overload_monitor is None:
+            _overload_monitor = OverloadMonitor(queue_depth=lambda: get_job_queue().depth())
+        return _overload_monitor
+
+def get_degradation_level():
+    monitor = get_overload_monitor()
+    return monitor.level() if monitor else LEVEL_NORMAL
+
+def admit_review():
+    """Return a Rejection (HTTP status, reason, Retry-After) when the service is too overloaded for new reviews"""
+    monitor = get_overload_monitor()
+    return monitor.admit() if monitor else None
+
+def get_job_queue():
+    """Return the process-wide review job queue, starting its workers on first use"""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(handler=run_review_job)
+            _job_queue.start()
+        return _job_queue
+
+def run_review_job(job):
+    """Job queue handler: run the review pipeline for a queued job"""
+    scheduler = get_scheduler()
+    with scheduler.track(job.job_id, job.repo_full_name) if scheduler else nullcontext():
+        return process_pr(job.repo_full_name, job.pr_id, job=job)
+
+def process_pr_async(repo_full_name, pr_id, source_commit=None):
+    """Queue PR processing, debounced per PR. Returns (job_id, outcome)."""
+    job_id, outcome = get_job_queue().enqueue(repo_full_name, pr_id, source_commit=source_commit)
+    logger.info(f"Background processing for PR #{pr_id} at commit {source_commit}: {outcome} (job {job_id})")
+    return job_id, outcome
+
+def get_job_status(job_id):
+    """Return the status of a review job, or None if it is unknown; running jobs include their model call scheduling"""
+    status = get_job_queue().get(job_id)
+    scheduler = get_scheduler()
+    if status and scheduler:
+        status['scheduler'] = scheduler.job_status(job_id)
+    return status
+
+
+def process_pr(repo_full_name, pr_id, job=None):
+    """Process a pull request, recording each stage on the job when one is given"""
+    job = job or NullJobContext()
     try:
         logger.info(f"Starting PR analysis for {repo_full_name} PR #{pr_id}")
         
@@ -51,49 +218,46 @@ def process_pr(repo_full_name, pr_id):
         
         # Get PR diff
         logger.info(f"Getting diff for PR #{pr_id}")
-        diff_content = get_pr_diff(workspace, repo_slug, pr_id)
-        if not diff_content:
+        diff_lines = job.run_stage('fetch_diff', open_pr_diff, workspace, repo_slug, pr_id, job.source_commit,
+                                   retry_if=lambda result: result is None)
+        if diff_lines is None:
             logger.error(f"Failed to get diff for PR #{pr_id}")
             add_pr_comment(workspace, repo_slug, pr_id, "⚠️ Error: Could not retrieve the diff for this PR. Please check if the PR exists and is accessible.")
             return False
             
-        # Parse diff to extract changed files
-        logger.info(f"Parsing diff with length: {len(diff_content)} characters")
-        changed_files = parse_diff(diff_content)
-        logger.info(f"Found {len(changed_files)} changed files in PR #{pr_id}")
+        # Everything from parsing to the comment text; posting it is left to this function
+        review = review_diff(diff_lines, repo_full_name, job,
+                             fetch_contents=lambda files: fetch_file_contents(workspace, repo_slug, pr_id, files,
+                                                                              source_commit=job.source_commit))
         
-        if not changed_files:
+        if not review['changed_files']:
             logger.info(f"No relevant files to review in PR #{pr_id}")
             add_pr_comment(workspace, repo_slug, pr_id, 
                           "I didn't find any substantial code changes to review in this PR.")
             return True
-            
-        # Limit the number of files to analyze
-        files_to_analyze = select_files_to_analyze(changed_files)
-        logger.info(f"Selected {len(files_to_analyze)} files for analysis")
         
-        # Get file contents
-        for file_info in files_to_analyze:
-            logger.info(f"Getting content for file: {file_info['path']}")
-            file_content = get_file_content(workspace, repo_slug, pr_id, file_info['path'])
-            if file_content:
-                file_info['content'] = file_content
-                logger.info(f"Got content for {file_info['path']}, length: {len(file_content)} chars")
-            else:
-                logger.warning(f"Could not get content for {file_info['path']}")
+        # Under overload, post a summary now and the full review later
+        if review['summary_only']:
+            if review['comment']:
+                job.run_stage('post_comment', add_pr_comment, workspace, repo_slug, pr_id, review['comment'])
+            job.defer(BACKPRESSURE_DEFER_SECONDS)
+            return True
         
-        # Analyze files
-        logger.info(f"Starting analysis of {len(files_to_analyze)} files")
-        results = analyze_files(files_to_analyze)
-        logger.info(f"results======>{results}")
-        logger.info(f"Analysis complete, got results for {len(results)} files")
+        if INLINE_COMMENTS_ENABLED:
+            # Inline comments are not retried as a stage: the ones already posted would be posted again
+            if not job.run_stage('post_comment', post_inline_review, workspace, repo_slug, pr_id, review['mapped'],
+                                 review['files_analyzed'], len(review['changed_files'])):
+                logger.error("Failed to post the review summary to PR")
+                return False
+            return True
         
         # Post comment with analysis results
-        if results:
-            logger.info("Formatting analysis results")
-            comment = format_analysis_results(results, files_to_analyze)
+        comment = review['comment']
+        if comment:
             logger.info(f"Posting comment with length: {len(comment)} chars")
-            comment_result = add_pr_comment(workspace, repo_slug, pr_id, comment)
+            # Not retried as a stage: after a 5xx or a timeout the comment may exist already. The client
+            # retries the answers that mean it was not created (429, 503).
+            comment_result = job.run_stage('post_comment', add_pr_comment, workspace, repo_slug, pr_id, comment)
             if not comment_result:
                 logger.error("Failed to post comment to PR")
                 return False
@@ -105,227 +269,669 @@ def process_pr(repo_full_name, pr_id):
         
         return True
             
+    except JobCancelled:
+        # A newer commit superseded this review; don't post anything for the stale one
+        raise
     except Exception as e:
         error_traceback = traceback.format_exc()
         logger.error(f"Error processing PR #{pr_id}: {str(e)}\n{error_traceback}")
         try:
             add_pr_comment(workspace, repo_slug, pr_id, 
                           f"⚠️ An error occurred while analyzing this PR: {str(e)}")
-                          except Exception as comment_error:
+        except Exception as comment_error:
             logger.error(f"Failed to add error comment to PR #{pr_id}: {str(comment_error)}")
         return False
 
-def get_pr_diff(workspace, repo_slug, pr_id):
-    """Get the diff for a pull request"""
+def review_diff(diff_lines, repo_full_name, job=None, fetch_contents=None):
+    """Review a diff up to the comment text, posting nothing; 'summary_only' is set when overload put it off"""
+    job = job or NullJobContext()
+    review = {'changed_files': [], 'files_analyzed': [], 'results': None, 'mapped': None, 'incomplete': [],
+              'comment': None, 'summary_only': False}
+
+    # Parse the streamed diff to extract changed files
+    logger.info("Parsing streamed diff")
     try:
-        url = f"{BITBUCKET_API_BASE}/repositories/{workspace}/{repo_slug}/pullrequests/{pr_id}/diff"
-        headers = {}
-        if BITBUCKET_AUTH:
-            headers['Authorization'] = f"Basic {BITBUCKET_AUTH}"
-        
-        logger.info(f"Requesting diff from: {url}")
-        response = requests.get(url, headers=headers)
+        changed_files = job.run_stage('parse_diff', parse_diff, diff_lines)
+    finally:
+        diff_lines.close()
+    logger.info(f"Found {len(changed_files)} changed files")
+    
+    # Drop trivial and unreviewable changes before they cost a model call
+    if PREFILTER_ENABLED:
+        changed_files = job.run_stage('prefilter', prefilter_files, changed_files, repo_full_name, trace=job.trace)
+    review['changed_files'] = changed_files
+    if not changed_files:
+        return review
         
-        if response.status_code == 200:
-            logger.info(f"Successfully got diff, length: {len(response.text)} chars")
-            return response.text
-        else:
-            logger.error(f"Failed to get PR diff: {response.status_code} - {response.text}")
-            return None
+    # Under overload, review less, or only summarize now and review in full later
+    level = get_degradation_level()
+    if level != LEVEL_NORMAL:
+        logger.warning(f"Reviewing {repo_full_name} at degradation level {LEVEL_NAMES[level]}")
+        if job.trace is not None:
+            job.trace.append({'event': 'degradation', 'level': LEVEL_NAMES[level]})
+    if level >= LEVEL_SUMMARY_ONLY and job.deferrals < BACKPRESSURE_MAX_DEFERRALS:
+        review['summary_only'] = True
+        if not job.deferrals:
+            review['comment'] = job.run_stage('summarize', format_summary_only, changed_files, repo_full_name)
+        return review
+    
+    # Limit the number of files to analyze
+    map_reduce = use_map_reduce(changed_files)
+    budget_ratio = BACKPRESSURE_FILE_BUDGET_RATIO if level >= LEVEL_FEWER_FILES else 1.0
+    files_to_analyze = job.run_stage('select_files', select_files_to_analyze, changed_files, repo_full_name,
+                                     map_reduce=map_reduce, budget_ratio=budget_ratio)
+    review['files_analyzed'] = files_to_analyze
+    logger.info(f"Selected {len(files_to_analyze)} files for analysis")
+    if get_scheduler():
+        # Smaller reviews get their model calls first
+        get_scheduler().set_job_size(sum(estimate_file_tokens(file_info) for file_info in files_to_analyze))
+    
+    # Get file contents
+    if fetch_contents:
+        job.run_stage('fetch_contents', fetch_contents, files_to_analyze)
+    
+    # Files that don't parse are reported as they are, without a model call
+    syntax_errors = []
+    if PREFILTER_ENABLED:
+        syntax_errors = job.run_stage('check_syntax', find_syntax_errors, files_to_analyze)
+    broken_paths = {error['path'] for error in syntax_errors}
+    files_to_review = [file_info for file_info in files_to_analyze if file_info['path'] not in broken_paths]
+    
+    # Send each hunk with its enclosing function or class instead of the whole file
+    if CONTEXT_ENABLED:
+        job.run_stage('extract_context', add_hunk_context, files_to_review, trace=job.trace)
+    
+    # Analyze files
+    if map_reduce or INLINE_COMMENTS_ENABLED:
+        logger.info(f"Starting {'map-reduce' if map_reduce else 'findings'} review of {len(files_to_review)} files")
+        mapped = job.run_stage('analyze', map_findings, files_to_review, trace=job.trace,
+                               time_budget=MAP_REDUCE_TIME_BUDGET if map_reduce else None,
+                               retry_if=lambda mapped: nothing_reviewed(files_to_review, mapped['incomplete']))
+        if nothing_reviewed(files_to_review, mapped['incomplete']):
+            raise RuntimeError(f"None of the {len(files_to_review)} files could be reviewed, the model calls failed")
+        mapped['findings'] = syntax_errors + mapped['findings']
+        mapped['reviewed'] = sorted(broken_paths) + mapped['reviewed']
+        review['mapped'] = mapped
+        review['incomplete'] = mapped['incomplete']
+        if not INLINE_COMMENTS_ENABLED:
+            review['comment'] = job.run_stage('reduce', reduce_review, mapped, len(changed_files), trace=job.trace)
+        return review
+
+    logger.info(f"Starting analysis of {len(files_to_review)} files")
+    results = syntax_error_results(syntax_errors)
+    incomplete = []
+    results += job.run_stage('analyze', analyze_files, files_to_review, trace=job.trace, incomplete=incomplete,
+                             retry_if=lambda _: nothing_reviewed(files_to_review, incomplete))
+    # Not posting "no issues" for a review that didn't happen keeps the commit from being marked reviewed
+    if nothing_reviewed(files_to_review, incomplete):
+        raise RuntimeError(f"None of the {len(files_to_review)} files could be reviewed, the model calls failed")
+    # Analyses can be large; only format them when DEBUG logging is on
+    logger.debug("Analysis results: %s", results)
+    logger.info(f"Analysis complete, got results for {len(results)} files")
+    review['results'] = results
+    review['incomplete'] = incomplete
+    if results or incomplete:
+        logger.info("Formatting analysis results")
+        review['comment'] = format_analysis_results(results, files_to_analyze, incomplete)
+    return review
+
+def open_pr_diff(workspace, repo_slug, pr_id, source_commit=None):
+    """Open the diff of a pull request (at `source_commit` when known) as a stream of lines, or None on failure"""
+    try:
+        return get_repository_source().iter_pr_diff_lines(workspace, repo_slug, pr_id, source_commit)
             
     except Exception as e:
         logger.error(f"Error getting PR diff: {str(e)}", exc_info=True)
         return None
 
 def parse_diff(diff_content):
-    """Parse diff content to extract changed files and their changes"""
+    """Parse a diff (a string or an iterable of lines) into changed files, each capped at MAX_FILE_DIFF_SIZE"""
     if not diff_content:
         logger.warning("Diff content is empty")
         return []
-        
-    if len(diff_content) > MAX_DIFF_SIZE:
-        logger.warning(f"Diff too large ({len(diff_content)} chars), truncating to {MAX_DIFF_SIZE} chars")
-        diff_content = diff_content[:MAX_DIFF_SIZE]
-        
-    changed_files = []
-    current_file = None
-    changes = []
     
+    parsed_count = 0
+    filtered_files = []
     try:
-        for line in diff_content.split('\n'):
-            if line.startswith('diff --git'):
-                # Save previous file if exists
-                if current_file:
-                    changed_files.append({
-                        'path': current_file,
-                        'changes': '\n'.join(changes),
-                        'size': len('\n'.join(changes))
-                    })
-                    
-                # Extract new filename
-                parts = line.split(' ')
-                if len(parts) >= 4:
-                    current_file = parts[3][2:]  # Remove 'b/' prefix
-                    changes = []
-                elif current_file and (line.startswith('+') or line.startswith('-')):
-                # Only collect actual changes (additions/deletions)
-                changes.append(line)
-        
-        # Add the last file
-        if current_file and changes:
-            changed_files.append({
-                'path': current_file,
-                'changes': '\n'.join(changes),
-                'size': len('\n'.join(changes))
-            })
+        for file_info in iter_diff_files(diff_content):
+            parsed_count += 1
+            file_ext = os.path.splitext(file_info['path'] or '')[1].lower()
             
-        # Filter out ignored file types
-        filtered_files = []
-        for file_info in changed_files:
-            file_ext = os.path.splitext(file_info['path'])[1].lower()
-            if file_ext not in IGNORE_FILE_TYPES:
-                filtered_files.append(file_info)
+            # Filter out ignored file types and files without reviewable changes
+            if file_ext in IGNORE_FILE_TYPES:
+                continue
+            if file_info['is_rename'] and not file_info['hunks']:
+                logger.info(f"Skipping {file_info['path']}: pure rename of {file_info['old_path']}")
+                PREFILTER_SKIPPED.inc(kind='file', reason='rename')
+                continue
+            if file_info['is_binary'] or file_info['is_deleted'] or not file_info['changes']:
+                logger.info(f"Skipping {file_info['path']}: binary, deleted or no changed lines")
+                continue
+            filtered_files.append(file_info)
                 
-        logger.info(f"Parsed {len(changed_files)} files from diff, {len(filtered_files)} after filtering")
+        logger.info(f"Parsed {parsed_count} files from diff, {len(filtered_files)} after filtering")
         return filtered_files
     
+    except (requests.RequestException, OSError, GitError):
+        # The streamed diff broke off: fail the stage rather than review part of the PR, or none of it
+        raise
     except Exception as e:
-        except Exception as e:
         logger.error(f"Error parsing diff: {str(e)}", exc_info=True)
         return []
 
 
-def select_files_to_analyze(changed_files):
-     """Select which files to analyze based on importance and size"""
+def prefilter_files(changed_files, repo_full_name=None, trace=None):
+    """Drop ignored, generated and trivially changed files and hunks before selection"""
     try:
-        # Sort by size (changes size)
-        sorted_files = sorted(changed_files, key=lambda x: x['size'], reverse=True)
-        
-        # Take the top N files
-        selected = sorted_files[:MAX_FILES_TO_REVIEW]
-        logger.info(f"Selected {len(selected)} files out of {len(changed_files)} for analysis")
+        kept, skipped = prefilter(changed_files, repo_full_name)
+        logger.info(f"Pre-filter kept {len(kept)} of {len(changed_files)} files, skipped: {skipped}")
+        if trace is not None:
+            trace.append({'event': 'prefilter', 'files': len(changed_files), 'kept_files': len(kept),
+                          'skipped': skipped})
+        return kept
+    except Exception as e:
+        logger.error(f"Error pre-filtering files: {str(e)}", exc_info=True)
+        return changed_files
+
+def syntax_error_results(syntax_errors):
+    """Turn syntax errors found locally into per-file analysis results"""
+    return [{'file_path': error['path'],
+             'analysis': f"**{error['message']}**" + (f" at line {error['line']}" if error['line'] else "") + ". "
+                         "The file does not parse, so it was not reviewed further.",
+             'cached_hunks': 0}
+            for error in syntax_errors]
+
+def nothing_reviewed(files_to_review, incomplete):
+    """Whether none of the files got a review, as when every model call failed"""
+    return bool(files_to_review) and len(incomplete) >= len(files_to_review)
+
+def use_map_reduce(changed_files):
+    """Whether to review the PR in map-reduce mode, per REVIEW_MODE"""
+    if REVIEW_MODE in ('full', 'map_reduce'):
+        return REVIEW_MODE == 'map_reduce'
+    if MAP_REDUCE_MIN_FILES and len(changed_files) >= MAP_REDUCE_MIN_FILES:
+        return True
+    if MAX_FILES_TO_REVIEW and len(changed_files) > MAX_FILES_TO_REVIEW:
+        return True
+    return sum(estimate_file_tokens(file_info) for file_info in changed_files) > REVIEW_TOKEN_BUDGET
+
+def select_files_to_analyze(changed_files, repo_full_name=None, map_reduce=False, budget_ratio=1.0):
+    """Select the riskiest files that fit in the review token budget, scaled by `budget_ratio` under load"""
+    try:
+        if map_reduce:
+            selected, tokens = select_by_risk(changed_files, repo_full_name,
+                                              token_budget=MAP_REDUCE_TOKEN_BUDGET * budget_ratio)
+        else:
+            selected, tokens = select_by_risk(changed_files, repo_full_name, token_budget=REVIEW_TOKEN_BUDGET * budget_ratio,
+                                              max_files=MAX_FILES_TO_REVIEW)
+        logger.info(f"Selected {len(selected)} files out of {len(changed_files)} for analysis, "
+                    f"~{tokens} prompt tokens: " + ', '.join(f"{f['path']} ({f['risk_score']})" for f in selected))
         return selected
     except Exception as e:
         logger.error(f"Error selecting files to analyze: {str(e)}", exc_info=True)
         return []
 
+def fetch_file_contents(workspace, repo_slug, pr_id, files_to_analyze, source_commit=None):
+    """Fill in file_info['content'] for each selected file at `source_commit` (else the PR's)"""
+    client = get_repository_source()
+    source_commit = source_commit or client.get_source_commit(workspace, repo_slug, pr_id)
+    if not source_commit:
+        logger.warning(f"Could not determine source commit of PR #{pr_id}, skipping file contents")
+        return files_to_analyze
+    
+    paths = [file_info['path'] for file_info in files_to_analyze]
+    logger.info(f"Getting content for {len(paths)} files at {source_commit}")
+    contents = client.get_file_contents(workspace, repo_slug, source_commit, paths)
+    for file_info in files_to_analyze:
+        file_content = contents.get(file_info['path'])
+        if file_content:
+            file_info['content'] = file_content
+            logger.info(f"Got content for {file_info['path']}, length: {len(file_content)} chars")
+        else:
+            logger.warning(f"Could not get content for {file_info['path']}")
+    return files_to_analyze
+
+def add_hunk_context(files_to_review, trace=None):
+    """Attach the enclosing scope and imports from each file's content to its hunks"""
+    try:
+        tokens = get_context_extractor().add_hunk_context(files_to_review)
+        logger.info(f"Added ~{tokens} tokens of context to the hunks of {len(files_to_review)} files")
+        if trace is not None:
+            trace.append({'event': 'context', 'files': len(files_to_review), 'tokens': tokens})
+    except Exception as e:
+        logger.error(f"Error extracting hunk context: {str(e)}", exc_info=True)
+    return files_to_review
+
 def get_file_content(workspace, repo_slug, pr_id, file_path):
-     """Get the content of a file in the PR"""
+    """Get the content of a file in the PR"""
     try:
-        # Get the latest commit in the PR
-        url = f"{BITBUCKET_API_BASE}/repositories/{workspace}/{repo_slug}/pullrequests/{pr_id}"
-        headers = {}
-        if BITBUCKET_AUTH:
-            headers['Authorization'] = f"Basic {BITBUCKET_AUTH}"
+        client = get_repository_source()
+        source_commit = client.get_source_commit(workspace, repo_slug, pr_id)
+        if not source_commit:
+            return None
+        return client.get_file_content(workspace, repo_slug, source_commit, file_path)
+            
+    except Exception as e:
+        logger.error(f"Error getting file content for {file_path}: {str(e)}", exc_info=True)
+        return None
+
+def get_file_hunks(file_info):
+    """Return the file's hunks, treating a diff without hunk headers as one hunk"""
+    hunks = [hunk for hunk in file_info.get('hunks') or [] if hunk['lines']]
+    if hunks:
+        return hunks
+    changes = file_info.get('changes', '')
+    return [{'header': '', 'lines': changes.split('\n')}] if changes else []
+
+def format_hunk_context(units, i, shown):
+    """Context block of the i-th unit (1-based), showing imports and scopes once per prompt"""
+    path, hunk = units[i - 1]['path'], units[i - 1]['hunk']
+    context = hunk.get('context')
+    if not context:
+        return ''
+    scope = hunk.get('context_scope')
+    key = (path, tuple(scope) if scope else context)
+    if key in shown:
+        where = f", lines {scope[0]}-{scope[1]}" if scope else ''
+        return f"Context: same scope as [HUNK {shown[key]}]{where}\nChanges:\n"
+    shown[key] = i
+    if hunk.get('context_imports'):
+        if (path, 'imports') in shown:
+            context = hunk.get('context_scope_text')
+            if not context:
+                return ''
+        shown[(path, 'imports')] = i
+    return f"Context:\n{context}\nChanges:\n"
+
+def build_hunks_prompt(units):
+    """Build the review prompt for a batch of review units, one labelled section per hunk"""
+    sections = []
+    shown = {}
+    for i, unit in enumerate(units, 1):
+        body = '\n'.join(unit['hunk']['lines'])
+        sections.append(f"[HUNK {i}] {unit['path']} {unit['hunk']['header']}\n{format_hunk_context(units, i, shown)}{body}")
+    hunk_text = '\n\n'.join(sections)
+    return f"""
+            please help to review this js code
+            check any syntax error , add suugested validation error code.
+            The changes are split into hunks, possibly from several files. Start your review of each hunk with its label, e.g. [HUNK 1].
+            A hunk may start with context from its enclosing function or class; review only the changed lines.
+            When you have reviewed every hunk, write {REVIEW_END_MARKER} and stop.
+{hunk_text} """
+
+def split_hunk_analysis(analysis, hunk_count):
+    """Split a model response into per-hunk sections by [HUNK n] label; None if it can't be mapped back"""
+    if hunk_count == 1:
+        return [HUNK_LABEL_RE.sub('', analysis, count=1).strip()]
+    matches = list(HUNK_LABEL_RE.finditer(analysis))
+    sections = [None] * hunk_count
+    for i, match in enumerate(matches):
+        index = int(match.group(1)) - 1
+        if not 0 <= index < hunk_count:
+            continue
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(analysis)
+        sections[index] = analysis[match.end():end].strip()
+    if any(section is None for section in sections):
+        return None
+    return sections
+
+def collect_review_units(files_to_analyze, cache, prompt_version=PROMPT_TEMPLATE_VERSION, field='analysis'):
+    """Split files into per-hunk review units; returns (cached analyses per file and hunk or None, units to review)"""
+    hunk_analyses = []
+    units = []
+    for file_index, file_info in enumerate(files_to_analyze):
+        file_path = file_info['path']
+        if not file_info.get('content') and not file_info.get('changes'):
+            logger.warning(f"No content or changes for {file_path}, skipping")
+            hunk_analyses.append([])
+            continue
         
-        logger.info(f"Getting PR details from: {url}")
-        response = requests.get(url, headers=headers)
+        analyses = []
+        for hunk_index, hunk in enumerate(get_file_hunks(file_info)):
+            key = ReviewCache.make_key(REVIEW_MODELS, prompt_version,
+                                       hunk_hash(hunk['lines'], file_path, hunk.get('context')))
+            entry = cache.get(key) if cache is not None else None
+            analyses.append(entry[field] if entry else None)
+            if entry is None:
+                units.append({'file_index': file_index, 'hunk_index': hunk_index, 'path': file_path,
+                              'hunk': hunk, 'key': key, 'part': 0, 'parts': 1,
+                              'risk_score': file_info.get('risk_score')})
+        hunk_analyses.append(analyses)
+    return hunk_analyses, units
+
+def analyze_batch(units, trace=None):
+    """Review one packed batch of units with a single model call; returns (unit, analysis, cacheable) tuples"""
+    try:
+        stats = {} if trace is not None else None
+        risk = max((unit.get('risk_score') or 0) for unit in units)
+        num_predict = estimate_output_tokens(units, FREE_TEXT_TOKENS_PER_HUNK, OLLAMA_OUTPUT_TOKEN_BUDGET)
+        analysis = generate_analysis(build_hunks_prompt(units), stats, risk=risk, num_predict=num_predict)
+        if trace is not None:
+            trace.append(dict(stats, event='model_call', hunks=len(units),
+                              files=sorted({unit['path'] for unit in units})))
+        if not analysis:
+            logger.warning(f"No analysis generated for batch of {len(units)} hunks")
+            return []
         
-        if response.status_code != 200:
-            logger.error(f"Failed to get PR details: {response.status_code} - {response.text}")
-            return None
+        sections = split_hunk_analysis(analysis, len(units))
+        if sections is not None:
+            return [(unit, section, True) for unit, section in zip(units, sections)]
         
-        pr_data = response.json()
-        source_branch = pr_data.get('source', {}).get('branch', {}).get('name')
-        source_commit = pr_data.get('source', {}).get('commit', {}).get('hash')
+        paths = list(dict.fromkeys(unit['path'] for unit in units))
+        if len(paths) == 1:
+            logger.info(f"Could not split analysis for {paths[0]} into hunks, not caching it")
+            return [(units[0], analysis, False)]
         
-        if not source_branch or not source_commit:
-            logger.error("Missing source branch or commit information")
-            logger.error(f"PR data keys: {list(pr_data.keys())}")
-            logger.error(f"Source data: {json.dumps(pr_data.get('source', {}))}")
-            return None
+        logger.info(f"Could not split analysis of {len(paths)} files into hunks, retrying per file")
+        outcomes = []
+        for path in paths:
+            outcomes.extend(analyze_batch([unit for unit in units if unit['path'] == path], trace))
+        return outcomes
+            
+    except Exception as e:
+        logger.error(f"Error analyzing batch of {len(units)} hunks: {str(e)}", exc_info=True)
+        return []
+
+def analyze_files(files_to_analyze, concurrency=None, trace=None, incomplete=None):
+    """Analyze files using the AI model; paths left partly unreviewed are put in `incomplete`"""
+    if STRUCTURED_OUTPUT:
+        return analyze_files_structured(files_to_analyze, concurrency, trace, incomplete)
+    cache = get_review_cache()
+    total = len(files_to_analyze)
+    hunk_analyses, units = collect_review_units(files_to_analyze, cache)
+    batches = plan_batches(units)
+    cached_count = sum(len(analyses) for analyses in hunk_analyses) - len(units)
+    logger.info(f"Analyzing {total} files: {len(units)} hunks to review in {len(batches)} requests, "
+                f"{cached_count} hunks cached")
+    if trace is not None:
+        trace.append({'event': 'analysis_plan', 'files': total, 'hunks': len(units),
+                      'cached_hunks': cached_count, 'requests': len(batches)})
+    
+    fresh = {}
+    uncacheable = set()
+    if batches:
+        concurrency = max(1, min(concurrency or ANALYSIS_CONCURRENCY, len(batches)))
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='analysis',
+                                initializer=bind_job, initargs=(current_job(),)) as executor:
+            for outcomes in executor.map(lambda batch: analyze_batch(batch, trace), batches):
+                for unit, analysis, cacheable in outcomes:
+                    hunk_id = (unit['file_index'], unit['hunk_index'])
+                    fresh.setdefault(hunk_id, {})[unit['part']] = analysis
+                    if not cacheable:
+                        uncacheable.add(hunk_id)
+    
+    # Store complete hunk reviews, joining the parts of split hunks
+    parts_expected = {(unit['file_index'], unit['hunk_index']): (unit['parts'], unit['key']) for unit in units}
+    for hunk_id, parts in fresh.items():
+        analysis = '\n\n'.join(parts[part] for part in sorted(parts))
+        hunk_analyses[hunk_id[0]][hunk_id[1]] = analysis
+        expected_parts, key = parts_expected[hunk_id]
+        if cache is not None and hunk_id not in uncacheable and len(parts) == expected_parts:
+            cache.put(key, {'analysis': analysis, 'path': files_to_analyze[hunk_id[0]]['path']})
+    
+    if incomplete is not None:
+        incomplete[:] = [file_info['path'] for file_info, analyses in zip(files_to_analyze, hunk_analyses)
+                         if any(analysis is None for analysis in analyses)]
+    results = []
+    for file_index, file_info in enumerate(files_to_analyze):
+        analyses = hunk_analyses[file_index]
+        analysis = '\n\n'.join(text for text in analyses if text)
+        if not analysis:
+            logger.warning(f"No analysis generated for {file_info['path']}")
+            continue
+        cached_hunks = sum(1 for hunk_index in range(len(analyses)) if (file_index, hunk_index) not in parts_expected)
+        results.append({
+            'file_path': file_info['path'],
+            'analysis': analysis,
+            'cached_hunks': cached_hunks
+        })
             
-        # Get file content
-        file_url = f"{BITBUCKET_API_BASE}/repositories/{workspace}/{repo_slug}/src/{source_commit}/{file_path}"
-        logger.info(f"Getting file content from: {file_url}")
-        file_response = requests.get(file_url, headers=headers)
+    logger.info(f"Analyzed {len(results)}/{total} files successfully")
+    if cache is not None:
+        logger.info(f"Review cache stats: {cache.stats()}")
+    return results
+
+def analyze_files_structured(files_to_analyze, concurrency=None, trace=None, incomplete=None):
+    """Full-mode review through the findings path: one result per file with findings, listed most severe first"""
+    mapped = map_findings(files_to_analyze, concurrency, trace, time_budget=None)
+    if incomplete is not None:
+        incomplete[:] = mapped['incomplete']
+    by_path = {}
+    for finding in mapped['findings']:
+        by_path.setdefault(finding['path'], []).append(finding)
+    results = []
+    for file_info in files_to_analyze:
+        findings = sorted(by_path.get(file_info['path'], []),
+                          key=lambda finding: (SEVERITIES.index(finding['severity']), finding['line'] or 0))
+        if not findings:
+            continue
+        results.append({
+            'file_path': file_info['path'],
+            'analysis': '\n'.join(format_file_finding(finding) for finding in findings),
+            'cached_hunks': mapped['cached_hunks'].get(file_info['path'], 0)
+        })
+    logger.info(f"Found issues in {len(results)}/{len(files_to_analyze)} files")
+    return results
+
+def format_file_finding(finding):
+    line = f" line {finding['line']}" if finding['line'] is not None else ""
+    return f"- **{finding['severity']}**{line}: {finding['message']}"
+
+def get_review_cache_stats():
+    """Return hit/miss counters of the review cache, or None when it is disabled"""
+    cache = get_review_cache()
+    return cache.stats() if cache is not None else None
+
+def build_findings_prompt(units):
+    """Build the map-step prompt asking for compact findings labelled by hunk, as JSON or one per line"""
+    sections = []
+    shown = {}
+    for i, unit in enumerate(units, 1):
+        hunk = unit['hunk']
+        line_numbers = hunk.get('line_numbers') or [None] * len(hunk['lines'])
+        # Added lines carry their line number in the new file so findings can point at them
+        body = '\n'.join(f"{number if number and line.startswith('+') else '':>5} {line}"
+                         for line, number in zip(hunk['lines'], line_numbers))
+        sections.append(f"[HUNK {i}] {unit['path']} {hunk['header']}\n{format_hunk_context(units, i, shown)}{body}")
+    hunk_text = '\n\n'.join(sections)
+    if STRUCTURED_OUTPUT:
+        return f"""
+            Review these code changes for bugs, syntax errors, security problems and missing validation.
+            The changes are split into hunks, possibly from several files. Added lines are prefixed with their line number.
+            A hunk may start with context from its enclosing function or class; report problems in the changed lines only.
+            Answer with JSON only, in this form:
+            {{"has_issues": true, "findings": [{{"hunk": <n>, "severity": "<critical|high|medium|low>", "line": <line>, "message": "<one sentence describing the problem and the fix>"}}]}}
+            Report only real problems; no praise, no summaries. If no hunk has a problem, answer {{"has_issues": false, "findings": []}}
+{hunk_text} """
+    return f"""
+            Review these code changes for bugs, syntax errors, security problems and missing validation.
+            The changes are split into hunks, possibly from several files. Added lines are prefixed with their line number.
+            A hunk may start with context from its enclosing function or class; report problems in the changed lines only.
+            Report each problem on its own line, exactly in this format:
+            [HUNK <n>] <critical|high|medium|low> L<line>: <one sentence describing the problem and the fix>
+            Report only real problems; no praise, no summaries. For a hunk without problems write: [HUNK <n>] NO ISSUES
+            When you have reviewed every hunk, write {REVIEW_END_MARKER} and stop.
+{hunk_text} """
+
+def anchor_line(hunk, line):
+    """Return the reported line if it lies within the hunk's changed lines, else the hunk's first added line"""
+    numbers = [number for text, number in zip(hunk['lines'], hunk.get('line_numbers') or [])
+               if number and text.startswith('+')]
+    if line is not None and (not numbers or min(numbers) - 3 <= line <= max(numbers) + 3):
+        return line
+    return numbers[0] if numbers else hunk.get('new_start')
+
+def analyze_findings_batch(units, deadline=None, trace=None):
+    """Map step for one packed batch; returns (unit, findings, cacheable) tuples, or None past `deadline`"""
+    if deadline is not None and time.monotonic() > deadline:
+        return None
+    try:
+        stats = {} if trace is not None else None
+        risk = max((unit.get('risk_score') or 0) for unit in units)
+        text = generate_analysis(build_findings_prompt(units), stats, risk=risk,
+                                 num_predict=estimate_output_tokens(units, limit=OLLAMA_OUTPUT_TOKEN_BUDGET),
+                                 output_format=FINDINGS_SCHEMA if STRUCTURED_OUTPUT else None)
+        if trace is not None:
+            trace.append(dict(stats, event='model_call', hunks=len(units),
+                              files=sorted({unit['path'] for unit in units})))
+        if text is None:
+            return []
         
-        if file_response.status_code == 200:
-            logger.info(f"Got file content, length: {len(file_response.text)} chars")
-            return file_response.text
+        if STRUCTURED_OUTPUT:
+            findings, complete = parse_json_findings(text, len(units))
         else:
-            logger.error(f"Failed to get file content: {file_response.status_code} - {file_response.text}")
-            return None
+            findings, complete = parse_findings(text, len(units))
+        if not complete:
+            logger.info(f"Model did not answer every hunk of a batch of {len(units)}, not caching its findings")
+        outcomes = []
+        for unit, unit_findings in zip(units, findings):
+            hunk = unit['hunk']
+            relative = []
+            for finding in unit_findings:
+                line = anchor_line(hunk, finding['line'])
+                relative.append({'severity': finding['severity'], 'message': finding['message'],
+                                 'line_offset': line - (hunk.get('new_start') or 0) if line is not None else None})
+            outcomes.append((unit, relative, complete))
+        return outcomes
             
     except Exception as e:
-        logger.error(f"Error getting file content for {file_path}: {str(e)}", exc_info=True)
-        return None
+        logger.error(f"Error analyzing batch of {len(units)} hunks: {str(e)}", exc_info=True)
+        return []
 
-def analyze_files(files_to_analyze):
-    """Analyze files using the AI model"""
-    results = []
+def map_findings(files_to_analyze, concurrency=None, trace=None, time_budget=MAP_REDUCE_TIME_BUDGET):
+    """Map step of a map-reduce review: compact findings for every hunk, within `time_budget` seconds"""
+    cache = get_review_cache()
+    hunk_findings, units = collect_review_units(files_to_analyze, cache, FINDINGS_PROMPT_VERSION, 'findings')
+    batches = plan_batches(units)
+    cached_count = sum(len(findings) for findings in hunk_findings) - len(units)
+    logger.info(f"Mapping {len(files_to_analyze)} files: {len(units)} hunks to review in {len(batches)} requests, "
+                f"{cached_count} hunks cached")
+    if trace is not None:
+        trace.append({'event': 'analysis_plan', 'mode': 'map_reduce', 'files': len(files_to_analyze),
+                      'hunks': len(units), 'cached_hunks': cached_count, 'requests': len(batches)})
     
-    for i, file_info in enumerate(files_to_analyze):
-        try:
-            file_path = file_info['path']
-            file_ext = os.path.splitext(file_path)[1].lower()
-            changes = file_info.get('changes', '')
-            content = file_info.get('content', '')
-            
-            logger.info(f"Analyzing file {i+1}/{len(files_to_analyze)}: {file_path}")
-            
-            if not content and not changes:
-                logger.warning(f"No content or changes for {file_path}, skipping")
-                continue
-                
-            # Prepare prompt for AI analysis
-            prompt = f"""
-            please help to review this js code
-            check any syntax error , add suugested validation error code:{changes} """
-            
-            # Get AI analysis
-            logger.info(f"Generating analysis for {file_path}")
-            analysis = generate_analysis(prompt)
-            
-            if analysis:
-                logger.info(f"Analysis generated for {file_path}, length: {len(analysis)} chars")
-                results.append({
-                    'file_path': file_path,
-                    'analysis': analysis
+    deadline = time.monotonic() + time_budget if time_budget else None
+    fresh = {}
+    uncacheable = set()
+    skipped_requests = 0
+    if batches:
+        concurrency = max(1, min(concurrency or ANALYSIS_CONCURRENCY, len(batches)))
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='analysis',
+                                initializer=bind_job, initargs=(current_job(),)) as executor:
+            for outcomes in executor.map(lambda batch: analyze_findings_batch(batch, deadline, trace), batches):
+                if outcomes is None:
+                    skipped_requests += 1
+                    continue
+                for unit, findings, cacheable in outcomes:
+                    hunk_id = (unit['file_index'], unit['hunk_index'])
+                    fresh.setdefault(hunk_id, {})[unit['part']] = findings
+                    if not cacheable:
+                        uncacheable.add(hunk_id)
+    if skipped_requests:
+        logger.warning(f"Skipped {skipped_requests}/{len(batches)} map requests after the {time_budget}s time budget")
+    
+    parts_expected = {(unit['file_index'], unit['hunk_index']): (unit['parts'], unit['key']) for unit in units}
+    for hunk_id, parts in fresh.items():
+        expected_parts, key = parts_expected[hunk_id]
+        if len(parts) < expected_parts:
+            continue
+        findings = [finding for part in sorted(parts) for finding in parts[part]]
+        hunk_findings[hunk_id[0]][hunk_id[1]] = findings
+        if cache is not None and hunk_id not in uncacheable:
+            cache.put(key, {'findings': findings, 'path': files_to_analyze[hunk_id[0]]['path']})
+    
+    mapped = {'findings': [], 'reviewed': [], 'incomplete': [], 'skipped_requests': skipped_requests,
+              'cached_hunks': {}}
+    for file_index, file_info in enumerate(files_to_analyze):
+        hunks = get_file_hunks(file_info)
+        mapped['cached_hunks'][file_info['path']] = sum(
+            1 for hunk_index in range(len(hunks)) if (file_index, hunk_index) not in parts_expected)
+        for hunk, findings in zip(hunks, hunk_findings[file_index]):
+            for finding in findings or []:
+                line = finding['line_offset']
+                mapped['findings'].append({
+                    'path': file_info['path'],
+                    'line': line + (hunk.get('new_start') or 0) if line is not None else None,
+                    'severity': finding['severity'],
+                    'message': finding['message'],
+                    'risk_score': file_info.get('risk_score')
                 })
-            else:
-                logger.warning(f"No analysis generated for {file_path}")
-                
-        except Exception as e:
-            logger.error(f"Error analyzing file {file_info.get('path')}: {str(e)}", exc_info=True)
-            
-    logger.info(f"Analyzed {len(results)}/{len(files_to_analyze)} files successfully")
-    return results
+        if any(findings is None for findings in hunk_findings[file_index]):
+            mapped['incomplete'].append(file_info['path'])
+        else:
+            mapped['reviewed'].append(file_info['path'])
+    
+    logger.info(f"Mapped {len(mapped['reviewed'])}/{len(files_to_analyze)} files to {len(mapped['findings'])} findings")
+    if cache is not None:
+        logger.info(f"Review cache stats: {cache.stats()}")
+    return mapped
 
-def generate_analysis(prompt):
-   """Generate analysis using Ollama API"""
+def summarize_findings(ranked, reviewed_count):
+    """Run the single, short summarization call of the reduce step; returns None on failure"""
+    lines = [f"- {entry['severity']}: {entry['message']} ({len(entry['locations'])} places)"
+             for entry in ranked[:SUMMARY_MAX_FINDINGS]]
+    prompt = f"""
+            These are the findings of an automated review of {reviewed_count} files in a pull request, most severe first.
+            Summarize the most important risks for the author in at most four sentences. Do not repeat the list.
+            Then write {REVIEW_END_MARKER} and stop.
+""" + '\n'.join(lines)
+    summary = generate_analysis(prompt, num_predict=MAP_REDUCE_SUMMARY_TOKENS)
+    return summary.replace(REVIEW_END_MARKER, '').strip() if summary else None
+
+def reduce_review(mapped, changed_file_count, trace=None):
+    """Reduce step of a map-reduce review: merge and rank the findings, summarize them and build the comment"""
+    ranked = reduce_findings(mapped['findings'])
+    summary = None
+    if ranked and MAP_REDUCE_SUMMARY_ENABLED:
+        summary = summarize_findings(ranked, len(mapped['reviewed']))
+    if trace is not None:
+        trace.append({'event': 'reduce', 'findings': len(mapped['findings']), 'merged_findings': len(ranked),
+                      'summary': summary is not None})
+    return format_findings_results(ranked, summary, mapped, changed_file_count)
+
+def generate_analysis(prompt, stats=None, risk=None, num_predict=None, output_format=None):
+    """Generate analysis using Ollama API; `stats`, when given, gets the generation's counters"""
     try:
         logger.info("Calling Ollama API for analysis")
-        response = requests.post(
-            f"{OLLAMA_URL}/api/generate",
-            json={
-                "model": MODEL_NAME,
-                "prompt": prompt,
-                "options": {
-                    "temperature": 0.1,  # Lower temperature for more focused review
-                    "top_p": 0.95,
-                    "num_predict": 1500  # Limit response size
-                }
-            }
-        )
-        
-        if response.status_code != 200:
-            logger.error(f"Ollama API error: {response.status_code} - {response.text}")
-            return None
+        options = {
+            "temperature": 0.1,  # Lower temperature for more focused review
+            "top_p": 0.95,
+            "num_predict": num_predict or 1500  # Limit response size
+        }
+        if output_format is None:
+            options["stop"] = OLLAMA_STOP_MARKERS
+        prompt_tokens = estimate_tokens(prompt)
+        scheduler = get_scheduler()
+        monitor = get_overload_monitor()
+        started = time.monotonic()
+        with scheduler.slot(prompt_tokens) if scheduler else nullcontext(0.0) as waited:
+            generation = get_backend_pool().generate(
+                prompt,
+                prompt_tokens=prompt_tokens,
+                risk=risk,
+                # Under load, the next smaller model tier answers
+                downgrade=1 if monitor and monitor.level() >= LEVEL_SMALLER_TIER else 0,
+                options=options,
+                stop_markers=OLLAMA_STOP_MARKERS,
+                # num_predict is enforced by Ollama, which then still sends its final counters; cut client-side
+                # only below it
+                max_tokens=OLLAMA_OUTPUT_TOKEN_BUDGET if OLLAMA_OUTPUT_TOKEN_BUDGET < options["num_predict"] else None,
+                format=output_format
+            )
+        if monitor:
+            monitor.record_model_call(time.monotonic() - started)
+        generated_text = generation.pop('text')
+        if stats is not None:
+            stats.update(generation, scheduler_wait_ms=round(waited * 1000, 1))
         
-        # Parse response
-        generated_text = ""
-        logger.info(f"generates text ->: {response.text}")
-        logger.info(f"Parsing Ollama response with length: {len(response.text)} chars")
-        for line in response.text.strip().split('\n'):
-            if line:
-                try:
-                    data = json.loads(line)
-                    if 'response' in data:
-                        generated_text += data['response']
-                except json.JSONDecodeError:
-                    logger.warning(f"Failed to parse line as JSON: {line[:50]}...")
-                    continue
+        tokens_per_second = None
+        if generation['eval_count'] and generation['eval_duration']:
+            tokens_per_second = round(generation['eval_count'] / (generation['eval_duration'] / 1e9), 1)
+        logger.info(f"Generated {generation['tokens']} tokens with {generation['model']} on {generation['backend']} "
+                    f"in {generation['total_ms']} ms "
+                    f"(first token after {generation['time_to_first_token_ms']} ms, {tokens_per_second} tokens/s"
+                    + (f", stopped early: {generation['stopped_early']}" if generation['stopped_early'] else "") + ")")
+        logger.debug("Generated text: %s", generated_text)
         
         if not generated_text:
             logger.warning("No text generated from Ollama API")
@@ -336,31 +942,29 @@ def generate_analysis(prompt):
         logger.error(f"Error generating analysis: {str(e)}", exc_info=True)
         return None
 
-def format_analysis_results(results, files_analyzed):
-   """Format analysis results into a PR comment"""
+def format_analysis_results(results, files_analyzed, incomplete=None):
+    """Format analysis results into a PR comment, listing the files in `incomplete` as not fully reviewed"""
     try:
-        if not results:
+        if not results and not incomplete:
             logger.warning("No results to format")
             return "I've reviewed this PR but found no significant issues to report."
             
         # Create comment header
-        comment = f"# AI Code Review\n\n"
-        comment += f"I've analyzed {len(files_analyzed)} files in this PR and found some suggestions:\n\n"
+        header = f"# AI Code Review\n\n"
+        if results:
+            header += f"I've analyzed {len(files_analyzed)} files in this PR and found some suggestions:\n\n"
+        else:
+            header += f"I've analyzed {len(files_analyzed)} files in this PR and found no significant issues.\n\n"
         
         # Add file-specific comments
-        for result in results:
-            file_path = result['file_path']
-            analysis = result['analysis']
-            
-            comment += f"## {file_path}\n\n"
-            comment += f"{analysis}\n\n"
-            comment += "---\n\n"
+        sections = [f"## {result['file_path']}\n\n{result['analysis']}\n\n---\n\n" for result in results]
         
         # Add disclaimer
-        comment += "Note: This review was generated automatically by an AI assistant. Please consider these suggestions carefully using your own judgment."
+        footer = format_incomplete_note(incomplete) + REVIEW_DISCLAIMER
         
-        # Truncate if too long
-       
+        # Truncate if too long, dropping whole file sections
+        comment = join_within_limit(header, sections, footer, MAX_COMMENT_LENGTH,
+                                    lambda count: f"_{count} more files not shown: the comment length limit was reached._\n\n")
         logger.info(f"Formatted analysis results, final comment length: {len(comment)} chars")
         return comment
     
@@ -368,42 +972,98 @@ def format_analysis_results(results, files_analyzed):
         logger.error(f"Error formatting analysis results: {str(e)}", exc_info=True)
         return "Error formatting analysis results. Please check the logs for details."
 
-def add_pr_comment(workspace, repo_slug, pr_id, comment):
-     """Add a comment to a PR"""
+def format_summary_only(changed_files, repo_full_name=None):
+    """Build the comment posted instead of a review under heavy load: PR size and the riskiest files, without a model call"""
+    ranked, _ = select_by_risk(changed_files, repo_full_name, token_budget=float('inf'))
+    added = sum(file_info.get('added', 0) for file_info in changed_files)
+    removed = sum(file_info.get('removed', 0) for file_info in changed_files)
+    comment = "# AI Code Review\n\n"
+    comment += ("The reviewer is under heavy load, so this is a summary only; "
+                "the full review will follow once the load goes down.\n\n")
+    comment += (f"This PR changes {len(changed_files)} file{'s' if len(changed_files) != 1 else ''} "
+                f"(+{added}/-{removed} lines). Riskiest files:\n\n")
+    for file_info in ranked[:SUMMARY_ONLY_MAX_FILES]:
+        comment += (f"- `{file_info['path']}` (risk {file_info['risk_score']}, "
+                    f"+{file_info.get('added', 0)}/-{file_info.get('removed', 0)})\n")
+    if len(ranked) > SUMMARY_ONLY_MAX_FILES:
+        comment += f"- _and {len(ranked) - SUMMARY_ONLY_MAX_FILES} more_\n"
+    return comment + "\n" + REVIEW_DISCLAIMER
+
+def format_finding(entry):
+    locations = [f"`{location['path']}:{location['line']}`" if location['line'] is not None else f"`{location['path']}`"
+                 for location in entry['locations']]
+    text = f"- **{entry['severity']}** {locations[0]}: {entry['message']}"
+    if len(locations) > 1:
+        more = len(locations) - MAX_FINDING_LOCATIONS
+        text += f" (also {', '.join(locations[1:MAX_FINDING_LOCATIONS])}" + (f" and {more} more" if more > 0 else "") + ")"
+    return text + "\n"
+
+def format_findings_results(ranked, summary, mapped, changed_file_count):
+    """Format the ranked findings of a map-reduce review into a PR comment of at most MAX_COMMENT_LENGTH chars"""
     try:
-        url = f"{BITBUCKET_API_BASE}/repositories/{workspace}/{repo_slug}/pullrequests/{pr_id}/comments"
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        
-        if BITBUCKET_AUTH:
-            headers['Authorization'] = f"Basic {BITBUCKET_AUTH}"
-            logger.info("Using Bitbucket authentication")
+        reviewed = len(mapped['reviewed'])
+        header = "# AI Code Review\n\n"
+        header += f"I've reviewed {reviewed} of {changed_file_count} changed files in this PR"
+        if ranked:
+            header += f" and found {len(ranked)} issue{'s' if len(ranked) > 1 else ''}, most severe first:\n\n"
         else:
-            logger.warning("No Bitbucket authentication configured")
-            
-        data = {
-            "content": {
-                "raw": comment
-            }
-        }
+            header += " and found no significant issues.\n\n"
+        if summary:
+            header += f"{summary}\n\n"
         
-        logger.info(f"Posting comment to: {url}")
-        response = requests.post(url, headers=headers, json=data)
-        
-        if response.status_code in (201, 200):
-            logger.info(f"Successfully added comment to PR #{pr_id}")
-            return True
-        else:
-            logger.error(f"Failed to add PR comment: {response.status_code} - {response.text}")
-            # Check auth issues
-            if response.status_code == 401:
-                logger.error("Authentication failed. Check BITBUCKET_USERNAME and BITBUCKET_APP_PASSWORD")
-            elif response.status_code == 403:
-                logger.error("Permission denied. User may not have write access to this repository")
-            elif response.status_code == 404:
-                logger.error("Resource not found. Check workspace, repo_slug and PR ID")
-            return False
+        footer = format_findings_footer(mapped)
+        comment = join_within_limit(header, [format_finding(entry) for entry in ranked], footer, MAX_COMMENT_LENGTH,
+                                    lambda count: f"- _{count} more findings not shown: the comment length limit was reached._\n")
+        logger.info(f"Formatted {len(ranked)} findings, final comment length: {len(comment)} chars")
+        return comment
+    
+    except Exception as e:
+        logger.error(f"Error formatting findings: {str(e)}", exc_info=True)
+        return "Error formatting analysis results. Please check the logs for details."
+
+def format_incomplete_note(paths):
+    """Line listing the files not fully reviewed, or '' when there are none"""
+    if not paths:
+        return ""
+    names = ', '.join(f"`{path}`" for path in paths[:MAX_FINDING_LOCATIONS * 4])
+    more = len(paths) - MAX_FINDING_LOCATIONS * 4
+    return f"Not fully reviewed (time budget reached or model errors): {names}" + (f" and {more} more" if more > 0 else "") + "\n\n"
+
+def format_findings_footer(mapped):
+    """Footer of a findings comment: the files not fully reviewed, then the disclaimer"""
+    return "\n" + format_incomplete_note(mapped['incomplete']) + REVIEW_DISCLAIMER
+
+def format_inline_summary(mapped, posted_count, ranked, changed_file_count):
+    """Format the summary comment of an inline review: counts, then the findings that were not commented inline"""
+    total = len(mapped['findings'])
+    header = "# AI Code Review\n\n"
+    header += f"I've reviewed {len(mapped['reviewed'])} of {changed_file_count} changed files in this PR"
+    if not total:
+        header += " and found no significant issues.\n\n"
+    else:
+        header += f" and found {total} issue{'s' if total > 1 else ''}"
+        if posted_count:
+            header += f", commented inline on {posted_count} line{'s' if posted_count > 1 else ''}"
+        header += ".\n\n"
+        if ranked:
+            header += "Not commented inline, most severe first:\n\n"
+    return join_within_limit(header, [format_finding(entry) for entry in ranked], format_findings_footer(mapped),
+                             MAX_COMMENT_LENGTH,
+                             lambda count: f"- _{count} more findings not shown: the comment length limit was reached._\n")
+
+def post_inline_review(workspace, repo_slug, pr_id, mapped, files_analyzed, changed_file_count):
+    """Post findings as inline comments, then a summary of the rest; returns whether the summary was posted"""
+    groups, unanchored = group_inline_findings(mapped['findings'], files_analyzed)
+    posted, not_posted = get_comment_writer().post(workspace, repo_slug, pr_id, groups)
+    remaining = unanchored + [finding for group in not_posted for finding in group['findings']]
+    summary = format_inline_summary(mapped, len(posted), reduce_findings(remaining), changed_file_count)
+    logger.info(f"Posting review summary with length: {len(summary)} chars")
+    return add_pr_comment(workspace, repo_slug, pr_id, summary)
+
+def add_pr_comment(workspace, repo_slug, pr_id, comment):
+    """Add a comment to a PR"""
+    try:
+        return get_bitbucket_client().add_pr_comment(workspace, repo_slug, pr_id, comment)
             
     except Exception as e:
         logger.error(f"Error adding PR comment: {str(e)}", exc_info=True)
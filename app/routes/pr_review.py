@@ -1,5 +1,6 @@
-from flask import Blueprint, jsonify, request
-from controllers.pr_review import process_pr_async
+from flask import Blueprint, jsonify, request, url_for
+from controllers.pr_review import admit_review, process_pr_async, get_job_status, get_review_cache_stats
+import json
 import logging
 import traceback
 
@@ -40,9 +41,11 @@ def bitbucket_webhook():
         pr_id = pr_data.get('id')
         repo_info = pr_data.get('destination', {}).get('repository', {})
         repo_full_name = repo_info.get('full_name', '')
+        source_commit = pr_data.get('source', {}).get('commit', {}).get('hash')
         
-        logger.info(f"PR ID: {pr_id}, Repo: {repo_full_name}")
-        logger.info(f"Repository info: {json.dumps(repo_info)}")
+        logger.info(f"PR ID: {pr_id}, Repo: {repo_full_name}, Source commit: {source_commit}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Repository info: {json.dumps(repo_info)}")
         
         if not pr_id or not repo_full_name:
             logger.error("Missing PR ID or repository name in payload")
@@ -50,15 +53,35 @@ def bitbucket_webhook():
             
         logger.info(f"Processing PR #{pr_id} from repository {repo_full_name}")
         
-        # Start the PR analysis process
-        process_result = process_pr_async(repo_full_name, pr_id)
+        # Past the hard overload limits, refuse the event so Bitbucket delivers it again later
+        rejection = admit_review()
+        if rejection is not None:
+            logger.warning(f"Refusing PR #{pr_id} of {repo_full_name}: {rejection.reason}")
+            return jsonify({
+                "error": rejection.reason,
+                "pr_id": pr_id,
+                "repository": repo_full_name
+            }), rejection.status_code, {'Retry-After': str(rejection.retry_after)}
+        
+        # Queue the PR analysis job; repeated events for the same PR are coalesced
+        job_id, outcome = process_pr_async(repo_full_name, pr_id, source_commit)
+        
+        if job_id is None:
+            return jsonify({
+                "message": f"Commit {source_commit} was already reviewed, ignoring",
+                "pr_id": pr_id,
+                "repository": repo_full_name,
+                "outcome": outcome
+            }), 200
         
         return jsonify({
-            "message": "PR analysis completed",
+            "message": f"PR analysis {outcome}",
             "pr_id": pr_id,
             "repository": repo_full_name,
-            "status": "success" if process_result else "error"
-        }), 200
+            "job_id": job_id,
+            "outcome": outcome,
+            "status_url": url_for('pr_review.review_job_status', job_id=job_id)
+        }), 202
         
     except Exception as e:
         error_traceback = traceback.format_exc()
@@ -68,3 +91,20 @@ def bitbucket_webhook():
             "traceback": error_traceback
         }), 500
 
+
+@pr_review_bp.route('/pr-review/jobs/<job_id>', methods=['GET'])
+def review_job_status(job_id):
+    """Report the state and per-stage timings of a review job"""
+    status = get_job_status(job_id)
+    if status is None:
+        return jsonify({"error": f"Unknown job: {job_id}"}), 404
+    return jsonify(status), 200
+
+
+@pr_review_bp.route('/pr-review/cache/stats', methods=['GET'])
+def review_cache_stats():
+    """Report hit/miss counters of the hunk review cache"""
+    stats = get_review_cache_stats()
+    if stats is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify(dict(stats, enabled=True)), 200
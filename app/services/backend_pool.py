@@ -0,0 +1,268 @@
+import logging
+import os
+import threading
+import time
+import requests
+from services import metrics
+from services.ollama_client import OllamaError, get_ollama_client
+
+logger = logging.getLogger(__name__)
+
+# Backend pool config
+# Comma-separated Ollama base URLs; empty means the single OLLAMA_HOST/OLLAMA_PORT server
+OLLAMA_BACKENDS = [url.strip().rstrip('/') for url in os.environ.get('OLLAMA_BACKENDS', '').split(',') if url.strip()]
+# Comma-separated model tiers, smallest first, as "model@max_prompt_tokens"; the last tier takes the rest
+MODEL_TIERS_SPEC = os.environ.get('MODEL_TIERS', '')
+# Batches containing a file with at least this risk score go to the largest tier (0 = off)
+MODEL_TIER_RISK_THRESHOLD = float(os.environ.get('MODEL_TIER_RISK_THRESHOLD', '0'))
+OLLAMA_CIRCUIT_FAILURES = int(os.environ.get('OLLAMA_CIRCUIT_FAILURES', '3'))
+OLLAMA_CIRCUIT_COOLDOWN = float(os.environ.get('OLLAMA_CIRCUIT_COOLDOWN', '30'))
+OLLAMA_BACKEND_PROBE_INTERVAL = float(os.environ.get('OLLAMA_BACKEND_PROBE_INTERVAL', '10'))
+
+PROBE_TIMEOUT = 2
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+OUTSTANDING = metrics.gauge('ollama_backend_outstanding_requests', 'Generations in flight per backend', ['backend'])
+CIRCUIT_OPENED = metrics.counter('ollama_backend_circuit_opened_total', 'Times a backend circuit opened', ['backend'])
+FAILOVERS = metrics.counter('ollama_backend_failovers_total',
+                            'Generations retried on another backend or tier', ['reason'])
+GENERATIONS = metrics.counter('ollama_pool_generations_total',
+                              'Generations requested from the backend pool, by result (ok, failed)', ['result'])
+
+
+class ModelTier:
+    """A model and the largest estimated prompt (in tokens) it is used for"""
+
+    def __init__(self, model, max_prompt_tokens=None):
+        self.model = model
+        self.max_prompt_tokens = max_prompt_tokens
+
+    def __repr__(self):
+        return f"{self.model}@{self.max_prompt_tokens}" if self.max_prompt_tokens else self.model
+
+
+def parse_tiers(spec):
+    """Parse "small-model@2000,big-model" into ModelTiers, smallest first"""
+    tiers = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        model, _, limit = entry.partition('@')
+        tiers.append(ModelTier(model, int(limit) if limit else None))
+    return tiers
+
+
+class Backend:
+    """One Ollama server with its load, circuit state and known models"""
+
+    def __init__(self, url):
+        self.url = url
+        self.client = get_ollama_client(url)
+        self.outstanding = 0
+        self.failures = 0
+        self.circuit = CIRCUIT_CLOSED
+        self.open_until = 0.0
+        self.trial_in_flight = False
+        # Model names from /api/tags; None until the first successful probe
+        self.models = None
+        # Models the backend answered 404 for, until a probe lists them
+        self.missing_models = set()
+        self.last_error = None
+
+    def lists(self, model):
+        return self.models is not None and (model in self.models or f"{model}:latest" in self.models)
+
+    def serves(self, model):
+        """Whether a request for the model may be sent here; only a 404 rules a backend out, not its tag list"""
+        return model not in self.missing_models
+
+    def available(self, now):
+        if self.circuit == CIRCUIT_OPEN and now >= self.open_until:
+            self.circuit = CIRCUIT_HALF_OPEN
+        if self.circuit == CIRCUIT_HALF_OPEN:
+            # Let a single trial request through to find out whether the backend recovered
+            return not self.trial_in_flight
+        return self.circuit == CIRCUIT_CLOSED
+
+    def status(self):
+        return {
+            'url': self.url,
+            'circuit': self.circuit,
+            'outstanding': self.outstanding,
+            'failures': self.failures,
+            'models': sorted(self.models) if self.models is not None else None,
+            'missing_models': sorted(self.missing_models),
+            'error': self.last_error
+        }
+
+
+class BackendPool:
+    """Routes generations over several Ollama servers and model tiers.
+
+    A request goes to the smallest tier whose prompt limit fits its
+    estimated size (risky batches go straight to the largest), on the
+    backend with the fewest requests in flight, preferring backends that
+    list the model; a backend is only skipped for a model after it
+    answered 404 for it, until its model list shows the model.
+    Backends that keep failing are taken out by a circuit breaker for
+    OLLAMA_CIRCUIT_COOLDOWN seconds, then tried again with one request.
+    A failed request fails over to the next backend, then to the other
+    tiers' models. Adding a server only means adding its URL.
+    """
+
+    def __init__(self, urls, tiers):
+        if not urls or not tiers:
+            raise ValueError("A backend pool needs at least one backend URL and one model tier")
+        self.backends = [Backend(url) for url in urls]
+        self.tiers = tiers
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._session = requests.Session()
+
+    def start(self):
+        """Start probing the backends' health and models in the background"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._probe_loop, name='ollama-backend-probe')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+
+    def select_tier(self, prompt_tokens, risk=None, downgrade=0):
+        """The tier for a prompt, or `downgrade` tiers smaller than that when shedding load"""
+        index = len(self.tiers) - 1
+        if not (MODEL_TIER_RISK_THRESHOLD and risk is not None and risk >= MODEL_TIER_RISK_THRESHOLD):
+            index = next((i for i, tier in enumerate(self.tiers)
+                          if tier.max_prompt_tokens is None or prompt_tokens <= tier.max_prompt_tokens), index)
+        return self.tiers[max(0, index - downgrade)]
+
+    def _acquire(self, model, tried):
+        now = time.monotonic()
+        with self._lock:
+            candidates = [backend for backend in self.backends
+                          if backend.url not in tried and backend.serves(model) and backend.available(now)]
+            if not candidates:
+                return None
+            backend = min(candidates, key=lambda backend: (not backend.lists(model), backend.outstanding))
+            backend.outstanding += 1
+            if backend.circuit == CIRCUIT_HALF_OPEN:
+                backend.trial_in_flight = True
+            OUTSTANDING.set(backend.outstanding, backend=backend.url)
+            return backend
+
+    def _release(self, backend, failed=False, error=None):
+        with self._lock:
+            backend.outstanding -= 1
+            OUTSTANDING.set(backend.outstanding, backend=backend.url)
+            was_trial = backend.trial_in_flight and backend.circuit == CIRCUIT_HALF_OPEN
+            backend.trial_in_flight = False
+            if failed:
+                self._record_failure(backend, error, reopen=was_trial)
+            elif backend.circuit != CIRCUIT_OPEN:
+                backend.failures = 0
+                backend.last_error = None
+                if backend.circuit == CIRCUIT_HALF_OPEN:
+                    logger.info(f"Ollama backend {backend.url} recovered, closing its circuit")
+                backend.circuit = CIRCUIT_CLOSED
+
+    def _record_failure(self, backend, error, reopen=False):
+        """Count a failure and open the circuit past the threshold; call with the lock held"""
+        backend.failures += 1
+        backend.last_error = str(error) if error else None
+        if backend.circuit == CIRCUIT_OPEN:
+            return
+        if reopen or backend.failures >= OLLAMA_CIRCUIT_FAILURES:
+            backend.circuit = CIRCUIT_OPEN
+            backend.open_until = time.monotonic() + OLLAMA_CIRCUIT_COOLDOWN
+            CIRCUIT_OPENED.inc(backend=backend.url)
+            logger.warning(f"Opened circuit of Ollama backend {backend.url} for {OLLAMA_CIRCUIT_COOLDOWN:.0f}s "
+                           f"after {backend.failures} failures: {backend.last_error}")
+
+    def generate(self, prompt, prompt_tokens=0, risk=None, downgrade=0, **kwargs):
+        """Run generate_stream on the best available backend, failing over on errors.
+
+        Returns the generate_stream result with the `model` and `backend`
+        that produced it. Raises OllamaError when every backend and tier failed.
+        """
+        tier = self.select_tier(prompt_tokens, risk, downgrade)
+        models = [tier.model] + [other.model for other in reversed(self.tiers) if other.model != tier.model]
+        last_error = None
+        for model in models:
+            if model != tier.model:
+                FAILOVERS.inc(reason='tier')
+                logger.warning(f"No backend could serve {tier.model}, falling back to {model}")
+            tried = set()
+            while True:
+                backend = self._acquire(model, tried)
+                if backend is None:
+                    break
+                if tried:
+                    FAILOVERS.inc(reason='backend')
+                tried.add(backend.url)
+                try:
+                    result = backend.client.generate_stream(model, prompt, **kwargs)
+                except OllamaError as e:
+                    last_error = e
+                    if e.status_code == 404:
+                        # The model is not pulled on this backend; not a health problem
+                        self._release(backend)
+                        with self._lock:
+                            backend.missing_models.add(model)
+                        continue
+                    if e.status_code is not None and e.status_code < 500:
+                        self._release(backend)
+                        GENERATIONS.inc(result='failed')
+                        raise
+                    self._release(backend, failed=True, error=e)
+                    logger.warning(f"Ollama backend {backend.url} failed for {model}: {str(e)}")
+                    continue
+                except requests.RequestException as e:
+                    last_error = e
+                    self._release(backend, failed=True, error=e)
+                    logger.warning(f"Ollama backend {backend.url} failed for {model}: {str(e)}")
+                    continue
+                self._release(backend)
+                GENERATIONS.inc(result='ok')
+                result['model'] = model
+                result['backend'] = backend.url
+                return result
+        GENERATIONS.inc(result='failed')
+        raise OllamaError(f"No Ollama backend could serve the request: {last_error or 'all backends unavailable'}")
+
+    def probe(self):
+        """Refresh each backend's model list; an unreachable backend counts as a failure"""
+        for backend in self.backends:
+            try:
+                response = self._session.get(f"{backend.url}/api/tags", timeout=PROBE_TIMEOUT)
+                response.raise_for_status()
+                models = {model.get('name') for model in response.json().get('models', [])}
+            except (requests.RequestException, ValueError) as e:
+                with self._lock:
+                    self._record_failure(backend, e)
+                continue
+            with self._lock:
+                backend.models = models
+                backend.missing_models = {model for model in backend.missing_models if not backend.lists(model)}
+
+    def _probe_loop(self):
+        while True:
+            try:
+                self.probe()
+            except Exception as e:
+                logger.error(f"Ollama backend probe failed: {str(e)}", exc_info=True)
+            if self._stopping.wait(OLLAMA_BACKEND_PROBE_INTERVAL):
+                return
+
+    def status(self):
+        with self._lock:
+            return {
+                'tiers': [repr(tier) for tier in self.tiers],
+                'backends': [backend.status() for backend in self.backends]
+            }
@@ -0,0 +1,137 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Backpressure config
+BACKPRESSURE_ENABLED = os.environ.get('BACKPRESSURE_ENABLED', 'true').lower() == 'true'
+# Queue depths (running jobs plus queued jobs that can run now) from which degradation levels 1, 2 and 3 apply
+BACKPRESSURE_QUEUE_DEPTHS = os.environ.get('BACKPRESSURE_QUEUE_DEPTHS', '20,40,80')
+# Mean seconds per model call (including the wait for a scheduler slot) from which levels 1, 2 and 3 apply
+BACKPRESSURE_MODEL_LATENCIES = os.environ.get('BACKPRESSURE_MODEL_LATENCIES', '60,120,240')
+# Beyond these, webhooks are refused: 429 for a full queue, 503 for an overloaded model
+BACKPRESSURE_MAX_QUEUE_DEPTH = int(os.environ.get('BACKPRESSURE_MAX_QUEUE_DEPTH', '150'))
+BACKPRESSURE_MAX_MODEL_LATENCY = float(os.environ.get('BACKPRESSURE_MAX_MODEL_LATENCY', '600'))
+# Model calls older than this many seconds no longer count towards the measured latency
+BACKPRESSURE_LATENCY_WINDOW = float(os.environ.get('BACKPRESSURE_LATENCY_WINDOW', '120'))
+BACKPRESSURE_RETRY_AFTER = int(os.environ.get('BACKPRESSURE_RETRY_AFTER', '60'))
+# Share of the review token budget used from level 1 on
+BACKPRESSURE_FILE_BUDGET_RATIO = float(os.environ.get('BACKPRESSURE_FILE_BUDGET_RATIO', '0.5'))
+# At level 3 the full review is deferred by this many seconds, at most this many times
+BACKPRESSURE_DEFER_SECONDS = float(os.environ.get('BACKPRESSURE_DEFER_SECONDS', '600'))
+BACKPRESSURE_MAX_DEFERRALS = int(os.environ.get('BACKPRESSURE_MAX_DEFERRALS', '3'))
+
+# Seconds the computed level is reused before queue depth is read again
+LEVEL_REFRESH_SECONDS = 1.0
+
+LEVEL_NORMAL = 0
+LEVEL_FEWER_FILES = 1
+LEVEL_SMALLER_TIER = 2
+LEVEL_SUMMARY_ONLY = 3
+LEVEL_NAMES = ['normal', 'fewer_files', 'smaller_tier', 'summary_only']
+
+DEGRADATION_LEVEL = metrics.gauge('review_degradation_level',
+                                  'Current degradation level: 0 normal, 1 fewer files, 2 smaller tier, 3 summary only')
+MODEL_LATENCY = metrics.gauge('review_model_call_latency_seconds',
+                              'Mean duration of recent model calls, including the wait for a scheduler slot')
+REJECTED = metrics.counter('review_requests_rejected_total', 'Webhooks refused by admission control', ['reason'])
+
+
+def parse_thresholds(spec):
+    """Parse "20,40,80" into ascending thresholds for levels 1, 2 and 3"""
+    return sorted(float(value) for value in spec.split(',') if value.strip())
+
+
+class Rejection:
+    """Why a review request is refused, as the HTTP answer to give"""
+
+    def __init__(self, status_code, reason, retry_after):
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class OverloadMonitor:
+    """Turns queue depth and measured model latency into a degradation level and admission decisions.
+
+    Each signal maps to a level through its thresholds and the higher one
+    wins. Reviews started at level 1 get a smaller file budget, model
+    calls made at level 2 go to the next smaller model tier, and reviews
+    started at level 3 post a summary only and run in full later. Past
+    the hard limits new webhooks are refused so that Bitbucket retries.
+    """
+
+    def __init__(self, queue_depth, queue_thresholds=BACKPRESSURE_QUEUE_DEPTHS,
+                 latency_thresholds=BACKPRESSURE_MODEL_LATENCIES, window=BACKPRESSURE_LATENCY_WINDOW):
+        self.queue_depth = queue_depth
+        self.queue_thresholds = parse_thresholds(queue_thresholds)
+        self.latency_thresholds = parse_thresholds(latency_thresholds)
+        self.window = window
+        self._calls = deque()
+        self._level = None
+        self._level_at = 0.0
+        self._depth = 0
+        self._lock = threading.Lock()
+        DEGRADATION_LEVEL.set_function(self.level)
+        MODEL_LATENCY.set_function(self.model_latency)
+
+    def record_model_call(self, seconds):
+        now = time.monotonic()
+        with self._lock:
+            self._calls.append((now, seconds))
+            self._expire(now)
+
+    def _expire(self, now):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def model_latency(self):
+        """Mean seconds of the model calls finished within the window; 0 without recent calls"""
+        with self._lock:
+            self._expire(time.monotonic())
+            if not self._calls:
+                return 0.0
+            return sum(seconds for _, seconds in self._calls) / len(self._calls)
+
+    def level(self):
+        """Current degradation level, refreshed at most once per LEVEL_REFRESH_SECONDS"""
+        now = time.monotonic()
+        with self._lock:
+            if self._level is not None and now - self._level_at < LEVEL_REFRESH_SECONDS:
+                return self._level
+        depth = self.queue_depth()
+        latency = self.model_latency()
+        level = max(sum(1 for threshold in self.queue_thresholds if depth >= threshold),
+                    sum(1 for threshold in self.latency_thresholds if latency >= threshold))
+        level = min(level, LEVEL_SUMMARY_ONLY)
+        with self._lock:
+            if level != self._level and self._level is not None:
+                logger.warning(f"Degradation level {LEVEL_NAMES[self._level]} -> {LEVEL_NAMES[level]} "
+                               f"(queue depth {depth}, model latency {latency:.1f}s)")
+            self._level, self._level_at, self._depth = level, now, depth
+        return level
+
+    def admit(self):
+        """Return a Rejection when a new review request must be refused, else None"""
+        depth = self.queue_depth()
+        if BACKPRESSURE_MAX_QUEUE_DEPTH and depth >= BACKPRESSURE_MAX_QUEUE_DEPTH:
+            REJECTED.inc(reason='queue_full')
+            return Rejection(429, f"Review queue is full ({depth} jobs)", BACKPRESSURE_RETRY_AFTER)
+        latency = self.model_latency()
+        if BACKPRESSURE_MAX_MODEL_LATENCY and latency >= BACKPRESSURE_MAX_MODEL_LATENCY:
+            REJECTED.inc(reason='model_overloaded')
+            return Rejection(503, f"Model calls take {latency:.0f}s on average", BACKPRESSURE_RETRY_AFTER)
+        return None
+
+    def status(self):
+        level = self.level()
+        return {
+            'level': level,
+            'level_name': LEVEL_NAMES[level],
+            'queue_depth': self._depth,
+            'model_latency_seconds': round(self.model_latency(), 2)
+        }
@@ -0,0 +1,365 @@
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bitbucket client config
+BITBUCKET_POOL_SIZE = int(os.environ.get('BITBUCKET_POOL_SIZE', '10'))
+BITBUCKET_TIMEOUT = float(os.environ.get('BITBUCKET_TIMEOUT', '30'))
+PR_METADATA_TTL = float(os.environ.get('PR_METADATA_TTL', '30'))
+FILE_FETCH_CONCURRENCY = int(os.environ.get('FILE_FETCH_CONCURRENCY', '4'))
+FILE_CONTENT_CACHE_ENTRIES = int(os.environ.get('FILE_CONTENT_CACHE_ENTRIES', '512'))
+DIFF_CHUNK_SIZE = 64 * 1024
+# Requests per second sent to Bitbucket by all threads of the process, and the burst allowed above it (0 = no limit)
+BITBUCKET_RATE_LIMIT = float(os.environ.get('BITBUCKET_RATE_LIMIT', '10'))
+BITBUCKET_RATE_BURST = int(os.environ.get('BITBUCKET_RATE_BURST', '20'))
+# Retries of a request answered with 429 or a 5xx, after Retry-After or a jittered exponential backoff
+BITBUCKET_MAX_RETRIES = int(os.environ.get('BITBUCKET_MAX_RETRIES', '4'))
+BITBUCKET_BACKOFF_BASE = float(os.environ.get('BITBUCKET_BACKOFF_BASE', '1'))
+BITBUCKET_BACKOFF_MAX = float(os.environ.get('BITBUCKET_BACKOFF_MAX', '30'))
+# A Retry-After longer than this is not waited for; the request fails and its stage is retried later
+BITBUCKET_MAX_RETRY_WAIT = float(os.environ.get('BITBUCKET_MAX_RETRY_WAIT', '120'))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Other 5xx may come after a comment was created; retrying those would post it twice
+WRITE_RETRY_STATUSES = (429, 503)
+
+# Full commit hashes name immutable content, so cached files for them never need revalidation
+COMMIT_HASH_RE = re.compile(r'^[0-9a-f]{40}$')
+
+REQUEST_DURATION = metrics.histogram('bitbucket_request_duration_seconds',
+                                     'Bitbucket API request duration, until the response headers arrive',
+                                     ['operation'])
+REQUESTS = metrics.counter('bitbucket_requests_total', 'Bitbucket API requests by HTTP status',
+                           ['operation', 'status'])
+CACHE_LOOKUPS = metrics.counter('cache_lookups_total', 'Cache lookups by cache and result', ['cache', 'result'])
+RETRIES = metrics.counter('bitbucket_retries_total', 'Bitbucket API requests retried, by the status that caused it',
+                          ['operation', 'status'])
+RATE_LIMIT_WAIT = metrics.histogram('bitbucket_rate_limit_wait_seconds',
+                                    'Time a Bitbucket API request waited for the rate limiter')
+
+
+def parse_retry_after(value):
+    """Seconds to wait per a Retry-After header, given in seconds or as an HTTP date; None if absent or invalid"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=BITBUCKET_BACKOFF_BASE, cap=BITBUCKET_BACKOFF_MAX):
+    """Exponential backoff with equal jitter: between half and all of base * 2^attempt, at most cap"""
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class RateLimiter:
+    """Token bucket shared by all threads sending requests to Bitbucket.
+
+    Each request takes a token; tokens refill at `rate` per second up to
+    `burst`. pause() stops every request until a deadline, as when
+    Bitbucket answers 429 with Retry-After, and empties the bucket so the
+    waiting requests resume at `rate` instead of all at once.
+    """
+
+    def __init__(self, rate=BITBUCKET_RATE_LIMIT, burst=BITBUCKET_RATE_BURST):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for a token; returns the seconds waited"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                delay = self._paused_until - now
+                if delay <= 0:
+                    if not self.rate:
+                        return waited
+                    self._tokens = min(self.burst, self._tokens + max(0.0, now - self._updated) * self.rate)
+                    self._updated = max(now, self._updated)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return waited
+                    delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """Hold back all requests for `seconds`"""
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self._paused_until:
+                self._paused_until = until
+                self._tokens = 0.0
+                self._updated = until
+
+    def status(self):
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'paused_seconds': round(max(0.0, self._paused_until - time.monotonic()), 1)
+            }
+
+
+class DiffStream:
+    """Iterates over the lines of a streamed diff response as chunks arrive.
+
+    Lines are split on '\n' only (diff content may contain other line
+    separators such as form feeds). The stream can be read once; call
+    close() to release the connection.
+    """
+
+    def __init__(self, response, chunk_size=DIFF_CHUNK_SIZE):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.chars_read = 0
+        self.started = False
+        response.encoding = response.encoding or 'utf-8'
+
+    def __iter__(self):
+        # A second pass would continue where a broken read stopped and look like a shorter diff
+        if self.started:
+            raise requests.exceptions.StreamConsumedError("The diff stream was already read")
+        self.started = True
+        pending = ''
+        for chunk in self.response.iter_content(chunk_size=self.chunk_size, decode_unicode=True):
+            self.chars_read += len(chunk)
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            yield from lines
+        if pending:
+            yield pending
+
+    def close(self):
+        self.response.close()
+        logger.info(f"Read streamed diff, {self.chars_read} chars")
+
+
+class BitbucketClient:
+    """Bitbucket REST client sharing one keep-alive connection pool.
+
+    PR metadata is cached for a short TTL so a job fetches it once, and
+    file contents are cached per commit: content at a full commit hash is
+    served from memory, other refs are revalidated with If-None-Match.
+    Requests go through a rate limiter and are retried on 429 and 5xx.
+    """
+
+    def __init__(self, api_base, auth_token=None, pool_size=BITBUCKET_POOL_SIZE, timeout=BITBUCKET_TIMEOUT,
+                 limiter=None, max_retries=BITBUCKET_MAX_RETRIES):
+        self.api_base = api_base.rstrip('/')
+        self.timeout = timeout
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if auth_token:
+            self.session.headers['Authorization'] = f"Basic {auth_token}"
+            logger.info("Using Bitbucket authentication")
+        else:
+            logger.warning("No Bitbucket authentication configured")
+        self._pr_cache = {}
+        self._pr_cache_lock = threading.Lock()
+        self._file_cache = OrderedDict()
+        self._file_cache_lock = threading.Lock()
+
+    def _repo_url(self, workspace, repo_slug):
+        return f"{self.api_base}/repositories/{workspace}/{repo_slug}"
+
+    def _request(self, operation, method, url, retry_statuses=RETRY_STATUSES, **kwargs):
+        """Send a request on the shared session, recording its duration and status.
+
+        The request waits for the rate limiter first. Answers with a status
+        in `retry_statuses` are retried up to max_retries times, after the
+        Retry-After the server asked for or else a jittered exponential
+        backoff. A 429 pauses the limiter, so the other threads hold off
+        too. The last answer is returned as it is.
+        """
+        for attempt in range(self.max_retries + 1):
+            RATE_LIMIT_WAIT.observe(self.limiter.acquire())
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except requests.RequestException:
+                REQUESTS.inc(operation=operation, status='error')
+                raise
+            finally:
+                REQUEST_DURATION.observe(time.monotonic() - started, operation=operation)
+            status = response.status_code
+            REQUESTS.inc(operation=operation, status=status)
+            if status not in retry_statuses or attempt == self.max_retries:
+                return response
+
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None and retry_after > BITBUCKET_MAX_RETRY_WAIT:
+                logger.warning(f"Bitbucket asked to retry {operation} after {retry_after:.0f}s, not waiting that long")
+                if status == 429:
+                    self.limiter.pause(BITBUCKET_MAX_RETRY_WAIT)
+                return response
+            delay = retry_after if retry_after is not None else backoff_delay(attempt)
+            RETRIES.inc(operation=operation, status=status)
+            logger.warning(f"Bitbucket answered {status} to {operation}, retrying in {delay:.1f}s "
+                           f"({attempt + 1}/{self.max_retries})")
+            response.close()
+            if status == 429:
+                # Rate limits apply to the whole account: every thread waits, in acquire()
+                self.limiter.pause(delay)
+            else:
+                time.sleep(delay)
+
+    def get_pull_request(self, workspace, repo_slug, pr_id, max_age=PR_METADATA_TTL):
+        """Get PR metadata, reusing a copy fetched within the last `max_age` seconds"""
+        key = (workspace, repo_slug, pr_id)
+        with self._pr_cache_lock:
+            cached = self._pr_cache.get(key)
+        if cached and time.monotonic() - cached[0] < max_age:
+            CACHE_LOOKUPS.inc(cache='pr_metadata', result='hit')
+            return cached[1]
+        CACHE_LOOKUPS.inc(cache='pr_metadata', result='miss')
+
+        url = f"{self._repo_url(workspace, repo_slug)}/pullrequests/{pr_id}"
+        logger.info(f"Getting PR details from: {url}")
+        response = self._request('pull_request', 'GET', url)
+        if response.status_code != 200:
+            logger.error(f"Failed to get PR details: {response.status_code} - {response.text}")
+            return None
+
+        pr_data = response.json()
+        with self._pr_cache_lock:
+            self._pr_cache[key] = (time.monotonic(), pr_data)
+        return pr_data
+
+    def get_source_commit(self, workspace, repo_slug, pr_id):
+        """Return the PR's source commit hash, or None"""
+        pr_data = self.get_pull_request(workspace, repo_slug, pr_id)
+        if not pr_data:
+            return None
+        source_branch = pr_data.get('source', {}).get('branch', {}).get('name')
+        source_commit = pr_data.get('source', {}).get('commit', {}).get('hash')
+        if not source_branch or not source_commit:
+            logger.error("Missing source branch or commit information")
+            logger.error(f"PR data keys: {list(pr_data.keys())}")
+            logger.error(f"Source data: {json.dumps(pr_data.get('source', {}))}")
+            return None
+        return source_commit
+
+    def iter_pr_diff_lines(self, workspace, repo_slug, pr_id, source_commit=None):
+        """Stream the diff of a pull request as a DiffStream of lines, or None on failure.
+
+        The API always diffs the PR's latest commit; `source_commit` is
+        accepted for the git mirror source's signature. A review of an older
+        commit is cancelled by the newer one anyway.
+        """
+        url = f"{self._repo_url(workspace, repo_slug)}/pullrequests/{pr_id}/diff"
+        logger.info(f"Requesting diff from: {url}")
+        response = self._request('diff', 'GET', url, stream=True)
+
+        if response.status_code != 200:
+            logger.error(f"Failed to get PR diff: {response.status_code} - {response.text}")
+            response.close()
+            return None
+        return DiffStream(response)
+
+    def get_file_content(self, workspace, repo_slug, commit, file_path):
+        """Get the content of a file at a commit"""
+        key = (workspace, repo_slug, commit, file_path)
+        with self._file_cache_lock:
+            cached = self._file_cache.get(key)
+            if cached:
+                self._file_cache.move_to_end(key)
+        if cached and COMMIT_HASH_RE.match(commit):
+            CACHE_LOOKUPS.inc(cache='file_content', result='hit')
+            logger.debug(f"Using cached content for {file_path} at {commit[:12]}")
+            return cached[1]
+
+        headers = {}
+        if cached and cached[0]:
+            headers['If-None-Match'] = cached[0]
+        file_url = f"{self._repo_url(workspace, repo_slug)}/src/{commit}/{file_path}"
+        logger.info(f"Getting file content from: {file_url}")
+        response = self._request('file_content', 'GET', file_url, headers=headers)
+
+        if response.status_code == 304 and cached:
+            CACHE_LOOKUPS.inc(cache='file_content', result='revalidated')
+            logger.info(f"File {file_path} not modified, using cached content")
+            return cached[1]
+        CACHE_LOOKUPS.inc(cache='file_content', result='miss')
+        if response.status_code != 200:
+            logger.error(f"Failed to get file content: {response.status_code} - {response.text}")
+            return None
+
+        content = response.text
+        logger.info(f"Got file content, length: {len(content)} chars")
+        with self._file_cache_lock:
+            self._file_cache[key] = (response.headers.get('ETag'), content)
+            self._file_cache.move_to_end(key)
+            while len(self._file_cache) > FILE_CONTENT_CACHE_ENTRIES:
+                self._file_cache.popitem(last=False)
+        return content
+
+    def get_file_contents(self, workspace, repo_slug, commit, file_paths, concurrency=FILE_FETCH_CONCURRENCY):
+        """Fetch several files at one commit concurrently. Returns {path: content or None}."""
+        def fetch(file_path):
+            try:
+                return self.get_file_content(workspace, repo_slug, commit, file_path)
+            except Exception as e:
+                logger.error(f"Error getting file content for {file_path}: {str(e)}", exc_info=True)
+                return None
+
+        if not file_paths:
+            return {}
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(file_paths))),
+                                thread_name_prefix='bitbucket-fetch') as executor:
+            return dict(zip(file_paths, executor.map(fetch, file_paths)))
+
+    def add_pr_comment(self, workspace, repo_slug, pr_id, comment, path=None, line=None):
+        """Add a comment to a PR; with `path` and `line` it is an inline comment on that line of the new file"""
+        url = f"{self._repo_url(workspace, repo_slug)}/pullrequests/{pr_id}/comments"
+        data = {
+            "content": {
+                "raw": comment
+            }
+        }
+        if path:
+            data["inline"] = {"path": path, "to": line}
+
+        logger.info(f"Posting {'inline ' if path else ''}comment to: {url}")
+        response = self._request('inline_comment' if path else 'comment', 'POST', url, json=data,
+                                 retry_statuses=WRITE_RETRY_STATUSES)
+
+        if response.status_code in (201, 200):
+            logger.info(f"Successfully added comment to PR #{pr_id}")
+            return True
+        logger.error(f"Failed to add PR comment: {response.status_code} - {response.text}")
+        # Check auth issues
+        if response.status_code == 401:
+            logger.error("Authentication failed. Check BITBUCKET_USERNAME and BITBUCKET_APP_PASSWORD")
+        elif response.status_code == 403:
+            logger.error("Permission denied. User may not have write access to this repository")
+        elif response.status_code == 404:
+            logger.error("Resource not found. Check workspace, repo_slug and PR ID")
+        return False
@@ -0,0 +1,106 @@
+import logging
+import os
+import threading
+import time
+from services import metrics
+from services.findings import severity_rank
+
+logger = logging.getLogger(__name__)
+
+# Review comment config
+# 'summary' posts the review as one PR comment; 'inline' posts findings on their lines plus a short summary
+REVIEW_COMMENT_MODE = os.environ.get('REVIEW_COMMENT_MODE', 'summary').lower()
+INLINE_COMMENTS_ENABLED = REVIEW_COMMENT_MODE == 'inline'
+# Inline comments posted per review at most; the rest of the findings are listed in the summary
+INLINE_COMMENT_MAX = int(os.environ.get('INLINE_COMMENT_MAX', '25'))
+# Seconds between two inline comments posted by the process, across all reviews
+INLINE_COMMENT_INTERVAL = float(os.environ.get('INLINE_COMMENT_INTERVAL', '0.5'))
+
+INLINE_COMMENTS = metrics.counter('review_inline_comments_total', 'Inline review comments by result', ['result'])
+
+
+def commentable_lines(file_info):
+    """New-file lines of a file's diff that Bitbucket accepts inline comments on: added lines and hunk context"""
+    lines = set()
+    for hunk in file_info.get('hunks') or []:
+        if hunk.get('new_start') is not None:
+            lines.update(range(hunk['new_start'], hunk['new_start'] + (hunk.get('new_lines') or 0)))
+        lines.update(number for text, number in zip(hunk['lines'], hunk.get('line_numbers') or [])
+                     if number and text.startswith('+'))
+    return lines
+
+
+def group_inline_findings(findings, files):
+    """Batch findings by the diff line they are on.
+
+    Returns (groups, unanchored): groups are {'path', 'line', 'severity',
+    'findings'} dicts, one per line with findings, most severe first, and
+    unanchored are the findings without a line in the diff of `files`.
+    """
+    lines_by_path = {file_info['path']: commentable_lines(file_info) for file_info in files}
+    groups = {}
+    unanchored = []
+    for finding in findings:
+        if finding.get('line') is None or finding['line'] not in lines_by_path.get(finding['path'], ()):
+            unanchored.append(finding)
+            continue
+        group = groups.setdefault((finding['path'], finding['line']), {
+            'path': finding['path'], 'line': finding['line'], 'severity': finding['severity'], 'findings': [],
+            'risk_score': finding.get('risk_score') or 0
+        })
+        if severity_rank(finding['severity']) < severity_rank(group['severity']):
+            group['severity'] = finding['severity']
+        group['findings'].append(finding)
+    ranked = sorted(groups.values(), key=lambda group: (severity_rank(group['severity']), -group['risk_score'],
+                                                        group['path'], group['line']))
+    return ranked, unanchored
+
+
+def format_inline_comment(group):
+    findings = sorted(group['findings'], key=lambda finding: severity_rank(finding['severity']))
+    if len(findings) == 1:
+        return f"**{findings[0]['severity']}**: {findings[0]['message']}"
+    return '\n'.join(f"- **{finding['severity']}**: {finding['message']}" for finding in findings)
+
+
+class InlineCommentWriter:
+    """Posts inline review comments one at a time, paced across all reviews of the process.
+
+    Each comment takes the next free slot of a schedule spaced `interval`
+    seconds apart, so a review with many findings spreads its writes out
+    instead of draining the Bitbucket rate limit that diff and file
+    fetches of other reviews share. Findings on one line are posted as one
+    comment, and at most `max_comments` comments are posted per review.
+    """
+
+    def __init__(self, client, max_comments=INLINE_COMMENT_MAX, interval=INLINE_COMMENT_INTERVAL):
+        self.client = client
+        self.max_comments = max_comments
+        self.interval = interval
+        self._next_at = 0.0
+        self._lock = threading.Lock()
+
+    def _pace(self):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next_at)
+            self._next_at = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+    def post(self, workspace, repo_slug, pr_id, groups):
+        """Post up to max_comments groups as inline comments, in order; returns (posted, not posted) groups"""
+        posted = []
+        not_posted = list(groups[self.max_comments:])
+        for group in groups[:self.max_comments]:
+            self._pace()
+            try:
+                ok = self.client.add_pr_comment(workspace, repo_slug, pr_id, format_inline_comment(group),
+                                                path=group['path'], line=group['line'])
+            except Exception as e:
+                logger.error(f"Error posting inline comment on {group['path']}:{group['line']}: {str(e)}", exc_info=True)
+                ok = False
+            INLINE_COMMENTS.inc(result='posted' if ok else 'failed')
+            (posted if ok else not_posted).append(group)
+        logger.info(f"Posted {len(posted)}/{len(groups)} inline comments to PR #{pr_id}")
+        return posted, not_posted
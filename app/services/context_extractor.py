@@ -0,0 +1,262 @@
+import ast
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from services import metrics
+from services.prefilter import IMPORT_RE
+from services.prompt_planner import CHARS_PER_TOKEN
+
+logger = logging.getLogger(__name__)
+
+# Context extraction config
+CONTEXT_ENABLED = os.environ.get('CONTEXT_ENABLED', 'true').lower() == 'true'
+# Estimated prompt tokens of surrounding code sent with each hunk
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '250'))
+# File outlines (scopes and import lines) kept in memory, keyed by blob hash
+CONTEXT_CACHE_ENTRIES = int(os.environ.get('CONTEXT_CACHE_ENTRIES', '256'))
+
+# Share of the context budget imports may take
+IMPORT_BUDGET_RATIO = 0.25
+# Lines shown around a hunk that is not inside any function or class
+MODULE_WINDOW_LINES = 8
+# Only this many leading lines are scanned for imports by the text scanners
+IMPORT_SCAN_LINES = 200
+
+BRACE_EXTENSIONS = {'.js', '.jsx', '.ts', '.tsx', '.go', '.java', '.kt', '.c', '.cc', '.cpp', '.h', '.cs',
+                    '.rs', '.swift', '.scala', '.php', '.css', '.scss'}
+# Block headers that are control flow rather than a function, class or object
+CONTROL_RE = re.compile(r'^\s*[})]*\s*(if|else|for|foreach|while|do|switch|case|default|try|catch|finally|'
+                        r'with|using|lock|synchronized|select|loop|match|unsafe|return)\b')
+DEFINITION_RE = re.compile(r'^\s*(async\s+)?(def|class|function|module|sub|proc)\b')
+STRING_OR_COMMENT_RE = re.compile(r'"(\\.|[^"\\])*"|\'(\\.|[^\'\\])*\'|`[^`]*`|//.*$')
+
+OUTLINE_LOOKUPS = metrics.counter('context_outline_lookups_total', 'File outline cache lookups', ['result'])
+CONTEXT_TOKENS = metrics.counter('context_tokens_total', 'Estimated prompt tokens of context added to hunks')
+
+
+def blob_hash(content):
+    """Git's blob id of the content, so identical files share one outline across commits and PRs"""
+    data = content.encode('utf-8', 'replace')
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+def _indent(line):
+    return len(line) - len(line.lstrip())
+
+
+def outline_python(source):
+    """Scopes and import lines of Python source via ast; None if it doesn't parse"""
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return None
+    scopes = []
+    imports = []
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+            scopes.append((start, node.end_lineno, node.lineno))
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            imports.extend(range(node.lineno, node.end_lineno + 1))
+    return scopes, imports
+
+
+def outline_braces(lines):
+    """Scopes of brace-delimited code: every {...} block whose header is not control flow"""
+    scopes = []
+    stack = []
+    for number, line in enumerate(lines, 1):
+        code = STRING_OR_COMMENT_RE.sub('', line)
+        for char in code:
+            if char == '{':
+                header_number = number
+                if not code.split('{')[0].strip() and number > 1:
+                    # Brace on its own line: the header is the line above
+                    header_number = number - 1
+                control = bool(CONTROL_RE.match(lines[header_number - 1]))
+                stack.append((header_number, control))
+            elif char == '}' and stack:
+                start, control = stack.pop()
+                if not control and number > start:
+                    scopes.append((start, number, start))
+    return scopes
+
+
+def outline_indentation(lines):
+    """Scopes of indentation-structured code: a definition line and the more-indented lines after it"""
+    scopes = []
+    stack = []
+    last_code = 0
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        indent = _indent(line)
+        while stack and indent <= stack[-1][1]:
+            start, _ = stack.pop()
+            scopes.append((start, last_code, start))
+        if DEFINITION_RE.match(line):
+            stack.append((number, indent))
+        last_code = number
+    scopes.extend((start, last_code, start) for start, _ in stack)
+    return scopes
+
+
+def build_outline(path, content):
+    """Return (scopes, import_lines) for a file; scopes are (start, end, signature_line), 1-based and inclusive"""
+    lines = content.split('\n')
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.py':
+        outline = outline_python(content)
+        if outline is not None:
+            return outline
+    if ext in BRACE_EXTENSIONS:
+        scopes = outline_braces(lines)
+    else:
+        scopes = outline_indentation(lines)
+    imports = [number for number, line in enumerate(lines[:IMPORT_SCAN_LINES], 1) if IMPORT_RE.match(line)]
+    return scopes, imports
+
+
+class ContextExtractor:
+    """Extracts the enclosing function or class and the imports of a hunk from the file content.
+
+    File outlines are computed once per blob hash and kept in a small LRU,
+    so hunks of the same file, and the same file in later reviews, reuse
+    them. Context is cut to a token budget per hunk, keeping the scope's
+    signature and the lines nearest to the change.
+    """
+
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, cache_entries=CONTEXT_CACHE_ENTRIES):
+        self.token_budget = token_budget
+        self.cache_entries = cache_entries
+        self._outlines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def outline(self, path, content):
+        key = (os.path.splitext(path)[1].lower(), blob_hash(content))
+        with self._lock:
+            if key in self._outlines:
+                self._outlines.move_to_end(key)
+                OUTLINE_LOOKUPS.inc(result='hit')
+                return self._outlines[key]
+        OUTLINE_LOOKUPS.inc(result='miss')
+        outline = build_outline(path, content)
+        with self._lock:
+            self._outlines[key] = outline
+            self._outlines.move_to_end(key)
+            while len(self._outlines) > self.cache_entries:
+                self._outlines.popitem(last=False)
+        return outline
+
+    def extract(self, path, content, hunk, lines=None):
+        """Return (imports text, scope text, (start, end) of the enclosing scope or None) for a hunk"""
+        if hunk.get('new_start') is None:
+            return '', '', None
+        lines = lines if lines is not None else content.split('\n')
+        scopes, imports = self.outline(path, content)
+        first = max(hunk['new_start'], 1)
+        last = max(first, hunk['new_start'] + (hunk.get('new_lines') or 1) - 1)
+
+        # Innermost scope containing the whole hunk, else the one containing its start
+        containing = [scope for scope in scopes if scope[0] <= first and scope[1] >= last]
+        if not containing:
+            containing = [scope for scope in scopes if scope[0] <= first <= scope[1]]
+        if containing:
+            start, end, signature = max(containing, key=lambda scope: scope[0])
+            scope = (start, end)
+        else:
+            scope = None
+            start, end = max(1, first - MODULE_WINDOW_LINES), min(len(lines), last + MODULE_WINDOW_LINES)
+            signature = None
+
+        budget = self.token_budget * CHARS_PER_TOKEN
+        import_numbers = [number for number in imports if number < start]
+        import_text = self._fit(lines, import_numbers, int(budget * IMPORT_BUDGET_RATIO))
+        budget -= len(import_text)
+
+        # The hunk's own lines are in the diff already; show the scope around them
+        around = [number for number in range(start, end + 1) if not first <= number <= last]
+        pinned = list(range(start, signature + 1)) if signature else []
+        nearest = sorted(around, key=lambda number: (number not in pinned, min(abs(number - first), abs(number - last))))
+        chosen = []
+        used = 0
+        for number in nearest:
+            cost = len(lines[number - 1]) + 7 if number <= len(lines) else 0
+            if used + cost > budget:
+                if number in pinned:
+                    continue
+                break
+            chosen.append(number)
+            used += cost
+        return import_text.strip('\n'), self._render(lines, sorted(chosen), changed=(first, last)).strip('\n'), scope
+
+    def _fit(self, lines, numbers, budget):
+        chosen = []
+        used = 0
+        for number in numbers:
+            cost = len(lines[number - 1]) + 7
+            if used + cost > budget:
+                break
+            chosen.append(number)
+            used += cost
+        return self._render(lines, chosen)
+
+    def _render(self, lines, numbers, changed=None):
+        output = []
+        previous = None
+        marked = False
+        for number in numbers:
+            if changed and not marked and number > changed[1]:
+                output.append("      ... (changed lines) ...")
+                marked = True
+            elif previous is not None and number > previous + 1:
+                output.append("      ...")
+            output.append(f"{number:>5} {lines[number - 1]}")
+            previous = number
+        if changed and not marked and numbers:
+            output.append("      ... (changed lines) ...")
+        return '\n'.join(output)
+
+    def add_hunk_context(self, files):
+        """Set hunk['context'] for the hunks of files with content; returns the estimated context tokens added.
+
+        Each hunk's context stands on its own, since the hunks of a file may
+        be cached or planned into different prompts. The parts are kept too
+        ('context_imports', 'context_scope_text' and the 'context_scope'
+        line range), so a prompt can show a file's imports and each scope
+        only once.
+        """
+        total = 0
+        for file_info in files:
+            content = file_info.get('content')
+            if not content:
+                continue
+            lines = content.split('\n')
+            for hunk in file_info.get('hunks') or []:
+                import_text, scope_text, scope = self.extract(file_info['path'], content, hunk, lines)
+                if not import_text and not scope_text:
+                    continue
+                hunk['context'] = import_text + ('\n...\n' if import_text and scope_text else '') + scope_text
+                hunk['context_imports'] = import_text
+                hunk['context_scope_text'] = scope_text
+                hunk['context_scope'] = scope
+                total += len(hunk['context']) // CHARS_PER_TOKEN
+        CONTEXT_TOKENS.inc(total)
+        return total
+
+
+_extractor = None
+_extractor_lock = threading.Lock()
+
+
+def get_context_extractor():
+    """Return the process-wide context extractor"""
+    global _extractor
+    with _extractor_lock:
+        if _extractor is None:
+            _extractor = ContextExtractor()
+        return _extractor
@@ -0,0 +1,178 @@
+import io
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Diff parsing config
+MAX_FILE_DIFF_SIZE = int(os.environ.get('MAX_FILE_DIFF_SIZE', '20000'))
+MAX_DIFF_TOTAL_SIZE = int(os.environ.get('MAX_DIFF_TOTAL_SIZE', str(64 * 1024 * 1024)))
+
+HUNK_HEADER_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@ ?(.*)$')
+
+
+def iter_lines(diff):
+    """Iterate over the lines of a diff given as a string or an iterable of lines"""
+    if isinstance(diff, (str, bytes)):
+        diff = io.StringIO(diff.decode('utf-8', 'replace') if isinstance(diff, bytes) else diff)
+    for line in diff:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        yield line.rstrip('\r\n')
+
+
+def _strip_prefix(path):
+    if path.startswith(('a/', 'b/')):
+        return path[2:]
+    return path
+
+
+def _new_file(header):
+    # "diff --git a/old b/new"; paths with spaces are corrected by the ---/+++ and rename lines
+    parts = header.split(' ')
+    old_path = _strip_prefix(parts[2]) if len(parts) >= 4 else None
+    new_path = _strip_prefix(parts[3]) if len(parts) >= 4 else None
+    return {
+        'path': new_path,
+        'old_path': old_path,
+        'is_new': False,
+        'is_deleted': False,
+        'is_rename': False,
+        'is_binary': False,
+        'truncated': False,
+        'added': 0,
+        'removed': 0,
+        'size': 0,
+        'hunks': []
+    }
+
+
+def _parse_hunk_header(line):
+    match = HUNK_HEADER_RE.match(line)
+    if not match:
+        return {'header': line, 'old_start': None, 'old_lines': None, 'new_start': None,
+                'new_lines': None, 'section': '', 'lines': [], 'line_numbers': [], 'added': 0, 'removed': 0}
+    old_start, old_lines, new_start, new_lines, section = match.groups()
+    return {
+        'header': line,
+        'old_start': int(old_start),
+        'old_lines': int(old_lines) if old_lines is not None else 1,
+        'new_start': int(new_start),
+        'new_lines': int(new_lines) if new_lines is not None else 1,
+        'section': section.strip(),
+        'lines': [],
+        'line_numbers': [],
+        'added': 0,
+        'removed': 0
+    }
+
+
+def _finish_file(file_info, changes):
+    file_info['changes'] = '\n'.join(changes)
+    if file_info['path'] is None:
+        file_info['path'] = file_info['old_path']
+    return file_info
+
+
+def iter_diff_files(diff, max_file_size=MAX_FILE_DIFF_SIZE, max_total_size=MAX_DIFF_TOTAL_SIZE):
+    """Parse a unified git diff lazily, yielding one dict per changed file.
+
+    `diff` may be a string or any iterable of lines, such as a streamed
+    HTTP response body, so only the file being parsed is held in memory.
+    Each file carries its hunks with old/new line ranges, added/removed
+    line counts and new/deleted/rename/binary flags. `line_numbers` holds
+    the line number of each changed line: in the new file for additions,
+    in the old file for deletions. Changed lines beyond
+    `max_file_size` characters are dropped (counts stay exact) and the file
+    is marked truncated. Parsing stops after `max_total_size` characters.
+    """
+    file_info = None
+    changes = []
+    hunk = None
+    old_line = new_line = 0
+    total = 0
+    in_header = False
+
+    for line in iter_lines(diff):
+        total += len(line) + 1
+        if total > max_total_size:
+            logger.warning(f"Diff exceeds {max_total_size} chars, ignoring the remaining files")
+            break
+
+        if line.startswith('diff --git '):
+            if file_info is not None:
+                yield _finish_file(file_info, changes)
+            file_info = _new_file(line)
+            changes = []
+            hunk = None
+            in_header = True
+            continue
+
+        if file_info is None:
+            continue
+
+        if line.startswith('@@'):
+            hunk = _parse_hunk_header(line)
+            file_info['hunks'].append(hunk)
+            old_line = hunk['old_start'] or 0
+            new_line = hunk['new_start'] or 0
+            in_header = False
+            continue
+
+        if in_header:
+            if line.startswith('--- '):
+                if line[4:] != '/dev/null':
+                    file_info['old_path'] = _strip_prefix(line[4:])
+            elif line.startswith('+++ '):
+                if line[4:] == '/dev/null':
+                    file_info['is_deleted'] = True
+                else:
+                    file_info['path'] = _strip_prefix(line[4:])
+            elif line.startswith('new file mode'):
+                file_info['is_new'] = True
+            elif line.startswith('deleted file mode'):
+                file_info['is_deleted'] = True
+            elif line.startswith('rename from '):
+                file_info['is_rename'] = True
+                file_info['old_path'] = line[len('rename from '):]
+            elif line.startswith('rename to '):
+                file_info['is_rename'] = True
+                file_info['path'] = line[len('rename to '):]
+            elif line.startswith('Binary files ') or line == 'GIT binary patch':
+                file_info['is_binary'] = True
+            continue
+
+        if hunk is None or line.startswith('\\'):
+            continue
+        if not line or line[0] not in '+-':
+            # Context line: only advances the line numbers
+            old_line += 1
+            new_line += 1
+            continue
+
+        # Only collect actual changes (additions/deletions)
+        if line[0] == '+':
+            file_info['added'] += 1
+            hunk['added'] += 1
+            line_number = new_line
+            new_line += 1
+        else:
+            file_info['removed'] += 1
+            hunk['removed'] += 1
+            line_number = old_line
+            old_line += 1
+
+        if file_info['truncated']:
+            continue
+        if file_info['size'] + len(line) + 1 > max_file_size:
+            file_info['truncated'] = True
+            logger.info(f"Diff of {file_info['path']} exceeds {max_file_size} chars, truncating")
+            continue
+        file_info['size'] += len(line) + (1 if changes else 0)
+        changes.append(line)
+        hunk['lines'].append(line)
+        hunk['line_numbers'].append(line_number)
+
+    if file_info is not None:
+        yield _finish_file(file_info, changes)
@@ -0,0 +1,205 @@
+import json
+import logging
+import math
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# File scoring config
+RISK_WEIGHTS_FILE = os.environ.get('RISK_WEIGHTS_FILE', '')
+REVIEW_TOKEN_BUDGET = int(os.environ.get('REVIEW_TOKEN_BUDGET', '32000'))
+
+CHARS_PER_TOKEN = 4
+# Only this many added lines are checked for "generated" header markers
+GENERATED_MARKER_SCAN_LINES = 5
+
+DEFAULT_WEIGHTS = {
+    'extensions': {
+        '.py': 1.0, '.js': 1.0, '.jsx': 1.0, '.ts': 1.0, '.tsx': 1.0, '.go': 1.0, '.java': 1.0,
+        '.kt': 1.0, '.rb': 1.0, '.php': 1.0, '.cs': 1.0, '.c': 1.0, '.cc': 1.0, '.cpp': 1.0,
+        '.h': 0.9, '.rs': 1.0, '.swift': 1.0, '.scala': 1.0, '.sql': 1.0, '.sh': 0.9,
+        '.html': 0.5, '.css': 0.4, '.scss': 0.4, '.xml': 0.4, '.toml': 0.5, '.ini': 0.5, '.cfg': 0.5
+    },
+    'default_extension': 0.7,
+    # Multiplier added for paths that touch authentication, secrets, payments, ...
+    'security': 1.5,
+    'security_patterns': [
+        r'auth', r'login', r'passw', r'secret', r'token', r'crypt', r'session', r'permission',
+        r'acl', r'oauth', r'jwt', r'payment', r'billing', r'sql', r'migration', r'\.env',
+        r'dockerfile', r'security', r'sanitiz', r'csrf', r'cors'
+    ],
+    # Factor applied to generated, minified or vendored files
+    'generated': 0.05,
+    'generated_patterns': [
+        r'(^|/)(dist|build|vendor|node_modules|third_party|generated|gen)/', r'\.min\.(js|css)$',
+        r'_pb2(_grpc)?\.py$', r'\.pb\.go$', r'\.generated\.', r'\.g\.dart$', r'(^|/)package-lock\.json$',
+        r'\.snap$', r'\.map$'
+    ],
+    'generated_markers': ['@generated', 'DO NOT EDIT', 'auto-generated', 'autogenerated'],
+    # Average changed-line length above which a file is treated as minified
+    'minified_line_length': 300,
+    # Factor applied to test fixtures and snapshots
+    'fixture': 0.3,
+    'fixture_patterns': [r'(^|/)(fixtures?|testdata|__snapshots__|__fixtures__|mocks?)/'],
+    # Weight of the churn ratio: files that modify lines rank above pure additions/deletions
+    'churn': 0.5,
+    # Path globs (fnmatch, "*" also matches "/") of files never reviewed; see services/prefilter.py
+    'ignore_globs': []
+}
+
+
+def _compile(patterns):
+    return re.compile('|'.join(f"(?:{pattern})" for pattern in patterns), re.IGNORECASE) if patterns else None
+
+
+def merge_weights(base, overrides):
+    """Apply weight overrides: tables such as `extensions` are merged key by key, lists and numbers are replaced"""
+    merged = dict(base)
+    for key, value in (overrides or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = dict(merged[key], **value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class RiskWeights:
+    """Scoring weights with their path patterns compiled once"""
+
+    def __init__(self, overrides=None):
+        values = merge_weights(DEFAULT_WEIGHTS, overrides)
+        self.values = values
+        self.extensions = values['extensions']
+        self.security_re = _compile(values['security_patterns'])
+        self.generated_re = _compile(values['generated_patterns'])
+        self.fixture_re = _compile(values['fixture_patterns'])
+        self.generated_markers = values['generated_markers']
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+
+def extension_factor(file_info, weights):
+    ext = os.path.splitext(file_info['path'])[1].lower()
+    return weights.extensions.get(ext, weights['default_extension'])
+
+
+def size_factor(file_info, weights):
+    # Bigger changes carry more risk, but only logarithmically so one huge file can't dominate
+    return math.log2(2 + file_info.get('added', 0) + file_info.get('removed', 0))
+
+
+def churn_factor(file_info, weights):
+    added = file_info.get('added', 0)
+    removed = file_info.get('removed', 0)
+    if not added + removed:
+        return 1.0
+    return 1.0 + weights['churn'] * 2 * min(added, removed) / (added + removed)
+
+
+def security_factor(file_info, weights):
+    if weights.security_re and weights.security_re.search(file_info['path']):
+        return 1.0 + weights['security']
+    return 1.0
+
+
+def is_generated(file_info, weights):
+    """Cheap generated/minified/vendored check from the path, line length and header markers"""
+    if weights.generated_re and weights.generated_re.search(file_info['path']):
+        return True
+    changed_lines = file_info.get('added', 0) + file_info.get('removed', 0)
+    if changed_lines and file_info.get('size', 0) / changed_lines > weights['minified_line_length']:
+        return True
+    hunks = file_info.get('hunks') or []
+    if hunks and hunks[0].get('new_start') == 1:
+        for line in hunks[0]['lines'][:GENERATED_MARKER_SCAN_LINES]:
+            if any(marker in line for marker in weights.generated_markers):
+                return True
+    return False
+
+
+def generated_factor(file_info, weights):
+    return weights['generated'] if is_generated(file_info, weights) else 1.0
+
+
+def fixture_factor(file_info, weights):
+    if weights.fixture_re and weights.fixture_re.search(file_info['path']):
+        return weights['fixture']
+    return 1.0
+
+
+# Each scorer returns a multiplicative factor; register_scorer adds more
+SCORERS = [extension_factor, size_factor, churn_factor, security_factor, generated_factor, fixture_factor]
+
+
+def register_scorer(scorer):
+    """Add a scorer: a function (file_info, weights) -> multiplicative factor"""
+    SCORERS.append(scorer)
+    return scorer
+
+
+def score_file(file_info, weights):
+    score = 1.0
+    for scorer in SCORERS:
+        score *= scorer(file_info, weights)
+    return score
+
+
+def estimate_file_tokens(file_info):
+    return math.ceil(file_info.get('size', 0) / CHARS_PER_TOKEN)
+
+
+_repo_weights = {}
+_weights_config = None
+
+
+def _load_weights_config():
+    """Read per-repo weight overrides: {"default": {...}, "workspace/repo": {...}}"""
+    global _weights_config
+    if _weights_config is None:
+        _weights_config = {}
+        if RISK_WEIGHTS_FILE:
+            try:
+                with open(RISK_WEIGHTS_FILE) as f:
+                    _weights_config = json.load(f)
+                logger.info(f"Loaded risk weights for {len(_weights_config)} entries from {RISK_WEIGHTS_FILE}")
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not load risk weights from {RISK_WEIGHTS_FILE}: {str(e)}")
+    return _weights_config
+
+
+def get_weights(repo_full_name=None):
+    """Return the scoring weights for a repository, falling back to the defaults"""
+    if repo_full_name not in _repo_weights:
+        config = _load_weights_config()
+        overrides = merge_weights(config.get('default', {}), config.get(repo_full_name or '', {}))
+        _repo_weights[repo_full_name] = RiskWeights(overrides)
+    return _repo_weights[repo_full_name]
+
+
+def select_by_risk(changed_files, repo_full_name=None, token_budget=REVIEW_TOKEN_BUDGET, max_files=None):
+    """Pick the riskiest files whose estimated prompt tokens fit in the budget.
+
+    Files are ranked by score and taken greedily; a file that doesn't fit
+    is skipped in favour of smaller ones further down. The top-ranked file
+    is always taken, even when it alone exceeds the budget.
+    """
+    weights = get_weights(repo_full_name)
+    scored = []
+    for file_info in changed_files:
+        file_info['risk_score'] = round(score_file(file_info, weights), 3)
+        scored.append(file_info)
+    scored.sort(key=lambda file_info: file_info['risk_score'], reverse=True)
+
+    selected = []
+    used_tokens = 0
+    for file_info in scored:
+        if max_files and len(selected) >= max_files:
+            break
+        tokens = estimate_file_tokens(file_info)
+        if selected and used_tokens + tokens > token_budget:
+            continue
+        selected.append(file_info)
+        used_tokens += tokens
+    return selected, used_tokens
@@ -0,0 +1,181 @@
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Severities from most to least severe
+SEVERITIES = ['critical', 'high', 'medium', 'low']
+DEFAULT_SEVERITY = 'low'
+NO_ISSUES_RE = re.compile(r'^no (issues|problems)\b', re.IGNORECASE)
+
+# Ollama `format` schema of structured reviews; has_issues comes first so a clean batch is answered in a few tokens
+FINDINGS_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'has_issues': {'type': 'boolean'},
+        'findings': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'hunk': {'type': 'integer'},
+                    'severity': {'type': 'string', 'enum': SEVERITIES},
+                    'line': {'type': 'integer'},
+                    'message': {'type': 'string'}
+                },
+                'required': ['hunk', 'severity', 'line', 'message']
+            }
+        }
+    },
+    'required': ['has_issues', 'findings']
+}
+# A clean batch's answer; everything after it can be cut off without losing findings
+NO_ISSUES_JSON_RE = re.compile(r'"has_issues"\s*:\s*false')
+# A flat JSON object, for salvaging complete findings from output cut off by the token limit
+JSON_OBJECT_RE = re.compile(r'\{[^{}]*\}')
+
+# "[HUNK 2] high L42: message", tolerating list markers, brackets and a missing severity or line
+FINDING_RE = re.compile(
+    r'^[\s*>-]*\[HUNK (\d+)\][\s:.*]*'
+    r'(?:[\[(*]*(critical|high|medium|low)\b[\])*]*)?[\s:|*-]*'
+    r'(?:(?:L|line\s*)(\d+))?[\s:|*-]*'
+    r'(.*)$',
+    re.IGNORECASE
+)
+
+
+def parse_findings(text, hunk_count):
+    """Parse compact one-line findings out of a model response.
+
+    Returns (findings, complete): findings[i] lists the findings of hunk
+    i + 1 as {'severity', 'line', 'message'} dicts (line may be None), and
+    complete says whether every hunk was answered, with findings or an
+    explicit "NO ISSUES", so the result can be cached. Lines that don't
+    match the format are ignored.
+    """
+    findings = [[] for _ in range(hunk_count)]
+    answered = set()
+    for raw_line in (text or '').splitlines():
+        match = FINDING_RE.match(raw_line)
+        if not match:
+            continue
+        index = int(match.group(1)) - 1
+        if not 0 <= index < hunk_count:
+            continue
+        severity, line, message = match.group(2), match.group(3), match.group(4).strip()
+        answered.add(index)
+        if not message or NO_ISSUES_RE.match(message):
+            continue
+        findings[index].append({
+            'severity': severity.lower() if severity else DEFAULT_SEVERITY,
+            'line': int(line) if line else None,
+            'message': message
+        })
+    return findings, len(answered) == hunk_count
+
+
+def parse_json_findings(text, hunk_count):
+    """Parse a structured (FINDINGS_SCHEMA) model response; returns (findings, complete) like parse_findings.
+
+    Hunks without findings in a valid response count as answered, and so
+    does every hunk once the response starts with has_issues false. When
+    the JSON is cut off otherwise, the complete finding objects in it are
+    kept and the result is marked incomplete so it is not cached.
+    """
+    findings = [[] for _ in range(hunk_count)]
+    text = (text or '').strip()
+    if text.startswith('```'):
+        text = text.strip('`').partition('\n')[2]
+    try:
+        data = json.loads(text)
+        items = data.get('findings') if isinstance(data, dict) else data
+        complete = isinstance(items, list)
+    except ValueError:
+        items = []
+        for match in JSON_OBJECT_RE.finditer(text):
+            try:
+                items.append(json.loads(match.group(0)))
+            except ValueError:
+                continue
+        complete = bool(NO_ISSUES_JSON_RE.search(text))
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        hunk, line, message = item.get('hunk'), item.get('line'), item.get('message')
+        if not isinstance(hunk, int) or not 0 < hunk <= hunk_count or not isinstance(message, str) or not message.strip():
+            continue
+        severity = str(item.get('severity', '')).lower()
+        findings[hunk - 1].append({
+            'severity': severity if severity in SEVERITIES else DEFAULT_SEVERITY,
+            'line': line if isinstance(line, int) and line > 0 else None,
+            'message': message.strip()
+        })
+    return findings, complete
+
+
+def normalize_message(message):
+    """Lowercase and strip punctuation and line references so rewordings of one finding compare equal"""
+    message = re.sub(r'\b(on |at )?lines? \d+\b', '', message.lower())
+    return ' '.join(re.sub(r'[^a-z0-9_ ]+', ' ', message).split())
+
+
+def severity_rank(severity):
+    return SEVERITIES.index(severity) if severity in SEVERITIES else len(SEVERITIES)
+
+
+def reduce_findings(findings):
+    """Deduplicate, merge and rank findings from the map step.
+
+    `findings` are dicts with path, line, severity, message and the file's
+    risk_score. Findings with the same normalized message are merged into
+    one entry listing all their locations, at the highest severity any of
+    them had. Entries are ranked by severity, then file risk, then number
+    of locations.
+    """
+    merged = {}
+    for finding in findings:
+        key = normalize_message(finding['message'])
+        if not key:
+            continue
+        entry = merged.get(key)
+        if entry is None:
+            entry = merged[key] = {
+                'severity': finding['severity'],
+                'message': finding['message'],
+                'locations': [],
+                'risk_score': finding.get('risk_score') or 0
+            }
+        elif severity_rank(finding['severity']) < severity_rank(entry['severity']):
+            entry['severity'] = finding['severity']
+        entry['risk_score'] = max(entry['risk_score'], finding.get('risk_score') or 0)
+        location = {'path': finding['path'], 'line': finding['line']}
+        if location not in entry['locations']:
+            entry['locations'].append(location)
+
+    ranked = sorted(merged.values(), key=lambda entry: (severity_rank(entry['severity']), -entry['risk_score'],
+                                                        -len(entry['locations'])))
+    logger.info(f"Reduced {len(findings)} findings to {len(ranked)}")
+    return ranked
+
+
+def join_within_limit(header, items, footer, max_length, omitted_note):
+    """Join header, as many items as fit and footer into at most max_length characters.
+
+    Items are kept in order; when some don't fit, omitted_note(count) is
+    added in their place. The header is cut as a last resort.
+    """
+    body = []
+    length = len(header) + len(footer)
+    for i, item in enumerate(items):
+        note = omitted_note(len(items) - i - 1) if i + 1 < len(items) else ''
+        if length + len(item) + len(note) > max_length:
+            body.append(omitted_note(len(items) - i))
+            break
+        body.append(item)
+        length += len(item)
+    text = header + ''.join(body) + footer
+    if len(text) > max_length:
+        logger.warning(f"Comment header alone exceeds {max_length} chars, truncating")
+        text = text[:max_length]
+    return text
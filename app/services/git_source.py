@@ -0,0 +1,337 @@
+import fcntl
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+from services import metrics
+from services.bitbucket_client import FILE_FETCH_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# Git mirror config
+GIT_MIRROR_DIR = os.environ.get('GIT_MIRROR_DIR', '/tmp/ai-pr-reviewer/git-mirrors')
+# Clone URL of a repository; file:///... templates work for local testing
+GIT_MIRROR_URL = os.environ.get('GIT_MIRROR_URL', 'https://bitbucket.org/{workspace}/{repo_slug}.git')
+GIT_MIRROR_MAX_BYTES = int(os.environ.get('GIT_MIRROR_MAX_BYTES', str(10 * 1024 * 1024 * 1024)))
+GIT_FETCH_TIMEOUT = float(os.environ.get('GIT_FETCH_TIMEOUT', '600'))
+
+# Marker file whose mtime records when a mirror was last used, for LRU eviction
+LAST_USED_FILE = 'ai-pr-reviewer-last-used'
+
+MIRROR_FETCHES = metrics.counter('git_mirror_fetches_total', 'Clones and fetches of repository mirrors', ['kind'])
+MIRROR_FALLBACKS = metrics.counter('git_mirror_fallbacks_total',
+                                   'Reads served by the Bitbucket API because the mirror could not', ['operation'])
+MIRROR_EVICTIONS = metrics.counter('git_mirror_evictions_total', 'Repository mirrors evicted for disk space')
+
+
+class GitError(Exception):
+    """Raised when a git command fails"""
+
+
+class GitDiffStream:
+    """Iterates over the lines of `git diff` output as the process writes it.
+
+    Lines are split on '\n' only, like DiffStream, and the stream can be
+    read once. close() stops the process if the diff was not read to the
+    end, releases the mirror's read lock, and raises GitError if git
+    failed, since the output read so far may be incomplete.
+    """
+
+    def __init__(self, process, read_lock=None):
+        self.process = process
+        self.read_lock = read_lock
+        self.chars_read = 0
+        self.started = False
+
+    def __iter__(self):
+        if self.started:
+            raise GitError("The diff stream was already read")
+        self.started = True
+        for raw_line in self.process.stdout:
+            line = raw_line.decode('utf-8', errors='replace')
+            self.chars_read += len(line)
+            yield line[:-1] if line.endswith('\n') else line
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        if self.read_lock:
+            self.read_lock.close()
+            self.read_lock = None
+        if returncode > 0:
+            raise GitError(f"git diff exited with code {returncode} after {self.chars_read} chars")
+        logger.info(f"Read local diff, {self.chars_read} chars")
+
+
+class GitMirrorSource:
+    """Reads PR diffs and file contents from local bare mirrors of the repositories.
+
+    Drop-in replacement for the BitbucketClient read calls used by the
+    review pipeline. PR metadata still comes from the API (one cached
+    call); the mirror is fetched only when a PR's commits are missing, and
+    the diff and blobs are then computed locally. Mirrors are evicted in
+    least-recently-used order once they exceed GIT_MIRROR_MAX_BYTES; reads
+    hold a shared lock on the mirror, so one being read is not evicted. Any
+    failure falls back to the API client.
+    """
+
+    def __init__(self, api, mirror_dir=GIT_MIRROR_DIR, url_template=GIT_MIRROR_URL,
+                 max_bytes=GIT_MIRROR_MAX_BYTES, auth_token=None):
+        self.api = api
+        self.mirror_dir = mirror_dir
+        self.url_template = url_template
+        self.max_bytes = max_bytes
+        self.auth_token = auth_token
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        os.makedirs(self.mirror_dir, exist_ok=True)
+
+    def _mirror_path(self, workspace, repo_slug):
+        return os.path.join(self.mirror_dir, workspace, f"{repo_slug}.git")
+
+    def _git_env(self):
+        env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+        if self.auth_token:
+            # Credentials go in the environment, not on the command line where `ps` shows them,
+            # and per command so they are never written to the mirror's config
+            index = int(env.get('GIT_CONFIG_COUNT') or 0)
+            env.update({'GIT_CONFIG_COUNT': str(index + 1), f"GIT_CONFIG_KEY_{index}": 'http.extraHeader',
+                        f"GIT_CONFIG_VALUE_{index}": f"Authorization: Basic {self.auth_token}"})
+        return env
+
+    def _git(self, args, git_dir=None, timeout=GIT_FETCH_TIMEOUT, input=None):
+        command = ['git']
+        if git_dir:
+            command += ['--git-dir', git_dir]
+        result = subprocess.run(command + args, input=input, capture_output=True, timeout=timeout,
+                                env=self._git_env())
+        if result.returncode != 0:
+            raise GitError(f"git {args[0]} failed: {result.stderr.decode('utf-8', errors='replace').strip()}")
+        return result.stdout
+
+    def _lock(self, path):
+        """Thread lock plus a file lock, so processes on one node don't fetch the same mirror at once"""
+        with self._locks_lock:
+            lock = self._locks.setdefault(path, threading.Lock())
+        return _MirrorLock(lock, f"{path}.lock")
+
+    def _read_lock(self, git_dir):
+        """Shared lock held while a mirror is read; evict() needs it exclusively. Close the file to release it."""
+        os.makedirs(os.path.dirname(git_dir), exist_ok=True)
+        return _open_flock(f"{git_dir}.read.lock", fcntl.LOCK_SH)
+
+    def _has_commits(self, git_dir, commits):
+        request = ''.join(f"{commit}^{{commit}}\n" for commit in commits).encode('utf-8')
+        try:
+            output = self._git(['cat-file', '--batch-check'], git_dir, input=request)
+        except GitError:
+            return False
+        # Each line is "<sha> commit <size>", or "<name> missing" / "<name> ambiguous"
+        return all(line.split(b' ')[1:2] == [b'commit'] for line in output.splitlines())
+
+    def ensure_commits(self, workspace, repo_slug, commits):
+        """Clone or fetch the repository's mirror until it contains all commits; returns its path"""
+        git_dir = self._mirror_path(workspace, repo_slug)
+        os.makedirs(os.path.dirname(git_dir), exist_ok=True)
+        with self._lock(git_dir):
+            if os.path.isdir(git_dir) and self._has_commits(git_dir, commits):
+                self._touch(git_dir)
+                return git_dir
+            url = self.url_template.format(workspace=workspace, repo_slug=repo_slug)
+            started = time.monotonic()
+            if not os.path.isdir(git_dir):
+                self._git(['clone', '--mirror', '--quiet', url, git_dir])
+                MIRROR_FETCHES.inc(kind='clone')
+                logger.info(f"Cloned mirror of {workspace}/{repo_slug} in {time.monotonic() - started:.1f}s")
+            else:
+                self._git(['fetch', '--prune', '--quiet', 'origin'], git_dir)
+                MIRROR_FETCHES.inc(kind='fetch')
+                logger.info(f"Fetched mirror of {workspace}/{repo_slug} in {time.monotonic() - started:.1f}s")
+            self._touch(git_dir)
+            if not self._has_commits(git_dir, commits):
+                raise GitError(f"Commits {commits} not found in {workspace}/{repo_slug} after fetching")
+        self.evict()
+        return git_dir
+
+    def _touch(self, git_dir):
+        with open(os.path.join(git_dir, LAST_USED_FILE), 'a'):
+            pass
+        os.utime(os.path.join(git_dir, LAST_USED_FILE), None)
+
+    def get_pull_request(self, workspace, repo_slug, pr_id):
+        return self.api.get_pull_request(workspace, repo_slug, pr_id)
+
+    def get_source_commit(self, workspace, repo_slug, pr_id):
+        return self.api.get_source_commit(workspace, repo_slug, pr_id)
+
+    def iter_pr_diff_lines(self, workspace, repo_slug, pr_id, source_commit=None):
+        """Stream the PR diff computed locally (destination...source), or via the API on failure.
+
+        With `source_commit` (the commit the review job was queued for) the
+        diff is of that commit; PR metadata cached before it was pushed is
+        fetched again for the destination.
+        """
+        read_lock = None
+        try:
+            pr_data = self.api.get_pull_request(workspace, repo_slug, pr_id)
+            source = (pr_data or {}).get('source', {}).get('commit', {}).get('hash')
+            if source_commit and source != source_commit:
+                pr_data = self.api.get_pull_request(workspace, repo_slug, pr_id, max_age=0)
+                source = source_commit
+            destination = (pr_data or {}).get('destination', {}).get('commit', {}).get('hash')
+            if not source or not destination:
+                raise GitError("PR metadata has no source or destination commit")
+            read_lock = self._read_lock(self._mirror_path(workspace, repo_slug))
+            git_dir = self.ensure_commits(workspace, repo_slug, [source, destination])
+            command = ['git', '--git-dir', git_dir, 'diff', '--no-color', '--no-ext-diff', '-M',
+                       f"{destination}...{source}"]
+            logger.info(f"Computing diff of PR #{pr_id} locally: {destination[:12]}...{source[:12]}")
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            return GitDiffStream(process, read_lock)
+        except (GitError, OSError, subprocess.SubprocessError) as e:
+            if read_lock:
+                read_lock.close()
+            logger.warning(f"Local diff of {workspace}/{repo_slug} PR #{pr_id} failed, using the API: {str(e)}")
+            MIRROR_FALLBACKS.inc(operation='diff')
+            return self.api.iter_pr_diff_lines(workspace, repo_slug, pr_id, source_commit)
+
+    def get_file_content(self, workspace, repo_slug, commit, file_path):
+        return self.get_file_contents(workspace, repo_slug, commit, [file_path]).get(file_path)
+
+    def get_file_contents(self, workspace, repo_slug, commit, file_paths, concurrency=FILE_FETCH_CONCURRENCY):
+        """Read several files at one commit with a single `git cat-file --batch`. Returns {path: content or None}."""
+        if not file_paths:
+            return {}
+        try:
+            with self._read_lock(self._mirror_path(workspace, repo_slug)):
+                git_dir = self.ensure_commits(workspace, repo_slug, [commit])
+                request = ''.join(f"{commit}:{path}\n" for path in file_paths).encode('utf-8')
+                output = self._git(['cat-file', '--batch'], git_dir, input=request)
+        except (GitError, OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"Local read of {len(file_paths)} files from {workspace}/{repo_slug} failed, "
+                           f"using the API: {str(e)}")
+            MIRROR_FALLBACKS.inc(operation='file_content')
+            return self.api.get_file_contents(workspace, repo_slug, commit, file_paths, concurrency)
+
+        contents = {}
+        offset = 0
+        for path in file_paths:
+            header_end = output.index(b'\n', offset)
+            header = output[offset:header_end].decode('utf-8', errors='replace').split(' ')
+            offset = header_end + 1
+            if len(header) != 3 or header[1] != 'blob':
+                # "<object> missing", or a tree/submodule at that path
+                logger.warning(f"No file {path} at {commit[:12]} in {workspace}/{repo_slug}")
+                contents[path] = None
+                continue
+            size = int(header[2])
+            contents[path] = output[offset:offset + size].decode('utf-8', errors='replace')
+            offset += size + 1
+        return contents
+
+    def evict(self):
+        """Delete least recently used mirrors until all mirrors fit in max_bytes"""
+        mirrors = []
+        total = 0
+        for workspace in os.listdir(self.mirror_dir):
+            workspace_dir = os.path.join(self.mirror_dir, workspace)
+            if not os.path.isdir(workspace_dir):
+                continue
+            for name in os.listdir(workspace_dir):
+                git_dir = os.path.join(workspace_dir, name)
+                if not name.endswith('.git') or not os.path.isdir(git_dir):
+                    continue
+                size = _directory_size(git_dir)
+                try:
+                    last_used = os.stat(os.path.join(git_dir, LAST_USED_FILE)).st_mtime
+                except OSError:
+                    last_used = 0
+                mirrors.append((last_used, size, git_dir))
+                total += size
+
+        if total <= self.max_bytes:
+            return
+        mirrors.sort()
+        # Never evict the most recently used mirror; the review in progress needs it
+        for _, size, git_dir in mirrors[:-1]:
+            if total <= self.max_bytes:
+                break
+            lock = self._lock(git_dir)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                # A diff or file read in progress holds the read lock shared
+                readers = _open_flock(f"{git_dir}.read.lock", fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if readers is None:
+                    continue
+                with readers:
+                    shutil.rmtree(git_dir, ignore_errors=True)
+            finally:
+                lock.release()
+            total -= size
+            MIRROR_EVICTIONS.inc()
+            logger.info(f"Evicted git mirror {git_dir} ({size} bytes), {total} bytes left")
+
+
+class _MirrorLock:
+    """Context manager holding a per-mirror thread lock and an flock on a lock file"""
+
+    def __init__(self, thread_lock, path):
+        self.thread_lock = thread_lock
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking=True):
+        if not self.thread_lock.acquire(blocking):
+            return False
+        try:
+            self._file = open(self.path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            if self._file:
+                self._file.close()
+                self._file = None
+            self.thread_lock.release()
+            return False
+        return True
+
+    def release(self):
+        self._file.close()
+        self._file = None
+        self.thread_lock.release()
+
+    def __enter__(self):
+        if not self.acquire():
+            raise GitError(f"Could not lock {self.path}")
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _open_flock(path, operation):
+    """Open `path` and flock it; returns the file, or None when a non-blocking lock is held elsewhere"""
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, operation)
+    except OSError:
+        lock_file.close()
+        if operation & fcntl.LOCK_NB:
+            return None
+        raise
+    return lock_file
+
+
+def _directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
@@ -0,0 +1,160 @@
+import logging
+import os
+import threading
+import time
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Health monitor config
+HEALTH_POLL_INTERVAL = float(os.environ.get('HEALTH_POLL_INTERVAL', '10'))
+HEALTH_PROBE_TIMEOUT = float(os.environ.get('HEALTH_PROBE_TIMEOUT', '2'))
+HEALTH_CHECK_BITBUCKET = os.environ.get('HEALTH_CHECK_BITBUCKET', 'false').lower() == 'true'
+# Ollama counts as unhealthy once its last successful probe is older than this
+HEALTH_STALE_SECONDS = float(os.environ.get('HEALTH_STALE_SECONDS', str(3 * HEALTH_POLL_INTERVAL)))
+
+
+class HealthMonitor:
+    """Polls dependencies in the background and keeps the latest health state.
+
+    Probes use strict timeouts and run on their own thread; snapshot() only
+    reads the last state, so health endpoints answer in constant time and
+    never wait on Ollama while it is busy generating. Every Ollama backend
+    is probed; Ollama counts as healthy while any of them answers, and
+    models of `models` (the tier models) not loaded on any backend are
+    reported. `queue_depth` and `overload` are read on the same thread,
+    since both query the job queue.
+    """
+
+    def __init__(self, ollama_urls, bitbucket_url=None, queue_depth=None, overload=None, models=(),
+                 interval=HEALTH_POLL_INTERVAL):
+        self.ollama_urls = list(ollama_urls)
+        self.models = list(models)
+        self.bitbucket_url = bitbucket_url if HEALTH_CHECK_BITBUCKET else None
+        self.queue_depth = queue_depth
+        self.overload = overload
+        self.interval = interval
+        self.session = requests.Session()
+        self._state = {
+            'ollama': {'ok': False, 'last_success': None, 'error': 'not checked yet', 'version': None},
+            'backends': {url: {'ok': False, 'last_success': None, 'error': 'not checked yet', 'version': None,
+                               'loaded_models': []} for url in self.ollama_urls},
+            'loaded_models': [],
+            'bitbucket': None,
+            'queue_depth': None,
+            'overload': None,
+            'checked_at': None
+        }
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='health-monitor')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"Health poll failed: {str(e)}", exc_info=True)
+            if self._stopping.wait(self.interval):
+                return
+
+    def _probe(self, url):
+        """GET url; returns (response or None, error message or None)"""
+        try:
+            return self.session.get(url, timeout=HEALTH_PROBE_TIMEOUT), None
+        except requests.RequestException as e:
+            return None, str(e)
+
+    def poll(self):
+        """Run all probes once and publish the new state"""
+        now = time.time()
+        previous = self._state
+        backends = {}
+        for url in self.ollama_urls:
+            backend = dict(previous['backends'][url])
+            response, error = self._probe(f"{url}/api/version")
+            if response is not None and response.status_code == 200:
+                backend.update(ok=True, last_success=now, error=None, version=response.json().get('version'))
+                ps_response, _ = self._probe(f"{url}/api/ps")
+                if ps_response is not None and ps_response.status_code == 200:
+                    backend['loaded_models'] = [model.get('name') for model in ps_response.json().get('models', [])]
+            else:
+                backend.update(ok=False, error=error or f"Ollama server is not responding ({response.status_code})")
+                logger.warning(f"Ollama health probe of {url} failed: {backend['error']}")
+            backends[url] = backend
+
+        # Ollama as a whole: healthy while any backend answers
+        answering = [backend for backend in backends.values() if backend['ok']]
+        successes = [backend['last_success'] for backend in backends.values() if backend['last_success']]
+        ollama = {
+            'ok': bool(answering),
+            'last_success': max(successes) if successes else None,
+            'error': None if answering else next(iter(backends.values()))['error'],
+            'version': answering[0]['version'] if answering else previous['ollama']['version']
+        }
+        loaded_models = sorted({name for backend in backends.values() for name in backend['loaded_models']})
+
+        bitbucket = None
+        if self.bitbucket_url:
+            response, error = self._probe(self.bitbucket_url)
+            # Any answer below 500 (including 401/404) means the API is reachable
+            reachable = response is not None and response.status_code < 500
+            bitbucket = {'ok': reachable, 'error': None if reachable else (error or f"HTTP {response.status_code}")}
+
+        queue_depth = previous['queue_depth']
+        if self.queue_depth is not None:
+            try:
+                queue_depth = self.queue_depth()
+            except Exception as e:
+                logger.warning(f"Could not read queue depth: {str(e)}")
+
+        overload = previous['overload']
+        if self.overload is not None:
+            try:
+                overload = self.overload()
+            except Exception as e:
+                logger.warning(f"Could not read the degradation level: {str(e)}")
+
+        # Replace the whole dict so readers never see a half-updated state
+        self._state = {
+            'ollama': ollama,
+            'backends': backends,
+            'loaded_models': loaded_models,
+            'bitbucket': bitbucket,
+            'queue_depth': queue_depth,
+            'overload': overload,
+            'checked_at': now
+        }
+
+    def snapshot(self):
+        """Latest health state with ages relative to now; no I/O"""
+        state = self._state
+        now = time.time()
+        last_success = state['ollama']['last_success']
+        last_success_age = round(now - last_success, 1) if last_success else None
+        healthy = last_success_age is not None and last_success_age <= HEALTH_STALE_SECONDS
+        snapshot = {
+            'status': 'healthy' if healthy else 'unhealthy',
+            'ollama': dict(state['ollama'], last_success_age=last_success_age),
+            'loaded_models': state['loaded_models'],
+            # Tier models not resident on any backend; expected without warm-up until first used
+            'models_not_loaded': [model for model in self.models
+                                  if not any(name in (model, f"{model}:latest") for name in state['loaded_models'])],
+            'backends': {url: {key: value for key, value in backend.items() if key != 'last_success'}
+                         for url, backend in state['backends'].items()},
+            'bitbucket': state['bitbucket'],
+            'queue_depth': state['queue_depth'],
+            'checked_age': round(now - state['checked_at'], 1) if state['checked_at'] else None
+        }
+        if self.overload is not None:
+            snapshot['overload'] = state['overload']
+        return snapshot
@@ -0,0 +1,580 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from services import metrics
+from services.scheduler import fairness_key, max_jobs
+
+logger = logging.getLogger(__name__)
+
+# Job queue config
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', '/tmp/ai-pr-reviewer/jobs.db')
+JOB_WORKER_CONCURRENCY = int(os.environ.get('JOB_WORKER_CONCURRENCY', '2'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', '60'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '1.0'))
+STAGE_MAX_ATTEMPTS = int(os.environ.get('STAGE_MAX_ATTEMPTS', '3'))
+STAGE_RETRY_BACKOFF = float(os.environ.get('STAGE_RETRY_BACKOFF', '2.0'))
+REVIEW_DEBOUNCE_SECONDS = float(os.environ.get('REVIEW_DEBOUNCE_SECONDS', '30'))
+# Runnable jobs considered per claim when picking the next one fairly across repositories
+JOB_CLAIM_CANDIDATES = 200
+# Record every model call of a job in its status (see JobContext.trace)
+JOB_TRACE_ENABLED = os.environ.get('JOB_TRACE_ENABLED', 'false').lower() == 'true'
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+# Outcomes of submitting a review request
+SUBMIT_QUEUED = 'queued'
+SUBMIT_COALESCED = 'coalesced'
+SUBMIT_DUPLICATE = 'duplicate'
+SUBMIT_ALREADY_REVIEWED = 'already_reviewed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    repo_full_name TEXT NOT NULL,
+    pr_id INTEGER NOT NULL,
+    source_commit TEXT,
+    status TEXT NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_expires REAL,
+    available_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    stages TEXT NOT NULL DEFAULT '[]',
+    trace TEXT,
+    error TEXT,
+    deferrals INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, available_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_pr ON jobs (repo_full_name, pr_id, status);
+CREATE TABLE IF NOT EXISTS reviewed_commits (
+    repo_full_name TEXT NOT NULL,
+    pr_id INTEGER NOT NULL,
+    source_commit TEXT NOT NULL,
+    reviewed_at REAL NOT NULL,
+    PRIMARY KEY (repo_full_name, pr_id, source_commit)
+);
+"""
+
+# Columns added after the first release of the jobs table
+MIGRATIONS = {
+    'source_commit': "ALTER TABLE jobs ADD COLUMN source_commit TEXT",
+    'cancel_requested': "ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0",
+    'trace': "ALTER TABLE jobs ADD COLUMN trace TEXT",
+    'deferrals': "ALTER TABLE jobs ADD COLUMN deferrals INTEGER NOT NULL DEFAULT 0",
+}
+
+STAGE_DURATION = metrics.histogram('pr_review_stage_duration_seconds',
+                                   'Duration of one attempt of a review pipeline stage', ['stage'])
+STAGE_ERRORS = metrics.counter('pr_review_stage_errors_total',
+                               'Failed attempts of a review pipeline stage', ['stage'])
+QUEUE_WAIT = metrics.histogram('pr_review_queue_wait_seconds',
+                               'Time a runnable job waited for a free worker')
+QUEUE_DEPTH = metrics.gauge('pr_review_queue_depth', 'Review jobs running or ready to run')
+JOBS_SUBMITTED = metrics.counter('pr_review_jobs_submitted_total',
+                                 'Review requests by submit outcome', ['outcome'])
+JOBS_FINISHED = metrics.counter('pr_review_jobs_finished_total',
+                                'Review jobs by final status', ['status'])
+
+
+class JobCancelled(Exception):
+    """Raised between stages when a newer commit superseded the running review"""
+
+
+class NullJobContext:
+    """Stage runner used when a PR is processed outside the job queue"""
+
+    job_id = None
+    source_commit = None
+    deferrals = 0
+
+    def __init__(self, trace=None):
+        self.trace = trace
+
+    def check_cancelled(self):
+        pass
+
+    def defer(self, delay):
+        return False
+
+    def run_stage(self, name, func, *args, retry_if=None, **kwargs):
+        started = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            STAGE_ERRORS.inc(stage=name)
+            raise
+        finally:
+            STAGE_DURATION.observe(time.monotonic() - started, stage=name)
+
+
+class JobContext:
+    """Handle passed to the job handler; runs and records pipeline stages"""
+
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job_id = job['id']
+        self.repo_full_name = job['repo_full_name']
+        self.pr_id = job['pr_id']
+        self.source_commit = job.get('source_commit')
+        self.attempts = job['attempts']
+        # Times the job was put back to run later, see defer()
+        self.deferrals = job.get('deferrals') or 0
+        self.deferred_for = None
+        self.stages = []
+        # Model calls and other per-job events; None unless JOB_TRACE_ENABLED
+        self.trace = [] if JOB_TRACE_ENABLED else None
+
+    def check_cancelled(self):
+        """Raise JobCancelled if a newer commit for the same PR was queued"""
+        if self.queue.is_cancel_requested(self.job_id):
+            logger.info(f"Job {self.job_id} was superseded by a newer commit, cancelling")
+            raise JobCancelled(f"Superseded by a newer commit of {self.repo_full_name} PR #{self.pr_id}")
+
+    def defer(self, delay):
+        """Ask for the job to be queued again in `delay` seconds once the handler returns successfully"""
+        self.deferred_for = delay
+        return True
+
+    def run_stage(self, name, func, *args, retry_if=None, **kwargs):
+        """Run one pipeline stage, retrying with exponential backoff.
+
+        A stage fails when ``func`` raises or when ``retry_if(result)`` is true.
+        After ``STAGE_MAX_ATTEMPTS`` the last exception is re-raised, or the
+        last result is returned so the caller can handle it as before.
+        Before the stage starts, the job is cancelled if it was superseded.
+        """
+        self.check_cancelled()
+        stage = {'name': name, 'status': JOB_RUNNING, 'attempts': 0,
+                 'started_at': time.time(), 'duration_ms': None}
+        self.stages.append(stage)
+        error = None
+        result = None
+
+        for attempt in range(1, STAGE_MAX_ATTEMPTS + 1):
+            stage['attempts'] = attempt
+            error = None
+            started = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                error = e
+            elapsed = time.monotonic() - started
+            stage['duration_ms'] = round((stage['duration_ms'] or 0) + elapsed * 1000, 1)
+            STAGE_DURATION.observe(elapsed, stage=name)
+
+            failed = error is not None or (retry_if is not None and retry_if(result))
+            if not failed:
+                stage['status'] = JOB_DONE
+                self.queue.save_stages(self.job_id, self.stages, self.trace)
+                return result
+
+            STAGE_ERRORS.inc(stage=name)
+
+            logger.warning(f"Job {self.job_id} stage '{name}' failed on attempt {attempt}/{STAGE_MAX_ATTEMPTS}"
+                           + (f": {error}" if error else ""))
+            self.queue.save_stages(self.job_id, self.stages, self.trace)
+            if attempt < STAGE_MAX_ATTEMPTS:
+                time.sleep(STAGE_RETRY_BACKOFF * (2 ** (attempt - 1)))
+
+        stage['status'] = JOB_FAILED
+        self.queue.save_stages(self.job_id, self.stages, self.trace)
+        if error is not None:
+            raise error
+        return result
+
+
+class JobQueue:
+    """SQLite-backed persistent job queue with a fixed-size worker pool.
+
+    Jobs survive restarts: a worker holds a lease on the job it runs and
+    renews it while alive, so jobs left ``running`` by a dead process are
+    picked up again once their lease expires. Several processes on one node
+    can share the same database file.
+    """
+
+    def __init__(self, handler, db_path=JOB_DB_PATH, concurrency=JOB_WORKER_CONCURRENCY):
+        self.handler = handler
+        self.db_path = db_path
+        self.concurrency = max(1, concurrency)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._active_jobs = set()
+        self._active_lock = threading.Lock()
+        self._init_db()
+        QUEUE_DEPTH.set_function(self.depth)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_db(self):
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, statement in MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(statement)
+        finally:
+            conn.close()
+
+    def start(self):
+        """Recover unfinished jobs and start the worker threads"""
+        if self._threads:
+            return
+        self.recover()
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._worker_loop, name=f"review-worker-{i}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(target=self._heartbeat_loop, name="review-worker-heartbeat")
+        heartbeat.daemon = True
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        logger.info(f"Started {self.concurrency} review workers on {self.db_path}")
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def recover(self):
+        """Requeue jobs left running by a process that is no longer alive"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, lease_expires = NULL, available_at = ? "
+                "WHERE status = ? AND (lease_expires IS NULL OR lease_expires < ? OR owner = ?)",
+                (JOB_QUEUED, now, JOB_RUNNING, now, self.owner)
+            )
+            recovered = cursor.rowcount
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (JOB_QUEUED,)).fetchone()[0]
+        finally:
+            conn.close()
+        if recovered:
+            logger.warning(f"Recovered {recovered} unfinished review jobs")
+        logger.info(f"{queued} review jobs waiting in queue")
+        return recovered
+
+    def enqueue(self, repo_full_name, pr_id, source_commit=None, delay=None):
+        """Submit a review request for a PR, coalescing it with pending work.
+
+        Returns a ``(job_id, outcome)`` tuple. Requests for a commit that was
+        already reviewed, or that an unfinished job already covers, are not
+        queued again. A request for a new commit is merged into a job of the
+        same PR that is still waiting out its quiet window, which restarts
+        the window; a job still running for an older commit is asked to
+        cancel at its next stage boundary.
+        """
+        delay = REVIEW_DEBOUNCE_SECONDS if delay is None else delay
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if source_commit:
+                reviewed = conn.execute(
+                    "SELECT 1 FROM reviewed_commits WHERE repo_full_name = ? AND pr_id = ? AND source_commit = ?",
+                    (repo_full_name, pr_id, source_commit)
+                ).fetchone()
+                if reviewed:
+                    conn.execute("COMMIT")
+                    JOBS_SUBMITTED.inc(outcome=SUBMIT_ALREADY_REVIEWED)
+                    logger.info(f"Commit {source_commit} of {repo_full_name} PR #{pr_id} was already reviewed")
+                    return None, SUBMIT_ALREADY_REVIEWED
+
+            pending = conn.execute(
+                "SELECT id, status, source_commit FROM jobs WHERE repo_full_name = ? AND pr_id = ? "
+                "AND status IN (?, ?) AND cancel_requested = 0 ORDER BY created_at",
+                (repo_full_name, pr_id, JOB_QUEUED, JOB_RUNNING)
+            ).fetchall()
+
+            for job in pending:
+                if source_commit and job['source_commit'] == source_commit:
+                    conn.execute("COMMIT")
+                    JOBS_SUBMITTED.inc(outcome=SUBMIT_DUPLICATE)
+                    logger.info(f"Commit {source_commit} of {repo_full_name} PR #{pr_id} is already covered by job {job['id']}")
+                    return job['id'], SUBMIT_DUPLICATE
+
+            queued = [job for job in pending if job['status'] == JOB_QUEUED]
+            if queued:
+                job_id = queued[-1]['id']
+                conn.execute(
+                    "UPDATE jobs SET source_commit = COALESCE(?, source_commit), available_at = ? WHERE id = ?",
+                    (source_commit, now + delay, job_id)
+                )
+                outcome = SUBMIT_COALESCED
+            else:
+                job_id = uuid.uuid4().hex
+                conn.execute(
+                    "INSERT INTO jobs (id, repo_full_name, pr_id, source_commit, status, available_at, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, repo_full_name, pr_id, source_commit, JOB_QUEUED, now + delay, now)
+                )
+                outcome = SUBMIT_QUEUED
+
+            superseded = [job['id'] for job in pending if job['status'] == JOB_RUNNING]
+            if superseded:
+                conn.executemany("UPDATE jobs SET cancel_requested = 1 WHERE id = ?",
+                                 [(running_id,) for running_id in superseded])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        JOBS_SUBMITTED.inc(outcome=outcome)
+        if superseded:
+            logger.info(f"Requested cancellation of superseded jobs {superseded} for {repo_full_name} PR #{pr_id}")
+        self._wakeup.set()
+        logger.info(f"Review job {job_id} for {repo_full_name} PR #{pr_id} {outcome}, starts in {delay:.0f}s")
+        return job_id, outcome
+
+    def is_cancel_requested(self, job_id):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        return bool(row and row['cancel_requested'])
+
+    def get(self, job_id):
+        """Return the status of a job as a dict, or None if unknown; queued jobs include their queue position"""
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            status = self._row_to_status(row)
+            if row['status'] == JOB_QUEUED:
+                status['queue_position'] = self._queue_position(conn, row)
+        finally:
+            conn.close()
+        return status
+
+    def depth(self):
+        """Number of jobs that are running or can run now; deferred jobs and those in their quiet window don't count"""
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ? OR (status = ? AND available_at <= ?)",
+                                (JOB_RUNNING, JOB_QUEUED, time.time())).fetchone()[0]
+        finally:
+            conn.close()
+
+    def save_stages(self, job_id, stages, trace=None):
+        """Persist stage timings (and the trace, if any) and renew the lease on a running job"""
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE jobs SET stages = ?, trace = COALESCE(?, trace), lease_expires = ? WHERE id = ? AND owner = ?",
+                (json.dumps(stages), json.dumps(trace) if trace is not None else None,
+                 time.time() + JOB_LEASE_SECONDS, job_id, self.owner)
+            )
+        finally:
+            conn.close()
+
+    def _row_to_status(self, row):
+        queue_wait_ms = None
+        if row['started_at']:
+            queue_wait_ms = round((row['started_at'] - row['created_at']) * 1000, 1)
+        return {
+            'job_id': row['id'],
+            'repository': row['repo_full_name'],
+            'pr_id': row['pr_id'],
+            'source_commit': row['source_commit'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'created_at': row['created_at'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at'],
+            'queue_wait_ms': queue_wait_ms,
+            'stages': json.loads(row['stages'] or '[]'),
+            'trace': json.loads(row['trace']) if row['trace'] else None,
+            'deferrals': row['deferrals'],
+            'error': row['error']
+        }
+
+    def _running_by_key(self, conn, now):
+        """Jobs running under a live lease, counted per fairness key (repository or workspace)"""
+        running = {}
+        for row in conn.execute("SELECT repo_full_name, COUNT(*) AS count FROM jobs "
+                                "WHERE status = ? AND lease_expires >= ? GROUP BY repo_full_name", (JOB_RUNNING, now)):
+            key = fairness_key(row['repo_full_name'])
+            running[key] = running.get(key, 0) + row['count']
+        return running
+
+    def _fair_order(self, rows, running):
+        """Jobs of the repositories with the fewest running jobs first, then oldest first"""
+        return sorted(rows, key=lambda row: (running.get(fairness_key(row['repo_full_name']), 0), row['created_at']))
+
+    def _queue_position(self, conn, row):
+        """Estimated 1-based place of a queued job in the claim order; jobs still in their quiet window come last"""
+        now = time.time()
+        queued = conn.execute("SELECT id, repo_full_name, available_at, created_at FROM jobs WHERE status = ?",
+                              (JOB_QUEUED,)).fetchall()
+        running = self._running_by_key(conn, now)
+        ready = self._fair_order([job for job in queued if job['available_at'] <= now], running)
+        waiting = sorted((job for job in queued if job['available_at'] > now), key=lambda job: job['available_at'])
+        for position, job in enumerate(ready + waiting, 1):
+            if job['id'] == row['id']:
+                return position
+        return None
+
+    def _claim(self):
+        """Atomically take the next runnable job, or return None.
+
+        Jobs are taken oldest first, but from the repositories with the
+        fewest running jobs first, and never from a repository (or
+        workspace) already running as many jobs as its SCHEDULER_MAX_JOBS.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE (status = ? AND available_at <= ?) "
+                "OR (status = ? AND lease_expires < ?) ORDER BY created_at LIMIT ?",
+                (JOB_QUEUED, now, JOB_RUNNING, now, JOB_CLAIM_CANDIDATES)
+            ).fetchall()
+            running = self._running_by_key(conn, now)
+            row = next((row for row in self._fair_order(rows, running)
+                        if not max_jobs(row['repo_full_name'])
+                        or running.get(fairness_key(row['repo_full_name']), 0) < max_jobs(row['repo_full_name'])), None)
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                "started_at = COALESCE(started_at, ?) WHERE id = ?",
+                (JOB_RUNNING, self.owner, now + JOB_LEASE_SECONDS, now, row['id'])
+            )
+            conn.execute("COMMIT")
+            if row['status'] == JOB_QUEUED:
+                QUEUE_WAIT.observe(max(0.0, now - row['available_at']))
+            job = dict(row)
+            job['attempts'] += 1
+            return job
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _finish(self, job, status, error=None):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ?, lease_expires = NULL "
+                "WHERE id = ? AND owner = ?",
+                (status, error, now, job['id'], self.owner)
+            )
+            JOBS_FINISHED.inc(status=status)
+            if status == JOB_DONE and job.get('source_commit'):
+                conn.execute(
+                    "INSERT OR IGNORE INTO reviewed_commits (repo_full_name, pr_id, source_commit, reviewed_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (job['repo_full_name'], job['pr_id'], job['source_commit'], now)
+                )
+        finally:
+            conn.close()
+
+    def _requeue(self, job, delay):
+        """Put a running job back in the queue to run again after `delay` seconds, without using up an attempt"""
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, lease_expires = NULL, available_at = ?, "
+                "attempts = attempts - 1, deferrals = deferrals + 1 WHERE id = ? AND owner = ?",
+                (JOB_QUEUED, time.time() + delay, job['id'], self.owner)
+            )
+        finally:
+            conn.close()
+        logger.info(f"Deferred job {job['id']} for {job['repo_full_name']} PR #{job['pr_id']} by {delay:.0f}s")
+
+    def _worker_loop(self):
+        while not self._stopping.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"Error claiming review job: {str(e)}", exc_info=True)
+                job = None
+
+            if job is None:
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+
+            self._run_job(job)
+
+    def _run_job(self, job):
+        job_id = job['id']
+        if job['attempts'] > JOB_MAX_ATTEMPTS:
+            logger.error(f"Job {job_id} exceeded {JOB_MAX_ATTEMPTS} attempts, giving up")
+            self._finish(job, JOB_FAILED, f"Exceeded {JOB_MAX_ATTEMPTS} attempts")
+            return
+
+        with self._active_lock:
+            self._active_jobs.add(job_id)
+        logger.info(f"Running job {job_id} for {job['repo_full_name']} PR #{job['pr_id']} "
+                    f"(attempt {job['attempts']})")
+        try:
+            context = JobContext(self, job)
+            ok = self.handler(context)
+            if ok and context.deferred_for is not None:
+                self._requeue(job, context.deferred_for)
+                return
+            self._finish(job, JOB_DONE if ok else JOB_FAILED,
+                         None if ok else "Review did not complete successfully")
+        except JobCancelled as e:
+            self._finish(job, JOB_CANCELLED, str(e))
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {str(e)}", exc_info=True)
+            self._finish(job, JOB_FAILED, str(e))
+        finally:
+            with self._active_lock:
+                self._active_jobs.discard(job_id)
+
+    def _heartbeat_loop(self):
+        """Keep leases alive for jobs that are still running in this process"""
+        interval = max(1.0, JOB_LEASE_SECONDS / 3)
+        while not self._stopping.wait(interval):
+            with self._active_lock:
+                job_ids = list(self._active_jobs)
+            if not job_ids:
+                continue
+            try:
+                conn = self._connect()
+                try:
+                    conn.executemany(
+                        "UPDATE jobs SET lease_expires = ? WHERE id = ? AND owner = ?",
+                        [(time.time() + JOB_LEASE_SECONDS, job_id, self.owner) for job_id in job_ids]
+                    )
+                finally:
+                    conn.close()
+            except Exception as e:
+                logger.error(f"Error renewing job leases: {str(e)}")
@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ollama client config
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get('OLLAMA_CONNECT_TIMEOUT', '5'))
+OLLAMA_REQUEST_TIMEOUT = float(os.environ.get('OLLAMA_REQUEST_TIMEOUT', '300'))
+OLLAMA_POOL_SIZE = int(os.environ.get('OLLAMA_POOL_SIZE', '16'))
+
+REQUEST_DURATION = metrics.histogram('ollama_request_duration_seconds',
+                                     'Wall-clock duration of a streamed generation', ['model'])
+TIME_TO_FIRST_TOKEN = metrics.histogram('ollama_time_to_first_token_seconds',
+                                        'Time from request to the first streamed token', ['model'])
+TOKENS_PER_SECOND = metrics.histogram('ollama_eval_tokens_per_second',
+                                      'Generation speed from Ollama eval_count/eval_duration', ['model'],
+                                      buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 150, 200, 300, 500))
+PROMPT_TOKENS = metrics.counter('ollama_prompt_tokens_total', 'Prompt tokens evaluated by Ollama', ['model'])
+GENERATED_TOKENS = metrics.counter('ollama_generated_tokens_total', 'Tokens streamed back by Ollama', ['model'])
+REQUESTS = metrics.counter('ollama_requests_total',
+                           'Generations by outcome (completed, stop_marker, token_budget, error)',
+                           ['model', 'outcome'])
+
+
+class OllamaError(Exception):
+    """Raised when Ollama answers with an error status"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class OllamaClient:
+    """HTTP client for one Ollama server, reusing keep-alive connections.
+
+    A single instance is shared by all analysis threads; ``requests.Session``
+    with a sized connection pool lets concurrent generations each hold their
+    own connection instead of opening a new one per call.
+    """
+
+    def __init__(self, base_url, pool_size=OLLAMA_POOL_SIZE,
+                 connect_timeout=OLLAMA_CONNECT_TIMEOUT, request_timeout=OLLAMA_REQUEST_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, request_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def generate_stream(self, model, prompt, options=None, stop_markers=(), max_tokens=None, format=None):
+        """Stream a generation from /api/generate, parsing each NDJSON line once.
+
+        Tokens are collected in a list and joined once at the end. Generation
+        stops early, by closing the connection so Ollama aborts it, when a
+        stop marker appears in the output or after ``max_tokens`` streamed
+        tokens. ``format`` ("json" or a JSON schema) constrains the output.
+        Returns a dict with the text and the timing counters Ollama reports
+        in its final chunk.
+        """
+        try:
+            result = self._stream_generation(model, prompt, options, stop_markers, max_tokens, format)
+        except Exception:
+            REQUESTS.inc(model=model, outcome='error')
+            raise
+        REQUESTS.inc(model=model, outcome=result['stopped_early'] or 'completed')
+        REQUEST_DURATION.observe(result['total_ms'] / 1000, model=model)
+        if result['time_to_first_token_ms'] is not None:
+            TIME_TO_FIRST_TOKEN.observe(result['time_to_first_token_ms'] / 1000, model=model)
+        if result['eval_count'] and result['eval_duration']:
+            TOKENS_PER_SECOND.observe(result['eval_count'] / (result['eval_duration'] / 1e9), model=model)
+        if result['prompt_eval_count']:
+            PROMPT_TOKENS.inc(result['prompt_eval_count'], model=model)
+        GENERATED_TOKENS.inc(result['tokens'], model=model)
+        return result
+
+    def _stream_generation(self, model, prompt, options, stop_markers, max_tokens, format=None):
+        started = time.monotonic()
+        tokens = []
+        tail = ''
+        marker_window = max((len(marker) for marker in stop_markers), default=0)
+        result = {
+            'text': '',
+            'stopped_early': None,
+            'tokens': 0,
+            'time_to_first_token_ms': None,
+            'total_ms': None,
+            'eval_count': None,
+            'eval_duration': None,
+            'prompt_eval_count': None,
+            'prompt_eval_duration': None
+        }
+
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": True,
+            "options": options or {}
+        }
+        if format:
+            payload["format"] = format
+
+        with self.session.post(
+            f"{self.base_url}/api/generate",
+            json=payload,
+            timeout=self.timeout,
+            stream=True
+        ) as response:
+            if response.status_code != 200:
+                raise OllamaError(f"Ollama API error: {response.status_code} - {response.text[:500]}",
+                                  status_code=response.status_code)
+
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Failed to parse line as JSON: {line[:50]!r}...")
+                    continue
+
+                token = data.get('response')
+                if token:
+                    if result['time_to_first_token_ms'] is None:
+                        result['time_to_first_token_ms'] = round((time.monotonic() - started) * 1000, 1)
+                    tokens.append(token)
+                    if marker_window:
+                        tail = (tail + token)[-(marker_window + len(token)):]
+                        if any(marker in tail for marker in stop_markers):
+                            result['stopped_early'] = 'stop_marker'
+                            break
+                    if max_tokens and len(tokens) >= max_tokens:
+                        result['stopped_early'] = 'token_budget'
+                        break
+
+                if data.get('done'):
+                    # Keep reading to the end of the body so the connection goes back to the pool
+                    for key in ('eval_count', 'eval_duration', 'prompt_eval_count', 'prompt_eval_duration'):
+                        result[key] = data.get(key)
+
+        text = ''.join(tokens)
+        if result['stopped_early'] == 'stop_marker':
+            text = text[:min(text.find(marker) for marker in stop_markers if marker in text)]
+        result['text'] = text
+        result['tokens'] = len(tokens)
+        result['total_ms'] = round((time.monotonic() - started) * 1000, 1)
+        return result
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_ollama_client(base_url):
+    """Return the shared client for an Ollama base URL"""
+    with _clients_lock:
+        client = _clients.get(base_url)
+        if client is None:
+            client = OllamaClient(base_url)
+            _clients[base_url] = client
+        return client
@@ -0,0 +1,183 @@
+import ast
+import fnmatch
+import logging
+import os
+import re
+from services import metrics
+from services.file_scoring import get_weights, is_generated
+
+logger = logging.getLogger(__name__)
+
+# Pre-filter config
+PREFILTER_ENABLED = os.environ.get('PREFILTER_ENABLED', 'true').lower() == 'true'
+
+# Line comment prefixes by extension; files of other types never count as comment-only
+HASH_COMMENTS = ('#',)
+SLASH_COMMENTS = ('//', '/*', '* ', '*/')
+COMMENT_PREFIXES = {
+    '.py': HASH_COMMENTS, '.rb': HASH_COMMENTS, '.sh': HASH_COMMENTS, '.toml': HASH_COMMENTS,
+    '.cfg': HASH_COMMENTS, '.ini': ('#', ';'), '.sql': ('--',), '.lua': ('--',),
+    '.js': SLASH_COMMENTS, '.jsx': SLASH_COMMENTS, '.ts': SLASH_COMMENTS, '.tsx': SLASH_COMMENTS,
+    '.go': SLASH_COMMENTS, '.java': SLASH_COMMENTS, '.kt': SLASH_COMMENTS, '.c': SLASH_COMMENTS,
+    '.cc': SLASH_COMMENTS, '.cpp': SLASH_COMMENTS, '.h': SLASH_COMMENTS, '.cs': SLASH_COMMENTS,
+    '.rs': SLASH_COMMENTS, '.swift': SLASH_COMMENTS, '.scala': SLASH_COMMENTS, '.php': SLASH_COMMENTS + HASH_COMMENTS,
+    '.css': ('/*', '* ', '*/'), '.scss': SLASH_COMMENTS
+}
+# Languages where indentation is meaningful, so re-indenting is not a whitespace-only change
+INDENT_SENSITIVE = {'.py', '.yaml', '.yml', '.pug', '.haml', '.coffee'}
+IMPORT_RE = re.compile(r'^\s*(import\s|from\s+\S+\s+import\s|#include\s|using\s|require\s|'
+                       r'(const|let|var)\s+\S+\s*=\s*require\()')
+
+SKIPPED = metrics.counter('review_prefilter_skipped_total',
+                          'Files and hunks resolved before the model by the pre-filter', ['kind', 'reason'])
+SYNTAX_ERRORS = metrics.counter('review_prefilter_syntax_errors_total',
+                                'Syntax errors found in changed files without a model call')
+
+
+def _changed_lines(hunk, prefix):
+    return [line[1:] for line in hunk['lines'] if line.startswith(prefix)]
+
+
+def is_whitespace_only(hunk, ext):
+    removed, added = _changed_lines(hunk, '-'), _changed_lines(hunk, '+')
+    if ext in INDENT_SENSITIVE:
+        # Line by line, keeping each line's indentation
+        return ([(len(line) - len(line.lstrip()), ''.join(line.split())) for line in removed if line.strip()] ==
+                [(len(line) - len(line.lstrip()), ''.join(line.split())) for line in added if line.strip()])
+    return ''.join(''.join(removed).split()) == ''.join(''.join(added).split())
+
+
+def is_comment_only(hunk, ext):
+    prefixes = COMMENT_PREFIXES.get(ext)
+    if not prefixes:
+        return False
+    # The trailing space lets a bare "*" continuation line match "* "
+    return all((line[1:].strip() + ' ').startswith(prefixes) or not line[1:].strip() for line in hunk['lines'])
+
+
+def is_import_reorder(hunk, ext):
+    removed = [line.strip() for line in _changed_lines(hunk, '-') if line.strip()]
+    added = [line.strip() for line in _changed_lines(hunk, '+') if line.strip()]
+    return bool(added) and sorted(removed) == sorted(added) and all(IMPORT_RE.match(line) for line in added)
+
+
+# Hunk checks in order; the first that matches is recorded as the reason
+HUNK_FILTERS = [('whitespace', is_whitespace_only), ('comment', is_comment_only), ('import_reorder', is_import_reorder)]
+
+
+def trivial_hunk_reason(hunk, ext):
+    """Return why a hunk needs no review, or None if it does"""
+    for reason, check in HUNK_FILTERS:
+        if check(hunk, ext):
+            return reason
+    return None
+
+
+def file_skip_reason(file_info, weights):
+    """Return why a whole file needs no review, or None if it does"""
+    path = file_info['path']
+    if any(fnmatch.fnmatch(path, pattern) for pattern in weights['ignore_globs']):
+        return 'ignored'
+    if is_generated(file_info, weights):
+        return 'generated'
+    return None
+
+
+def _recount(file_info, hunks):
+    """Point file_info at its remaining hunks and recompute the counts scoring and selection use"""
+    file_info['hunks'] = hunks
+    file_info['changes'] = '\n'.join(line for hunk in hunks for line in hunk['lines'])
+    file_info['size'] = len(file_info['changes'])
+    file_info['added'] = sum(hunk['added'] for hunk in hunks)
+    file_info['removed'] = sum(hunk['removed'] for hunk in hunks)
+
+
+def prefilter(changed_files, repo_full_name=None):
+    """Drop files and hunks that need no model review.
+
+    Whole files are dropped when they match the repository's ignore_globs
+    or look generated, minified or vendored. Hunks that only change
+    whitespace or comments, or only reorder imports, are dropped from the
+    files kept, and files left without hunks are dropped too. Returns
+    (kept_files, skipped), where skipped maps "file:<reason>" and
+    "hunk:<reason>" to counts.
+    """
+    weights = get_weights(repo_full_name)
+    kept = []
+    skipped = {}
+
+    def skip(kind, reason):
+        skipped[f"{kind}:{reason}"] = skipped.get(f"{kind}:{reason}", 0) + 1
+        SKIPPED.inc(kind=kind, reason=reason)
+
+    for file_info in changed_files:
+        reason = file_skip_reason(file_info, weights)
+        if reason:
+            logger.info(f"Skipping {file_info['path']}: {reason}")
+            skip('file', reason)
+            continue
+
+        hunks = file_info.get('hunks') or []
+        ext = os.path.splitext(file_info['path'])[1].lower()
+        remaining = []
+        for hunk in hunks:
+            reason = trivial_hunk_reason(hunk, ext) if hunk['lines'] else None
+            if reason:
+                skip('hunk', reason)
+            else:
+                remaining.append(hunk)
+        if len(remaining) < len(hunks):
+            if not remaining:
+                logger.info(f"Skipping {file_info['path']}: only trivial changes")
+                skip('file', 'trivial')
+                continue
+            _recount(file_info, remaining)
+        kept.append(file_info)
+    return kept, skipped
+
+
+def check_python_syntax(content, path):
+    try:
+        ast.parse(content, filename=path)
+    except SyntaxError as e:
+        return e.lineno, e.msg
+    except ValueError as e:
+        # Source containing null bytes
+        return None, str(e)
+    except (RecursionError, MemoryError):
+        # Too deeply nested for the parser; not necessarily wrong
+        return None
+    return None
+
+
+# Checkers by extension: (content, path) -> (line, message) of the first error, or None
+SYNTAX_CHECKERS = {'.py': check_python_syntax}
+
+
+def find_syntax_errors(files):
+    """Parse changed files locally and return the syntax errors inside their changed hunks.
+
+    Only errors on lines the PR touched are returned, so files that were
+    already broken, or that only an older language version parses, are
+    left to the model. Each error is a finding dict with path, line,
+    severity and message.
+    """
+    errors = []
+    for file_info in files:
+        checker = SYNTAX_CHECKERS.get(os.path.splitext(file_info['path'])[1].lower())
+        if not checker or not file_info.get('content'):
+            continue
+        error = checker(file_info['content'], file_info['path'])
+        if not error:
+            continue
+        line, message = error
+        in_hunk = line is None or any(
+            hunk.get('new_start') is not None and hunk['new_start'] <= line < hunk['new_start'] + max(hunk['new_lines'], 1)
+            for hunk in file_info.get('hunks') or [])
+        if not in_hunk:
+            logger.info(f"Syntax error outside the changes of {file_info['path']} at line {line}, leaving it to the model")
+            continue
+        SYNTAX_ERRORS.inc()
+        errors.append({'path': file_info['path'], 'line': line, 'severity': 'critical',
+                       'message': f"Syntax error: {message}", 'risk_score': file_info.get('risk_score')})
+    return errors
@@ -0,0 +1,92 @@
+import logging
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+# Prompt planning config
+PROMPT_TOKEN_BUDGET = int(os.environ.get('PROMPT_TOKEN_BUDGET', '6000'))
+MAX_HUNKS_PER_REQUEST = int(os.environ.get('MAX_HUNKS_PER_REQUEST', '8'))
+# num_predict of a request: base + per hunk + per changed line, capped by OLLAMA_OUTPUT_TOKEN_BUDGET
+OUTPUT_TOKENS_BASE = int(os.environ.get('OUTPUT_TOKENS_BASE', '32'))
+OUTPUT_TOKENS_PER_HUNK = int(os.environ.get('OUTPUT_TOKENS_PER_HUNK', '48'))
+OUTPUT_TOKENS_PER_CHANGED_LINE = float(os.environ.get('OUTPUT_TOKENS_PER_CHANGED_LINE', '1'))
+
+# Rough size of a token in characters of source code; good enough for packing decisions
+CHARS_PER_TOKEN = 4
+# Tokens taken by a section label and separators
+SECTION_OVERHEAD_TOKENS = 12
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def estimate_unit_tokens(unit):
+    hunk = unit['hunk']
+    chars = len(unit['path']) + len(hunk['header']) + sum(len(line) + 1 for line in hunk['lines'])
+    chars += len(hunk.get('context') or '')
+    return math.ceil(chars / CHARS_PER_TOKEN) + SECTION_OVERHEAD_TOKENS
+
+
+def estimate_output_tokens(units, per_hunk=OUTPUT_TOKENS_PER_HUNK, limit=None):
+    """Output tokens to allow for reviewing a batch, growing with its hunks and changed lines"""
+    changed_lines = sum(len(unit['hunk']['lines']) for unit in units)
+    tokens = OUTPUT_TOKENS_BASE + per_hunk * len(units) + math.ceil(OUTPUT_TOKENS_PER_CHANGED_LINE * changed_lines)
+    return min(tokens, limit) if limit else tokens
+
+
+def split_unit(unit, token_budget):
+    """Split a hunk too large for one request into line-bounded parts"""
+    parts = []
+    current = []
+    current_tokens = SECTION_OVERHEAD_TOKENS + estimate_tokens(unit['path'] + unit['hunk']['header'] +
+                                                               (unit['hunk'].get('context') or ''))
+    base_tokens = current_tokens
+    line_numbers = unit['hunk'].get('line_numbers') or [None] * len(unit['hunk']['lines'])
+    for line, line_number in zip(unit['hunk']['lines'], line_numbers):
+        line_tokens = estimate_tokens(line) + 1
+        if current and current_tokens + line_tokens > token_budget:
+            parts.append(current)
+            current = []
+            current_tokens = base_tokens
+        current.append((line[:token_budget * CHARS_PER_TOKEN], line_number))
+        current_tokens += line_tokens
+    if current:
+        parts.append(current)
+
+    return [dict(unit, part=i, parts=len(parts),
+                 hunk=dict(unit['hunk'], header=f"{unit['hunk']['header']} (part {i + 1}/{len(parts)})",
+                           lines=[line for line, _ in lines], line_numbers=[number for _, number in lines]))
+            for i, lines in enumerate(parts)]
+
+
+def plan_batches(units, token_budget=PROMPT_TOKEN_BUDGET, max_units=MAX_HUNKS_PER_REQUEST):
+    """Pack review units (hunks) into as few model requests as the budget allows.
+
+    Units are taken in order, so hunks of one file stay adjacent, and added
+    to the current request until its estimated prompt tokens or unit count
+    would exceed the budget. A hunk larger than the whole budget is split
+    into parts at line boundaries, each in its own request slot, so an
+    oversized file is spread over several requests at hunk boundaries.
+    """
+    batches = []
+    current = []
+    current_tokens = 0
+    for unit in units:
+        pieces = [unit]
+        if estimate_unit_tokens(unit) > token_budget:
+            pieces = split_unit(unit, token_budget)
+        for piece in pieces:
+            tokens = estimate_unit_tokens(piece)
+            if current and (current_tokens + tokens > token_budget or len(current) >= max_units):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += tokens
+    if current:
+        batches.append(current)
+
+    logger.info(f"Packed {len(units)} hunks into {len(batches)} requests (budget {token_budget} tokens)")
+    return batches
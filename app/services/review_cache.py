@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Review cache config
+REVIEW_CACHE_DIR = os.environ.get('REVIEW_CACHE_DIR', '/tmp/ai-pr-reviewer/review-cache')
+REVIEW_CACHE_MAX_BYTES = int(os.environ.get('REVIEW_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+REVIEW_CACHE_ENABLED = os.environ.get('REVIEW_CACHE_ENABLED', 'true').lower() == 'true'
+
+# Fraction of the size budget kept after an eviction pass, so we don't evict on every write
+EVICTION_TARGET_RATIO = 0.9
+
+CACHE_LOOKUPS = metrics.counter('cache_lookups_total', 'Cache lookups by cache and result', ['cache', 'result'])
+CACHE_EVICTIONS = metrics.counter('review_cache_evictions_total', 'Entries evicted from the hunk review cache')
+
+# Line number prefix of rendered context lines, see ContextExtractor._render
+CONTEXT_LINE_NUMBER_RE = re.compile(r'^ *\d+ ', re.MULTILINE)
+
+
+def normalize_hunk(lines):
+    """Normalize hunk lines so cosmetic differences don't change the hash.
+
+    Hunk headers (and so line numbers) and trailing whitespace are dropped:
+    a hunk that only moved within the file hashes the same.
+    """
+    normalized = []
+    for line in lines:
+        if line.startswith('@@'):
+            continue
+        normalized.append(line.rstrip())
+    return '\n'.join(normalized)
+
+
+def hunk_hash(lines, path='', context=None):
+    """Hash of what the model sees of a hunk: its changed lines, file path and context (without line numbers)"""
+    context = CONTEXT_LINE_NUMBER_RE.sub('', context or '')
+    text = f"{path}\0{normalize_hunk(lines)}\0{context}"
+    return hashlib.sha256(text.encode('utf-8', 'replace')).hexdigest()
+
+
+class ReviewCache:
+    """Content-addressed on-disk cache of per-hunk review results.
+
+    Entries are single JSON files written atomically, so every worker
+    process on a node can share one directory. Reads touch the entry's
+    mtime, and the least recently used entries are evicted once the
+    directory grows past ``max_bytes``.
+    """
+
+    def __init__(self, directory=REVIEW_CACHE_DIR, max_bytes=REVIEW_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._approx_bytes = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(model, prompt_version, hunk_digest):
+        return hashlib.sha256(f"{model}\0{prompt_version}\0{hunk_digest}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+            os.utime(path, None)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            CACHE_LOOKUPS.inc(cache='hunk_review', result='miss')
+            return None
+        with self._lock:
+            self.hits += 1
+        CACHE_LOOKUPS.inc(cache='hunk_review', result='hit')
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = json.dumps(value).encode('utf-8')
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write review cache entry {key}: {str(e)}")
+            return
+
+        with self._lock:
+            self.writes += 1
+            if self._approx_bytes is not None:
+                self._approx_bytes += len(data)
+            needs_eviction = self._approx_bytes is None or self._approx_bytes > self.max_bytes
+        if needs_eviction:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits its budget"""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        evicted = 0
+        if total > self.max_bytes:
+            target = self.max_bytes * EVICTION_TARGET_RATIO
+            entries.sort()
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                evicted += 1
+            logger.info(f"Evicted {evicted} review cache entries, {total} bytes left")
+
+        with self._lock:
+            self._approx_bytes = total
+            self.evictions += evicted
+        if evicted:
+            CACHE_EVICTIONS.inc(evicted)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else None,
+                'writes': self.writes,
+                'evictions': self.evictions,
+                'approx_bytes': self._approx_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+
+_review_cache = None
+_review_cache_lock = threading.Lock()
+
+
+def get_review_cache():
+    """Return the process-wide review cache, or None when caching is disabled"""
+    global _review_cache
+    if not REVIEW_CACHE_ENABLED:
+        return None
+    with _review_cache_lock:
+        if _review_cache is None:
+            _review_cache = ReviewCache()
+        return _review_cache
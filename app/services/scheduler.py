@@ -0,0 +1,230 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Review scheduler config
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'true').lower() == 'true'
+# Model calls in flight across all reviews; 0 = one per backend slot (backends x OLLAMA_NUM_PARALLEL)
+SCHEDULER_SLOTS = int(os.environ.get('SCHEDULER_SLOTS', '0'))
+# Fair shares are kept per 'repository' (workspace/repo_slug) or per 'workspace'
+SCHEDULER_FAIRNESS = os.environ.get('SCHEDULER_FAIRNESS', 'repository').lower()
+# Comma-separated "name=value" overrides by repository or workspace, e.g. "acme/monorepo=0.5,acme=2"
+SCHEDULER_WEIGHTS_SPEC = os.environ.get('SCHEDULER_WEIGHTS', '')
+SCHEDULER_MAX_CALLS_SPEC = os.environ.get('SCHEDULER_MAX_CALLS', '')
+SCHEDULER_MAX_JOBS_SPEC = os.environ.get('SCHEDULER_MAX_JOBS', '')
+# Defaults for repositories without an override (0 = no cap)
+SCHEDULER_DEFAULT_MAX_CALLS = int(os.environ.get('SCHEDULER_DEFAULT_MAX_CALLS', '0'))
+SCHEDULER_DEFAULT_MAX_JOBS = int(os.environ.get('SCHEDULER_DEFAULT_MAX_JOBS', '0'))
+# Priority a waiting model call gains per second, in estimated tokens, so large jobs are not starved
+SCHEDULER_AGING_TOKENS_PER_SECOND = float(os.environ.get('SCHEDULER_AGING_TOKENS_PER_SECOND', '1000'))
+
+SCHEDULER_WAIT = metrics.histogram('review_scheduler_wait_seconds', 'Time a model call waited for a scheduler slot')
+SCHEDULER_WAITING = metrics.gauge('review_scheduler_waiting_calls', 'Model calls waiting for a scheduler slot')
+
+_current_job = contextvars.ContextVar('review_job', default=None)
+
+
+def parse_settings(spec):
+    """Parse "acme/monorepo=0.5,acme=2" into {name: float}"""
+    settings = {}
+    for entry in spec.split(','):
+        name, _, value = entry.strip().partition('=')
+        if name and value:
+            settings[name.strip()] = float(value)
+    return settings
+
+
+SCHEDULER_WEIGHTS = parse_settings(SCHEDULER_WEIGHTS_SPEC)
+SCHEDULER_MAX_CALLS = parse_settings(SCHEDULER_MAX_CALLS_SPEC)
+SCHEDULER_MAX_JOBS = parse_settings(SCHEDULER_MAX_JOBS_SPEC)
+
+
+def fairness_key(repo_full_name):
+    """The repository, or its workspace with SCHEDULER_FAIRNESS=workspace, that shares are kept for"""
+    repo_full_name = repo_full_name or ''
+    if SCHEDULER_FAIRNESS == 'workspace':
+        return repo_full_name.split('/')[0]
+    return repo_full_name
+
+
+def repo_setting(settings, repo_full_name, default):
+    """The override for the repository, else for its workspace, else the default"""
+    repo_full_name = repo_full_name or ''
+    for name in (repo_full_name, repo_full_name.split('/')[0]):
+        if name in settings:
+            return settings[name]
+    return default
+
+
+def max_jobs(repo_full_name):
+    """Review jobs of a repository (or workspace) that may run at once; 0 = no cap"""
+    return int(repo_setting(SCHEDULER_MAX_JOBS, repo_full_name, SCHEDULER_DEFAULT_MAX_JOBS))
+
+
+class ScheduledJob:
+    """A review job's share of the scheduler: its size estimate and the model calls it waited for"""
+
+    def __init__(self, job_id, repo_full_name):
+        self.job_id = job_id
+        self.repo_full_name = repo_full_name
+        self.key = fairness_key(repo_full_name)
+        self.weight = max(repo_setting(SCHEDULER_WEIGHTS, repo_full_name, 1.0), 0.01)
+        self.max_calls = int(repo_setting(SCHEDULER_MAX_CALLS, repo_full_name, SCHEDULER_DEFAULT_MAX_CALLS))
+        # Estimated prompt tokens of the whole review, known once its files are selected
+        self.estimated_tokens = None
+        self.served_tokens = 0
+        self.calls = 0
+        self.wait_seconds = 0.0
+
+    def remaining_tokens(self, tokens):
+        if self.estimated_tokens is None:
+            return tokens
+        return max(self.estimated_tokens - self.served_tokens, tokens)
+
+
+class ReviewScheduler:
+    """Orders model calls of concurrent reviews: fair across repositories, shortest job first.
+
+    A call waits until one of `slots` is free and it ranks first among the
+    waiting calls whose repository is below its concurrency cap. Calls
+    are ranked by their repository's virtual time (estimated tokens
+    served so far divided by its weight, as in weighted fair queuing)
+    plus the remaining size of their job, so small PRs overtake large
+    ones and a repository that got little service goes ahead of a busy
+    one. Every second of waiting lowers a call's rank by
+    SCHEDULER_AGING_TOKENS_PER_SECOND so large jobs still progress.
+    """
+
+    def __init__(self, slots, aging=SCHEDULER_AGING_TOKENS_PER_SECOND):
+        self.slots = max(1, slots)
+        self.aging = aging
+        self.in_flight = 0
+        self._jobs = {}
+        self._waiting = []
+        self._in_flight_by_key = {}
+        self._virtual = {}
+        self._condition = threading.Condition()
+        SCHEDULER_WAITING.set_function(lambda: len(self._waiting))
+
+    @contextmanager
+    def track(self, job_id, repo_full_name):
+        """Register a review job for the calls made in this context, including executor threads bound to it"""
+        job = ScheduledJob(job_id, repo_full_name)
+        with self._condition:
+            self._jobs[job_id] = job
+        token = _current_job.set(job)
+        try:
+            yield job
+        finally:
+            _current_job.reset(token)
+            with self._condition:
+                self._jobs.pop(job_id, None)
+
+    def set_job_size(self, estimated_tokens):
+        """Record the estimated prompt tokens of the current job's review"""
+        job = _current_job.get()
+        if job is not None:
+            job.estimated_tokens = estimated_tokens
+
+    @contextmanager
+    def slot(self, tokens):
+        """Wait for a model call slot for a call of `tokens` estimated tokens, and hold it"""
+        job = _current_job.get() or ScheduledJob(None, None)
+        waiter = {'job': job, 'tokens': tokens, 'enqueued': time.monotonic(), 'granted': False}
+        with self._condition:
+            self._activate(job.key)
+            self._waiting.append(waiter)
+            self._dispatch()
+            while not waiter['granted']:
+                self._condition.wait()
+            waited = time.monotonic() - waiter['enqueued']
+            job.wait_seconds += waited
+        SCHEDULER_WAIT.observe(waited)
+        try:
+            yield waited
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._in_flight_by_key[job.key] -= 1
+                self._dispatch()
+
+    def _activate(self, key):
+        """Start a repository that had nothing queued at the current virtual time, so idle time earns no credit"""
+        if self._in_flight_by_key.get(key) or any(waiter['job'].key == key for waiter in self._waiting):
+            return
+        active = [self._virtual[other] for other in self._virtual
+                  if self._in_flight_by_key.get(other) or any(waiter['job'].key == other for waiter in self._waiting)]
+        floor = min(active) if active else 0.0
+        self._virtual[key] = max(self._virtual.get(key, floor), floor)
+
+    def _rank(self, waiter, now):
+        job = waiter['job']
+        return (self._virtual.get(job.key, 0.0) + job.remaining_tokens(waiter['tokens']) / job.weight
+                - self.aging * (now - waiter['enqueued']))
+
+    def _eligible(self, waiter):
+        job = waiter['job']
+        return not job.max_calls or self._in_flight_by_key.get(job.key, 0) < job.max_calls
+
+    def _dispatch(self):
+        """Grant free slots to the best-ranked eligible waiters; call with the condition held"""
+        granted = False
+        while self.in_flight < self.slots:
+            now = time.monotonic()
+            eligible = [waiter for waiter in self._waiting if self._eligible(waiter)]
+            if not eligible:
+                break
+            waiter = min(eligible, key=lambda waiter: self._rank(waiter, now))
+            self._waiting.remove(waiter)
+            job = waiter['job']
+            waiter['granted'] = True
+            self.in_flight += 1
+            self._in_flight_by_key[job.key] = self._in_flight_by_key.get(job.key, 0) + 1
+            self._virtual[job.key] = self._virtual.get(job.key, 0.0) + waiter['tokens'] / job.weight
+            job.served_tokens += waiter['tokens']
+            job.calls += 1
+            granted = True
+        if granted:
+            self._condition.notify_all()
+
+    def job_status(self, job_id):
+        """Scheduler view of a running job: its size estimate, model calls and their wait, and queue position"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            now = time.monotonic()
+            ranked = sorted(self._waiting, key=lambda waiter: self._rank(waiter, now))
+            positions = [i for i, waiter in enumerate(ranked, 1) if waiter['job'] is job]
+            return {
+                'fairness_key': job.key,
+                'estimated_tokens': job.estimated_tokens,
+                'model_calls': job.calls,
+                'model_calls_waiting': len(positions),
+                'model_call_position': positions[0] if positions else None,
+                'model_wait_ms': round(job.wait_seconds * 1000, 1)
+            }
+
+    def status(self):
+        with self._condition:
+            return {
+                'slots': self.slots,
+                'in_flight': self.in_flight,
+                'waiting': len(self._waiting),
+                'in_flight_by_key': {key: count for key, count in self._in_flight_by_key.items() if count}
+            }
+
+
+def bind_job(job):
+    """ThreadPoolExecutor initializer: make a worker thread's model calls count for `job`"""
+    _current_job.set(job)
+
+
+def current_job():
+    return _current_job.get()
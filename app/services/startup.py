@@ -0,0 +1,215 @@
+import fcntl
+import logging
+import os
+import subprocess
+import threading
+import time
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Startup config
+OLLAMA_START_SERVER = os.environ.get('OLLAMA_START_SERVER', 'true').lower() == 'true'
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '24h')
+STARTUP_LOCK_PATH = os.environ.get('STARTUP_LOCK_PATH', '/tmp/ai-pr-reviewer/startup.lock')
+STARTUP_POLL_INTERVAL = float(os.environ.get('STARTUP_POLL_INTERVAL', '1.0'))
+STARTUP_SERVER_TIMEOUT = float(os.environ.get('STARTUP_SERVER_TIMEOUT', '120'))
+MODEL_WARMUP_ENABLED = os.environ.get('MODEL_WARMUP_ENABLED', 'true').lower() == 'true'
+
+STATE_STARTING = 'starting'
+STATE_WAITING_FOR_SERVER = 'waiting_for_server'
+STATE_PULLING_MODEL = 'pulling_model'
+STATE_WARMING_UP = 'warming_up'
+STATE_WAITING_FOR_LEADER = 'waiting_for_leader'
+STATE_READY = 'ready'
+STATE_FAILED = 'failed'
+
+# Seconds to wait for a single probe request during startup
+PROBE_TIMEOUT = 2
+
+
+def model_matches(name, model_name):
+    """Ollama reports untagged models as 'name:latest'"""
+    return name == model_name or name == f"{model_name}:latest"
+
+
+class StartupManager:
+    """Brings the Ollama backends and the review models up in the background.
+
+    The first process on the node to take the startup lock starts `ollama
+    serve` for `local_url` if nothing answers yet, then pulls every model
+    (one per model tier) on every backend that answers and loads it into
+    memory with a warm-up request using `keep_alive`. Other processes only
+    wait until every model shows up as loaded on some backend. Liveness is
+    true as soon as the process runs; readiness only once every model is
+    resident.
+    """
+
+    def __init__(self, ollama_urls, model_names, local_url=None, lock_path=STARTUP_LOCK_PATH):
+        self.ollama_urls = list(ollama_urls)
+        self.model_names = list(dict.fromkeys(model_names))
+        self.local_url = local_url
+        self.lock_path = lock_path
+        self.state = STATE_STARTING
+        self.error = None
+        self.is_leader = False
+        self.started_at = time.time()
+        self.ready_at = None
+        self._lock_file = None
+        self._thread = None
+        self._server_process = None
+
+    def start(self):
+        """Start the background startup thread; returns immediately"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ollama-startup')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def is_live(self):
+        return self.state != STATE_FAILED
+
+    def is_ready(self):
+        return self.state == STATE_READY
+
+    def status(self):
+        return {
+            'state': self.state,
+            'live': self.is_live(),
+            'ready': self.is_ready(),
+            'leader': self.is_leader,
+            'models': self.model_names,
+            'error': self.error,
+            'startup_seconds': round((self.ready_at or time.time()) - self.started_at, 1)
+        }
+
+    def _set_state(self, state):
+        self.state = state
+        logger.info(f"Startup state: {state}")
+
+    def _try_lock(self):
+        directory = os.path.dirname(self.lock_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # Held for the life of the process so no other worker repeats the startup work
+        self._lock_file = lock_file
+        return True
+
+    def _run(self):
+        try:
+            while self.state != STATE_READY:
+                if self._try_lock():
+                    self.is_leader = True
+                    self._lead()
+                elif self._models_loaded():
+                    self.ready_at = time.time()
+                    self._set_state(STATE_READY)
+                else:
+                    if self.state != STATE_WAITING_FOR_LEADER:
+                        self._set_state(STATE_WAITING_FOR_LEADER)
+                    time.sleep(STARTUP_POLL_INTERVAL)
+            logger.info(f"Models {', '.join(self.model_names)} ready after {self.status()['startup_seconds']}s")
+        except Exception as e:
+            self.error = str(e)
+            self._set_state(STATE_FAILED)
+            logger.error(f"Startup failed: {str(e)}", exc_info=True)
+
+    def _lead(self):
+        self._set_state(STATE_WAITING_FOR_SERVER)
+        if self.local_url and not self._server_responding(self.local_url) and OLLAMA_START_SERVER:
+            self._start_server()
+        responding = self._wait_for_servers()
+
+        for url in responding:
+            for model_name in self.model_names:
+                if not self._model_pulled(url, model_name):
+                    self._set_state(STATE_PULLING_MODEL)
+                    self._pull_model(url, model_name)
+                if MODEL_WARMUP_ENABLED:
+                    self._set_state(STATE_WARMING_UP)
+                    self._warm_up(url, model_name)
+        self.ready_at = time.time()
+        self._set_state(STATE_READY)
+
+    def _start_server(self):
+        logger.info("Starting Ollama server...")
+        self._server_process = subprocess.Popen(
+            ["nohup", "ollama", "serve"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            preexec_fn=os.setsid
+        )
+
+    def _server_responding(self, url):
+        try:
+            return requests.get(f"{url}/api/version", timeout=PROBE_TIMEOUT).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def _wait_for_servers(self):
+        """Wait until every backend answers; past the timeout, go on with the ones that do"""
+        deadline = time.monotonic() + STARTUP_SERVER_TIMEOUT
+        while True:
+            responding = [url for url in self.ollama_urls if self._server_responding(url)]
+            if len(responding) == len(self.ollama_urls):
+                break
+            if self._server_process is not None and self._server_process.poll() is not None:
+                raise RuntimeError(f"Ollama server exited with code {self._server_process.returncode}")
+            if time.monotonic() > deadline:
+                if not responding:
+                    raise RuntimeError(f"No Ollama server responded within {STARTUP_SERVER_TIMEOUT}s")
+                skipped = [url for url in self.ollama_urls if url not in responding]
+                logger.warning(f"Ollama backends {', '.join(skipped)} did not respond, not preparing models on them")
+                break
+            time.sleep(STARTUP_POLL_INTERVAL)
+        logger.info(f"Ollama servers responding: {', '.join(responding)}")
+        return responding
+
+    def _listed_models(self, url, endpoint):
+        """Model names of /api/tags (pulled) or /api/ps (loaded) of a backend; empty if it doesn't answer"""
+        response = requests.get(f"{url}/api/{endpoint}", timeout=PROBE_TIMEOUT)
+        if response.status_code != 200:
+            return []
+        return [model.get('name') for model in response.json().get('models', [])]
+
+    def _model_pulled(self, url, model_name):
+        if any(model_matches(name, model_name) for name in self._listed_models(url, 'tags')):
+            logger.info(f"Model {model_name} is already pulled on {url}")
+            return True
+        return False
+
+    def _pull_model(self, url, model_name):
+        logger.info(f"Pulling model {model_name} on {url}...")
+        response = requests.post(f"{url}/api/pull", json={"name": model_name, "stream": False}, timeout=None)
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to pull model {model_name} on {url}: {response.status_code} - {response.text}")
+        logger.info(f"Successfully pulled model {model_name} on {url}")
+
+    def _warm_up(self, url, model_name):
+        """Load the model into memory; an empty prompt loads it without generating"""
+        started = time.monotonic()
+        response = requests.post(f"{url}/api/generate",
+                                 json={"model": model_name, "prompt": "", "keep_alive": OLLAMA_KEEP_ALIVE,
+                                       "stream": False},
+                                 timeout=None)
+        if response.status_code != 200:
+            raise RuntimeError(f"Warm-up of {model_name} on {url} failed: {response.status_code} - {response.text}")
+        logger.info(f"Model {model_name} loaded on {url} in {time.monotonic() - started:.1f}s")
+
+    def _models_loaded(self):
+        """True if every model is resident in memory (or, without warm-up, at least pulled) on some backend"""
+        endpoint = 'ps' if MODEL_WARMUP_ENABLED else 'tags'
+        listed = []
+        for url in self.ollama_urls:
+            try:
+                listed.extend(self._listed_models(url, endpoint))
+            except requests.RequestException:
+                continue
+        return all(any(model_matches(name, model_name) for name in listed) for model_name in self.model_names)
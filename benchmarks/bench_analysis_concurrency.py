@@ -0,0 +1,81 @@
+"""Wall-clock time of analyze_files against a fake Ollama server at increasing concurrency.
+
+Each hunk is sent as its own request (MAX_HUNKS_PER_REQUEST=1) so the
+numbers isolate the effect of concurrency from prompt packing.
+
+Usage: python benchmarks/bench_analysis_concurrency.py [--files 10] [--parallel 4] [--levels 1,2,4,8]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_ollama import FakeOllamaServer
+
+
+def synthetic_files(count):
+    files = []
+    for i in range(count):
+        lines = [f"+const value{i}_{n} = compute({n});" for n in range(20)]
+        files.append({
+            'path': f"src/module_{i}.js",
+            'changes': '\n'.join(lines),
+            'size': sum(len(line) + 1 for line in lines),
+            'hunks': [{'header': f"@@ -1,0 +1,{len(lines)} @@", 'lines': lines}]
+        })
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=10)
+    parser.add_argument('--parallel', type=int, default=4, help="generations the fake server runs at once")
+    parser.add_argument('--latency', type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument('--tokens', type=int, default=60)
+    parser.add_argument('--token-rate', type=float, default=200.0)
+    parser.add_argument('--levels', default='1,2,4,8')
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(latency=args.latency, tokens=args.tokens,
+                              tokens_per_second=args.token_rate, parallel=args.parallel).start()
+    host, port = server.httpd.server_address[:2]
+    os.environ['OLLAMA_HOST'] = host
+    os.environ['OLLAMA_PORT'] = str(port)
+    os.environ['REVIEW_CACHE_ENABLED'] = 'false'
+    os.environ['MAX_HUNKS_PER_REQUEST'] = '1'
+
+    from controllers.pr_review import analyze_files
+
+    report = {'files': args.files, 'server_parallel': args.parallel, 'runs': []}
+    baseline = None
+    for level in [int(value) for value in args.levels.split(',')]:
+        server.max_in_flight = 0
+        started = time.perf_counter()
+        incomplete = []
+        results = analyze_files(synthetic_files(args.files), concurrency=level, incomplete=incomplete)
+        elapsed = time.perf_counter() - started
+        baseline = baseline or elapsed
+        run = {
+            'concurrency': level,
+            'seconds': round(elapsed, 3),
+            'speedup': round(baseline / elapsed, 2),
+            'results': len(results),
+            'reviewed_files': args.files - len(incomplete),
+            'max_in_flight': server.max_in_flight
+        }
+        if incomplete:
+            print(f"WARNING: {len(incomplete)}/{args.files} files were not reviewed, model calls failed", file=sys.stderr)
+        report['runs'].append(run)
+        print(f"concurrency={level:<3} {elapsed:7.3f}s  speedup x{run['speedup']:<5} "
+              f"results={len(results)} reviewed={run['reviewed_files']} server_in_flight={server.max_in_flight}", file=sys.stderr)
+
+    server.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Throughput of the Ollama backend pool as fake GPU backends are added, and failover.
+
+Each fake backend runs `--parallel` generations at once. A fixed set of
+requests, with small and large prompts, is sent through the pool at
+`--concurrency`; the small ones are routed to a small model tier. In
+the failover run one of two backends starts answering 503 part-way
+through, and every request should still complete on the other one.
+
+Usage: python benchmarks/bench_backend_pool.py [--requests 40] [--backends 1,2,4] [--concurrency 8]
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_ollama import FakeOllamaServer
+
+SMALL_MODEL = 'small-coder'
+LARGE_MODEL = 'large-coder'
+
+
+def prompts(count):
+    # Every fourth prompt is large enough for the large tier
+    return [('x' * (4000 if i % 4 == 0 else 400)) + f"\nrequest {i}" for i in range(count)]
+
+
+def run(pool, requests, concurrency):
+    from services.prompt_planner import estimate_tokens
+
+    def generate(prompt):
+        try:
+            result = pool.generate(prompt, prompt_tokens=estimate_tokens(prompt), options={'num_predict': 40})
+            return result['model'], result['backend']
+        except Exception as e:
+            return 'error', str(e)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(generate, requests))
+    elapsed = time.perf_counter() - started
+    by_model = {}
+    by_backend = {}
+    for model, backend in outcomes:
+        by_model[model] = by_model.get(model, 0) + 1
+        if model != 'error':
+            by_backend[backend] = by_backend.get(backend, 0) + 1
+    return {
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(requests) / elapsed, 2),
+        'by_model': by_model,
+        'by_backend': sorted(by_backend.values(), reverse=True),
+        'errors': by_model.get('error', 0)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--backends', default='1,2,4')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--parallel', type=int, default=2, help="generations each fake backend runs at once")
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--token-rate', type=float, default=400.0)
+    args = parser.parse_args()
+
+    # Keep the failed backend out for the rest of the run
+    os.environ.setdefault('OLLAMA_CIRCUIT_COOLDOWN', '60')
+    from services.backend_pool import BackendPool, ModelTier
+
+    tiers = [ModelTier(SMALL_MODEL, 500), ModelTier(LARGE_MODEL)]
+    requests = prompts(args.requests)
+    report = {'requests': args.requests, 'concurrency': args.concurrency,
+              'backend_parallel': args.parallel, 'runs': []}
+
+    for count in [int(value) for value in args.backends.split(',')]:
+        servers = [FakeOllamaServer(latency=args.latency, tokens_per_second=args.token_rate,
+                                    parallel=args.parallel).start() for _ in range(count)]
+        for server in servers:
+            server.pulled_models.update({SMALL_MODEL, LARGE_MODEL})
+        pool = BackendPool([server.url for server in servers], tiers)
+        pool.probe()
+        result = dict(run(pool, requests, args.concurrency), backends=count)
+        report['runs'].append(result)
+        print(f"backends={count:<2} {result['seconds']:7.3f}s  {result['requests_per_second']:6} req/s  "
+              f"per backend={result['by_backend']} models={result['by_model']}", file=sys.stderr)
+        for server in servers:
+            server.stop()
+
+    servers = [FakeOllamaServer(latency=args.latency, tokens_per_second=args.token_rate,
+                                parallel=args.parallel).start() for _ in range(2)]
+    for server in servers:
+        server.pulled_models.update({SMALL_MODEL, LARGE_MODEL})
+    pool = BackendPool([server.url for server in servers], tiers)
+    pool.probe()
+    threading.Timer(0.3, setattr, (servers[1], 'error_status', 503)).start()
+    failover = run(pool, requests, args.concurrency)
+    failover['circuits'] = [backend['circuit'] for backend in pool.status()['backends']]
+    failover['failed_backend_requests'] = servers[1].requests
+    report['failover'] = failover
+    print(f"failover   {failover['seconds']:7.3f}s  errors={failover['errors']} "
+          f"per backend={failover['by_backend']} circuits={failover['circuits']}", file=sys.stderr)
+    for server in servers:
+        server.stop()
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Bitbucket calls of concurrent reviews against a rate-limited server, with and without the limiter and retries.
+
+`--reviews` reviews start at once and each makes the Bitbucket calls of
+a real one: PR metadata, the streamed diff, the contents of its files
+and then its comments, either one summary comment or `--findings` inline
+comments through the paced writer plus a summary. The fake server allows
+`--rate` requests per second after a burst of `--burst` and answers
+429 with Retry-After beyond that. Three client setups are compared:
+no limiter and no retries (every call a single request, as before), retries
+only, and retries with the shared token bucket set just below the
+server's rate.
+
+Usage: python benchmarks/bench_bitbucket_rate_limit.py [--reviews 20] [--rate 20] [--burst 10] [--findings 6]
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bitbucket import FakeBitbucketServer
+
+REPO = 'bench/service'
+
+
+def inline_groups(server, pr_id, count):
+    """`count` findings on the first line of the PR's hunks, one per line"""
+    groups = []
+    for path in server.file_paths(REPO, pr_id):
+        for h in range(server.hunks):
+            line = 1 + h * (server.lines * 3)
+            groups.append({'path': path, 'line': line, 'severity': 'medium', 'risk_score': 0,
+                           'findings': [{'severity': 'medium', 'message': f"Check the result of compute() at line {line}."}]})
+    return groups[:count]
+
+
+def review(client, writer, server, pr_id, mode, findings):
+    """The Bitbucket calls of one review; returns whether all of them succeeded"""
+    workspace, repo_slug = REPO.split('/')
+    commit = client.get_source_commit(workspace, repo_slug, pr_id)
+    diff = client.iter_pr_diff_lines(workspace, repo_slug, pr_id)
+    if commit is None or diff is None:
+        return False
+    try:
+        paths = sorted({line[6:] for line in diff if line.startswith('+++ b/')})
+    finally:
+        diff.close()
+    contents = client.get_file_contents(workspace, repo_slug, commit, paths)
+    ok = all(content is not None for content in contents.values())
+    if mode == 'inline':
+        _, not_posted = writer.post(workspace, repo_slug, pr_id, inline_groups(server, pr_id, findings))
+        ok = ok and not not_posted
+    comment = "# AI Code Review\n\n" + "- **medium** finding\n" * findings
+    return client.add_pr_comment(workspace, repo_slug, pr_id, comment) and ok
+
+
+def run(setup, mode, args):
+    from services.bitbucket_client import BitbucketClient, RateLimiter
+    from services.comment_writer import InlineCommentWriter
+
+    server = FakeBitbucketServer(latency=args.latency, files=args.files, rate_limit=args.rate,
+                                 rate_burst=args.burst).start()
+    try:
+        limiter = RateLimiter(rate=args.rate * 0.9 if setup == 'limiter' else 0, burst=args.burst)
+        client = BitbucketClient(server.url, limiter=limiter, max_retries=0 if setup == 'single_request' else 6)
+        writer = InlineCommentWriter(client, max_comments=args.findings, interval=args.interval)
+        results = []
+        lock = threading.Lock()
+
+        def worker(pr_id):
+            try:
+                ok = review(client, writer, server, pr_id, mode, args.findings)
+            except Exception as e:
+                print(f"review of PR #{pr_id} failed: {e}", file=sys.stderr)
+                ok = False
+            with lock:
+                results.append(ok)
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(pr_id,)) for pr_id in range(1, args.reviews + 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        stats = server.stats()
+    finally:
+        server.stop()
+    return {
+        'setup': setup,
+        'comment_mode': mode,
+        'reviews_ok': sum(results),
+        'reviews_failed': len(results) - sum(results),
+        'requests': stats['requests'],
+        'rate_limited': stats['rate_limited'],
+        'comments': stats['comments'],
+        'inline_comments': stats['inline_comments'],
+        'seconds': round(elapsed, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--reviews', type=int, default=20)
+    parser.add_argument('--files', type=int, default=5, help="files per PR")
+    parser.add_argument('--findings', type=int, default=6, help="findings per review, posted inline in inline mode")
+    parser.add_argument('--rate', type=float, default=20, help="requests per second the fake server allows")
+    parser.add_argument('--burst', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--interval', type=float, default=0.05, help="INLINE_COMMENT_INTERVAL")
+    args = parser.parse_args()
+
+    import logging
+    logging.basicConfig(level=logging.CRITICAL)
+
+    runs = [run(setup, mode, args) for setup in ('single_request', 'retries', 'limiter')
+            for mode in ('summary', 'inline')]
+    for result in runs:
+        print(f"{result['setup']:>14} {result['comment_mode']:>7}: {result['reviews_ok']}/{args.reviews} reviews ok, "
+              f"{result['requests']} requests, {result['rate_limited']} rate limited, {result['seconds']}s",
+              file=sys.stderr)
+    print(json.dumps({'reviews': args.reviews, 'server_rate': args.rate, 'server_burst': args.burst,
+                      'runs': runs}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Prompt tokens of hunks with enclosing-scope context vs. bare hunks and whole files.
+
+Takes the source files under `--path` (this repository's app/ by
+default), fakes `--hunks` small hunks spread over each, and compares
+the estimated prompt tokens of the bare hunks, the hunks with extracted
+context and the whole files. Extraction is timed cold and with the
+outline cache warm.
+
+Usage: python benchmarks/bench_context.py [--path app] [--hunks 2] [--budget 250]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+EXTENSIONS = ('.py', '.js', '.ts', '.go', '.java')
+
+
+def load_files(root):
+    files = []
+    for directory, _, names in os.walk(root):
+        for name in sorted(names):
+            if name.endswith(EXTENSIONS):
+                path = os.path.join(directory, name)
+                with open(path, encoding='utf-8', errors='replace') as f:
+                    files.append((os.path.relpath(path, root), f.read()))
+    return files
+
+
+def fake_hunks(content, count):
+    """`count` evenly spread three-line hunks, each changing its middle line"""
+    lines = content.split('\n')
+    hunks = []
+    every = max(len(lines) // (count + 1), 4)
+    for start in range(every, len(lines) - 3, every)[:count]:
+        changed = lines[start + 1]
+        hunks.append({'new_start': start + 1, 'new_lines': 3, 'header': f"@@ -{start + 1},3 +{start + 1},3 @@",
+                      'lines': [f"-{changed}", f"+{changed}  # changed"]})
+    return hunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--path', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+    parser.add_argument('--hunks', type=int, default=2, help="fake hunks per file")
+    parser.add_argument('--budget', type=int, default=250, help="CONTEXT_TOKEN_BUDGET")
+    args = parser.parse_args()
+
+    from services.context_extractor import ContextExtractor
+    from services.prompt_planner import estimate_tokens
+
+    sources = load_files(args.path)
+    files = [{'path': path, 'content': content, 'hunks': fake_hunks(content, args.hunks)} for path, content in sources]
+    hunk_count = sum(len(file_info['hunks']) for file_info in files)
+    bare = sum(estimate_tokens('\n'.join(hunk['lines'])) for file_info in files for hunk in file_info['hunks'])
+    whole = sum(estimate_tokens(file_info['content']) for file_info in files if file_info['hunks'])
+
+    extractor = ContextExtractor(token_budget=args.budget)
+    started = time.perf_counter()
+    extractor.add_hunk_context(files)
+    cold = time.perf_counter() - started
+    started = time.perf_counter()
+    context_tokens = extractor.add_hunk_context(files)
+    warm = time.perf_counter() - started
+
+    report = {
+        'files': len(files),
+        'hunks': hunk_count,
+        'context_token_budget': args.budget,
+        'tokens_bare_hunks': bare,
+        'tokens_with_context': bare + context_tokens,
+        'tokens_whole_files': whole,
+        'context_share_of_whole_files': round((bare + context_tokens) / whole, 3) if whole else None,
+        'extract_cold_ms': round(cold * 1000, 1),
+        'extract_warm_ms': round(warm * 1000, 1)
+    }
+    print(f"{hunk_count} hunks in {len(files)} files: bare {bare} tokens, with context {bare + context_tokens}, "
+          f"whole files {whole}; extraction {report['extract_cold_ms']}ms cold, {report['extract_warm_ms']}ms warm",
+          file=sys.stderr)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""Peak memory of diff parsing: whole diff in memory vs. streamed line by line.
+
+Builds synthetic multi-MB diffs with a growing number of large files of the
+same size. With streaming, peak memory should stay flat as the diff grows,
+since only the file being parsed (capped at MAX_FILE_DIFF_SIZE) is held.
+
+Usage: python benchmarks/bench_diff_parser.py [--file-mb 2] [--files 1,2,4,8]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from controllers.pr_review import parse_diff
+
+
+def write_synthetic_diff(path, large_files, file_bytes, small_files=200):
+    """Write a diff with `large_files` files of about `file_bytes` each plus many small ones"""
+    line = "+    result = compute_value(alpha, beta, gamma) + offset  # generated\n"
+    lines_per_large = max(1, file_bytes // len(line))
+    with open(path, 'w') as f:
+        for i in range(large_files):
+            f.write(f"diff --git a/gen/big_{i}.py b/gen/big_{i}.py\n"
+                    f"index 0000000..1111111 100644\n--- a/gen/big_{i}.py\n+++ b/gen/big_{i}.py\n"
+                    f"@@ -0,0 +1,{lines_per_large} @@\n")
+            f.write(line * lines_per_large)
+        for i in range(small_files):
+            f.write(f"diff --git a/src/small_{i}.py b/src/small_{i}.py\n"
+                    f"index 0000000..1111111 100644\n--- a/src/small_{i}.py\n+++ b/src/small_{i}.py\n"
+                    f"@@ -10,3 +10,4 @@ def handler():\n     value = 1\n-    return value\n"
+                    f"+    checked = validate(value)\n+    return checked\n")
+    return os.path.getsize(path)
+
+
+def measure(func):
+    tracemalloc.start()
+    started = time.perf_counter()
+    files = func()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(files), peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--file-mb', type=float, default=2.0, help="size of each large file's diff")
+    parser.add_argument('--files', default='1,2,4,8', help="numbers of large files to try")
+    args = parser.parse_args()
+
+    report = {'large_file_bytes': int(args.file_mb * 1024 * 1024), 'runs': []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in [int(value) for value in args.files.split(',')]:
+            path = os.path.join(tmp, f"synthetic_{count}.diff")
+            diff_bytes = write_synthetic_diff(path, count, report['large_file_bytes'])
+
+            def buffered():
+                with open(path) as f:
+                    return parse_diff(f.read())
+
+            def streamed():
+                with open(path) as f:
+                    return parse_diff(f)
+
+            files, buffered_peak, buffered_seconds = measure(buffered)
+            _, streamed_peak, streamed_seconds = measure(streamed)
+            run = {
+                'large_files': count,
+                'diff_bytes': diff_bytes,
+                'parsed_files': files,
+                'buffered_peak_bytes': buffered_peak,
+                'streamed_peak_bytes': streamed_peak,
+                'buffered_seconds': round(buffered_seconds, 3),
+                'streamed_seconds': round(streamed_seconds, 3)
+            }
+            report['runs'].append(run)
+            print(f"diff={diff_bytes / 1e6:6.1f} MB  files={files:<4} "
+                  f"peak buffered={buffered_peak / 1e6:6.1f} MB  streamed={streamed_peak / 1e6:6.2f} MB  "
+                  f"time buffered={buffered_seconds:.2f}s streamed={streamed_seconds:.2f}s", file=sys.stderr)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""Bitbucket REST reads vs. a local git mirror for the diff and file contents of a PR.
+
+A local bare repository (served over file://) gets a PR with `--files`
+changed files, and the fake Bitbucket reports its real commits. Each
+review streams and parses the diff and reads every changed file, first
+through the REST API, then through GitMirrorSource: the first mirror
+review clones, the second finds everything locally, and the third fetches
+one new commit incrementally.
+
+Usage: python benchmarks/bench_git_source.py [--files 50] [--latency 0.05]
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bitbucket import FakeBitbucketServer
+
+WORKSPACE = 'bench'
+REPO_SLUG = 'service'
+
+
+def git(*args, cwd=None):
+    return subprocess.run(['git'] + list(args), cwd=cwd, check=True, capture_output=True,
+                          text=True).stdout.strip()
+
+
+def write_files(work_tree, count, revision):
+    for i in range(count):
+        path = os.path.join(work_tree, 'src', f"module_{i}.py")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            for n in range(200):
+                value = f"{n} + {revision}" if n % 20 == 0 else str(n)
+                f.write(f"def function_{n}(argument):\n    return argument * {value}\n\n")
+
+
+def create_repository(root, files):
+    """Create origin/<workspace>/<slug>.git with a base commit on main and a PR commit on feature"""
+    work_tree = os.path.join(root, 'work')
+    origin = os.path.join(root, 'origin', WORKSPACE, f"{REPO_SLUG}.git")
+    git('init', '--quiet', '--initial-branch=main', work_tree)
+    git('config', 'user.email', 'bench@example.com', cwd=work_tree)
+    git('config', 'user.name', 'bench', cwd=work_tree)
+    write_files(work_tree, files, 0)
+    git('add', '.', cwd=work_tree)
+    git('commit', '--quiet', '-m', 'base', cwd=work_tree)
+    git('checkout', '--quiet', '-b', 'feature', cwd=work_tree)
+    write_files(work_tree, files, 1)
+    git('commit', '--quiet', '-am', 'change', cwd=work_tree)
+    git('clone', '--quiet', '--bare', work_tree, origin)
+    return work_tree, origin
+
+
+def review(source):
+    from services.diff_parser import iter_diff_files
+
+    started = time.perf_counter()
+    diff_lines = source.iter_pr_diff_lines(WORKSPACE, REPO_SLUG, 1)
+    try:
+        files = list(iter_diff_files(diff_lines))
+    finally:
+        diff_lines.close()
+    commit = source.get_source_commit(WORKSPACE, REPO_SLUG, 1)
+    contents = source.get_file_contents(WORKSPACE, REPO_SLUG, commit, [f['path'] for f in files])
+    return {
+        'seconds': round(time.perf_counter() - started, 3),
+        'files': len(files),
+        'contents': sum(1 for content in contents.values() if content)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per fake Bitbucket request")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='bench-git-')
+    os.environ['PR_METADATA_TTL'] = '0'
+    from services.bitbucket_client import BitbucketClient
+    from services.git_source import GitMirrorSource
+
+    work_tree, origin = create_repository(root, args.files)
+    server = FakeBitbucketServer(latency=args.latency, files=args.files).start()
+    server.pull_requests[(f"{WORKSPACE}/{REPO_SLUG}", 1)] = (git('rev-parse', 'feature', cwd=work_tree),
+                                                            git('rev-parse', 'main', cwd=work_tree))
+    report = {'files': args.files, 'latency': args.latency, 'runs': []}
+
+    def record(name, source):
+        before = server.stats()['requests']
+        run = dict(review(source), source=name, api_requests=server.stats()['requests'] - before)
+        report['runs'].append(run)
+        print(f"{name:<22} {run['seconds']:7.3f}s  files={run['files']} contents={run['contents']} "
+              f"api_requests={run['api_requests']}", file=sys.stderr)
+
+    record('api', BitbucketClient(server.url))
+    mirror = GitMirrorSource(BitbucketClient(server.url), mirror_dir=os.path.join(root, 'mirrors'),
+                             url_template=f"file://{root}/origin/{{workspace}}/{{repo_slug}}.git")
+    record('git (clone)', mirror)
+    record('git (cached)', mirror)
+
+    write_files(work_tree, args.files, 2)
+    git('commit', '--quiet', '-am', 'follow-up', cwd=work_tree)
+    git('push', '--quiet', origin, 'feature', cwd=work_tree)
+    server.pull_requests[(f"{WORKSPACE}/{REPO_SLUG}", 1)] = (git('rev-parse', 'feature', cwd=work_tree),
+                                                            git('rev-parse', 'main', cwd=work_tree))
+    record('git (fetch new commit)', mirror)
+
+    server.stop()
+    shutil.rmtree(root, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
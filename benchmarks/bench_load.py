@@ -0,0 +1,233 @@
+"""End-to-end load test of the review service against fake Bitbucket and Ollama servers.
+
+Webhook payloads are replayed against the /pr-review blueprint at a fixed
+rate and each resulting job is followed until it finishes. The fake
+servers run in a child process, so the peak RSS reported is the service's
+own. Payloads come from a JSONL file (one Bitbucket webhook body per line,
+or {"event_key": ..., "payload": {...}}), or are generated, one PR each.
+
+Usage: python benchmarks/bench_load.py [--requests 20] [--rate 5] [--payloads events.jsonl] [--output run.json]
+"""
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bitbucket import FakeBitbucketServer, commit_hash
+from fake_ollama import FakeOllamaServer
+
+TERMINAL_STATES = ('done', 'failed', 'cancelled')
+DEFAULT_EVENT_KEY = 'pullrequest:updated'
+
+
+def run_fakes(args, urls, stop):
+    bitbucket = FakeBitbucketServer(latency=args.bitbucket_latency, files=args.files,
+                                    hunks=args.hunks, lines=args.lines).start()
+    ollama = FakeOllamaServer(latency=args.latency, tokens=args.tokens, tokens_per_second=args.token_rate,
+                              parallel=args.parallel).start()
+    urls.put((bitbucket.url, ollama.url))
+    stop.wait()
+    bitbucket.stop()
+    ollama.stop()
+
+
+def fetch_stats(url):
+    with urllib.request.urlopen(f"{url}/_stats", timeout=5) as response:
+        return json.load(response)
+
+
+def synthetic_payloads(count, repositories):
+    events = []
+    for i in range(count):
+        repo_full_name = f"bench/repo-{i % repositories}"
+        pr_id = i + 1
+        events.append((DEFAULT_EVENT_KEY, {'pullrequest': {
+            'id': pr_id,
+            'source': {'commit': {'hash': commit_hash(repo_full_name, pr_id)}},
+            'destination': {'repository': {'full_name': repo_full_name}}
+        }}))
+    return events
+
+
+def load_payloads(path, limit):
+    events = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'payload' in record:
+                events.append((record.get('event_key', DEFAULT_EVENT_KEY), record['payload']))
+            elif 'pullrequest' in record:
+                events.append((DEFAULT_EVENT_KEY, record))
+    return events[:limit] if limit else events
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+    return {'p50': rank(50), 'p95': rank(95), 'p99': rank(99), 'max': values[-1],
+            'mean': round(sum(values) / len(values), 1), 'count': len(values)}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--payloads', help="JSONL file of webhook payloads to replay")
+    parser.add_argument('--requests', type=int, default=20, help="generated events, or a limit on replayed ones")
+    parser.add_argument('--rate', type=float, default=5.0, help="webhook events per second (0 = all at once)")
+    parser.add_argument('--repositories', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=2, help="JOB_WORKER_CONCURRENCY")
+    parser.add_argument('--cache', action='store_true', help="enable the hunk review cache")
+    parser.add_argument('--files', type=int, default=5, help="files per generated PR diff")
+    parser.add_argument('--hunks', type=int, default=2, help="hunks per file")
+    parser.add_argument('--lines', type=int, default=12, help="lines per hunk")
+    parser.add_argument('--bitbucket-latency', type=float, default=0.02)
+    parser.add_argument('--parallel', type=int, default=4, help="generations the fake Ollama runs at once")
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument('--tokens', type=int, default=60)
+    parser.add_argument('--token-rate', type=float, default=200.0)
+    parser.add_argument('--timeout', type=float, default=600.0, help="seconds to wait for all jobs")
+    parser.add_argument('--output', help="also write the JSON report to this file")
+    parser.add_argument('--log-level', default='WARNING', help="log level of the service under test")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # Fork the fake servers before the service starts any threads
+    context = multiprocessing.get_context('fork')
+    urls = context.Queue()
+    stop = context.Event()
+    fakes = context.Process(target=run_fakes, args=(args, urls, stop), daemon=True)
+    fakes.start()
+    bitbucket_url, ollama_url = urls.get(timeout=30)
+
+    workdir = tempfile.mkdtemp(prefix='bench-load-')
+    host, port = ollama_url.rsplit('/', 1)[-1].split(':')
+    os.environ.update({
+        'BITBUCKET_API_BASE': bitbucket_url,
+        'OLLAMA_HOST': host,
+        'OLLAMA_PORT': port,
+        'JOB_DB_PATH': os.path.join(workdir, 'jobs.db'),
+        'JOB_WORKER_CONCURRENCY': str(args.workers),
+        'REVIEW_CACHE_DIR': os.path.join(workdir, 'review-cache'),
+        'REVIEW_CACHE_ENABLED': 'true' if args.cache else 'false',
+        'REVIEW_DEBOUNCE_SECONDS': '0',
+        'STAGE_RETRY_BACKOFF': '0.1'
+    })
+
+    from flask import Flask
+    from routes.pr_review import pr_review_bp
+    from controllers.pr_review import get_job_queue, get_job_status
+    from services.backend_pool import GENERATIONS
+
+    app = Flask(__name__)
+    app.register_blueprint(pr_review_bp)
+    client = app.test_client()
+
+    if args.payloads:
+        events = load_payloads(args.payloads, args.requests)
+    else:
+        events = synthetic_payloads(args.requests, args.repositories)
+    rss_before = peak_rss_mb()
+
+    submitted_at = {}
+    outcomes = {}
+    started = time.time()
+    for i, (event_key, payload) in enumerate(events):
+        if args.rate > 0:
+            delay = started + i / args.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        sent = time.time()
+        response = client.post('/pr-review', json=payload, headers={'X-Event-Key': event_key})
+        body = response.get_json() or {}
+        outcome = body.get('outcome') or f"http_{response.status_code}"
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        if body.get('job_id'):
+            submitted_at.setdefault(body['job_id'], sent)
+    submit_seconds = time.time() - started
+
+    statuses = {}
+    deadline = time.time() + args.timeout
+    while len(statuses) < len(submitted_at) and time.time() < deadline:
+        for job_id in submitted_at:
+            if job_id not in statuses:
+                status = get_job_status(job_id)
+                if status and status['status'] in TERMINAL_STATES:
+                    statuses[job_id] = status
+        time.sleep(0.05)
+    elapsed = time.time() - started
+
+    latencies = [round((status['finished_at'] - submitted_at[job_id]) * 1000, 1)
+                 for job_id, status in statuses.items() if status['status'] == 'done']
+    stage_durations = {}
+    for status in statuses.values():
+        for stage in status['stages']:
+            stage_durations.setdefault(stage['name'], []).append(stage['duration_ms'])
+    states = {}
+    for status in statuses.values():
+        states[status['status']] = states.get(status['status'], 0) + 1
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'events': len(events),
+        'submit_outcomes': outcomes,
+        'submit_seconds': round(submit_seconds, 3),
+        'jobs': len(submitted_at),
+        'job_states': states,
+        'unfinished_jobs': len(submitted_at) - len(statuses),
+        'seconds': round(elapsed, 3),
+        'throughput_jobs_per_second': round(states.get('done', 0) / elapsed, 3) if elapsed else None,
+        'latency_ms': percentiles(latencies),
+        'queue_wait_ms': percentiles([status['queue_wait_ms'] for status in statuses.values()
+                                      if status['queue_wait_ms'] is not None]),
+        'stages_ms': {name: percentiles(values) for name, values in stage_durations.items()},
+        # Model calls that got no answer; reviews can still finish without them, so check this too
+        'model_calls': {'ok': GENERATIONS.value(result='ok'), 'failed': GENERATIONS.value(result='failed')},
+        'rss_before_replay_mb': rss_before,
+        'peak_rss_mb': peak_rss_mb(),
+        'bitbucket': fetch_stats(bitbucket_url),
+        'ollama': fetch_stats(ollama_url)
+    }
+
+    get_job_queue().stop(timeout=5)
+    stop.set()
+    fakes.join(5)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    latency = report['latency_ms'] or {}
+    print(f"{states.get('done', 0)}/{len(submitted_at)} jobs done in {elapsed:.2f}s, "
+          f"{report['throughput_jobs_per_second']} jobs/s, latency p50={latency.get('p50')}ms "
+          f"p95={latency.get('p95')}ms p99={latency.get('p99')}ms, peak RSS {report['peak_rss_mb']}MB, "
+          f"{report['model_calls']['failed']} failed model calls", file=sys.stderr)
+    if report['model_calls']['failed']:
+        print(f"WARNING: {report['model_calls']['failed']} model calls failed", file=sys.stderr)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
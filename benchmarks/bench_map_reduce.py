@@ -0,0 +1,99 @@
+"""Coverage, wall-clock time and comment size of full vs. map-reduce reviews of a large PR.
+
+A generated PR of `--files` files is reviewed against a fake Ollama server
+twice: in full mode (risk-selected files within REVIEW_TOKEN_BUDGET, one
+free-form analysis per hunk) and in map-reduce mode (every file, compact
+findings merged into one ranked list plus one summary call). Every hunk
+gets the same canned finding, so the reduce step merges them into one.
+
+Usage: python benchmarks/bench_map_reduce.py [--files 200] [--parallel 4] [--time-budget 300]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_ollama import FakeOllamaServer
+
+MODEL = 'bench-coder'
+
+
+def synthetic_diff(count, hunks=2, lines=20):
+    chunks = []
+    for i in range(count):
+        path = f"src/service_{i}/handlers.py"
+        chunks.append(f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n")
+        for h in range(hunks):
+            start = 1 + h * lines * 3
+            chunks.append(f"@@ -{start},{lines} +{start},{lines} @@ def handler_{h}(request):\n")
+            for n in range(lines):
+                chunks.append(f"-    value_{n} = request.args['{n}']\n+    value_{n} = request.args.get('{n}', {i})\n")
+    return ''.join(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--parallel', type=int, default=4, help="generations the fake server runs at once")
+    parser.add_argument('--latency', type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument('--token-rate', type=float, default=400.0)
+    parser.add_argument('--time-budget', type=float, default=300.0, help="MAP_REDUCE_TIME_BUDGET")
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(latency=args.latency, tokens_per_second=args.token_rate, parallel=args.parallel,
+                              response_text='medium L3: request.args.get() hides missing parameters; validate them.')
+    server.pulled_models.add(MODEL)
+    server.start()
+    host, port = server.httpd.server_address[:2]
+    os.environ.update({
+        'OLLAMA_HOST': host,
+        'OLLAMA_PORT': str(port),
+        'MODEL_NAME': MODEL,
+        'REVIEW_CACHE_ENABLED': 'false'
+    })
+
+    from controllers.pr_review import (analyze_files, format_analysis_results, map_findings, parse_diff,
+                                       reduce_review, select_files_to_analyze, MAX_COMMENT_LENGTH)
+
+    changed_files = parse_diff(synthetic_diff(args.files))
+    report = {'files': len(changed_files), 'server_parallel': args.parallel,
+              'max_comment_length': MAX_COMMENT_LENGTH, 'runs': []}
+
+    def record(mode, review):
+        before = server.stats()['requests']
+        started = time.perf_counter()
+        covered, comment = review()
+        run = {
+            'mode': mode,
+            'seconds': round(time.perf_counter() - started, 3),
+            'files_covered': covered,
+            'model_requests': server.stats()['requests'] - before,
+            'comment_chars': len(comment)
+        }
+        report['runs'].append(run)
+        print(f"{mode:<11} {run['seconds']:7.3f}s  covered={covered}/{len(changed_files)} "
+              f"requests={run['model_requests']} comment={run['comment_chars']} chars", file=sys.stderr)
+
+    def full():
+        selected = select_files_to_analyze(changed_files, 'bench/monorepo')
+        results = analyze_files(selected)
+        return len(results), format_analysis_results(results, selected)
+
+    def map_reduce():
+        selected = select_files_to_analyze(changed_files, 'bench/monorepo', map_reduce=True)
+        mapped = map_findings(selected, time_budget=args.time_budget)
+        return len(mapped['reviewed']), reduce_review(mapped, len(changed_files))
+
+    record('full', full)
+    record('map_reduce', map_reduce)
+
+    server.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Cost of the local pre-filter and the model requests it saves on a mixed PR.
+
+Generates a diff of `--files` files in which each file is, in turn, a
+real code change, a re-indented/re-spaced change, a comment-only edit,
+an import reorder, a minified bundle or a vendored file, and reports how
+long the pre-filter takes and how many hunks and packed model requests
+remain afterwards.
+
+Usage: python benchmarks/bench_prefilter.py [--files 600]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+KINDS = ['code', 'whitespace', 'comment', 'imports', 'minified', 'vendored']
+
+
+def file_diff(i, kind):
+    path = {'minified': f"static/bundle_{i}.min.js", 'vendored': f"vendor/lib_{i}/util.js"}.get(kind, f"src/mod_{i}.js")
+    lines = []
+    for n in range(10):
+        if kind == 'code':
+            lines += [f"-  total += item{n}.price;", f"+  total += item{n}.price * item{n}.quantity;"]
+        elif kind == 'whitespace':
+            lines += [f"-  total+=item{n}.price;", f"+  total += item{n}.price;"]
+        elif kind == 'comment':
+            lines += [f"-  // price of item {n}", f"+  // net price of item {n}"]
+        elif kind == 'imports':
+            lines += [f"-import {{ a{n} }} from './a{n}';"]
+        else:
+            lines += [f"+var a{n}=function(b){{return b*{n}}};" * 10]
+    if kind == 'imports':
+        lines += [f"+import {{ a{n} }} from './a{n}';" for n in reversed(range(10))]
+    return (f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n@@ -1,10 +1,10 @@ function total() {{\n"
+            + '\n'.join(lines) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=600)
+    args = parser.parse_args()
+
+    from controllers.pr_review import collect_review_units, parse_diff
+    from services.prefilter import prefilter
+    from services.prompt_planner import plan_batches
+
+    diff = ''.join(file_diff(i, KINDS[i % len(KINDS)]) for i in range(args.files))
+    files = parse_diff(diff)
+    _, units_before = collect_review_units(files, None)
+    requests_before = len(plan_batches(units_before))
+
+    started = time.perf_counter()
+    kept, skipped = prefilter(files)
+    elapsed = time.perf_counter() - started
+    _, units_after = collect_review_units(kept, None)
+    requests_after = len(plan_batches(units_after))
+
+    report = {
+        'files': len(files),
+        'prefilter_ms': round(elapsed * 1000, 2),
+        'kept_files': len(kept),
+        'skipped': skipped,
+        'hunks_before': len(units_before),
+        'hunks_after': len(units_after),
+        'model_requests_before': requests_before,
+        'model_requests_after': requests_after
+    }
+    print(f"pre-filter {report['prefilter_ms']}ms for {len(files)} files: hunks {len(units_before)} -> "
+          f"{len(units_after)}, model requests {requests_before} -> {requests_after}", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
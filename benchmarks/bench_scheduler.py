@@ -0,0 +1,125 @@
+"""Review latency of small PRs during a burst of large monorepo PRs, with and without the scheduler.
+
+`--large` reviews of `--large-files` files each from one monorepo start
+at once against a fake Ollama server; `--delay` seconds later `--small`
+reviews of `--small-files` files from other repositories arrive. Each
+review runs like a job: registered with the scheduler, sized by its
+selected files, analyzed with ANALYSIS_CONCURRENCY requests in flight.
+Without the scheduler every request queues on the server's slots in
+arrival order, which is how reviews compete for the model today.
+
+Usage: python benchmarks/bench_scheduler.py [--large 3] [--large-files 40] [--small 5] [--parallel 2]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_ollama import FakeOllamaServer
+
+MODEL = 'bench-coder'
+
+
+def synthetic_diff(prefix, count, lines=20):
+    chunks = []
+    for i in range(count):
+        path = f"{prefix}/module_{i}.py"
+        chunks.append(f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n")
+        chunks.append(f"@@ -1,{lines} +1,{lines} @@ def handler(request):\n")
+        for n in range(lines):
+            chunks.append(f"-    value_{n} = request.args['{n}']\n+    value_{n} = request.args.get('{n}', {i})\n")
+    return ''.join(chunks)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--large', type=int, default=3, help="large monorepo reviews")
+    parser.add_argument('--large-files', type=int, default=40)
+    parser.add_argument('--small', type=int, default=5, help="small reviews from other repositories")
+    parser.add_argument('--small-files', type=int, default=1)
+    parser.add_argument('--delay', type=float, default=0.5, help="seconds after the burst the small reviews arrive")
+    parser.add_argument('--parallel', type=int, default=2, help="generations the fake server runs at once")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds before the first token")
+    parser.add_argument('--token-rate', type=float, default=400.0)
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(latency=args.latency, tokens_per_second=args.token_rate, parallel=args.parallel,
+                              response_text='No issues found in this change.')
+    server.pulled_models.add(MODEL)
+    server.start()
+    host, port = server.httpd.server_address[:2]
+    os.environ.update({
+        'OLLAMA_HOST': host,
+        'OLLAMA_PORT': str(port),
+        'MODEL_NAME': MODEL,
+        'REVIEW_CACHE_ENABLED': 'false',
+        'MAX_HUNKS_PER_REQUEST': '2',
+        'ANALYSIS_CONCURRENCY': '4'
+    })
+
+    from controllers import pr_review
+    from services.file_scoring import estimate_file_tokens
+    from services.scheduler import ReviewScheduler
+
+    large = pr_review.parse_diff(synthetic_diff('monorepo', args.large_files))
+    small = pr_review.parse_diff(synthetic_diff('service', args.small_files))
+    report = {'large_reviews': args.large, 'large_files': len(large), 'small_reviews': args.small,
+              'small_files': len(small), 'server_parallel': args.parallel, 'runs': []}
+
+    def review(scheduler, job_id, repo, files, durations):
+        started = time.perf_counter()
+        if scheduler is None:
+            pr_review.analyze_files(files)
+        else:
+            with scheduler.track(job_id, repo):
+                scheduler.set_job_size(sum(estimate_file_tokens(file_info) for file_info in files))
+                pr_review.analyze_files(files)
+        durations.append(time.perf_counter() - started)
+
+    for mode in ('fifo', 'scheduler'):
+        scheduler = ReviewScheduler(args.parallel) if mode == 'scheduler' else None
+        pr_review._scheduler = scheduler
+        pr_review.SCHEDULER_ENABLED = scheduler is not None
+        large_durations, small_durations = [], []
+        started = time.perf_counter()
+        threads = [threading.Thread(target=review, args=(scheduler, f"large-{i}", 'acme/monorepo', large, large_durations))
+                   for i in range(args.large)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.delay)
+        small_threads = [threading.Thread(target=review, args=(scheduler, f"small-{i}", f"team-{i}/service", small,
+                                                                small_durations))
+                         for i in range(args.small)]
+        for thread in small_threads:
+            thread.start()
+        for thread in threads + small_threads:
+            thread.join()
+        run = {
+            'mode': mode,
+            'seconds': round(time.perf_counter() - started, 3),
+            'small_p50_s': round(statistics.median(small_durations), 3),
+            'small_max_s': round(max(small_durations), 3),
+            'large_p50_s': round(statistics.median(large_durations), 3),
+            'large_max_s': round(percentile(large_durations, 1.0), 3)
+        }
+        report['runs'].append(run)
+        print(f"{mode:<9} total={run['seconds']:.2f}s small p50={run['small_p50_s']:.2f}s max={run['small_max_s']:.2f}s "
+              f"large p50={run['large_p50_s']:.2f}s max={run['large_max_s']:.2f}s", file=sys.stderr)
+
+    server.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
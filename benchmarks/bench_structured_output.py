@@ -0,0 +1,104 @@
+"""Generated tokens, per-file latency and finding coverage of free-form vs. structured (JSON) reviews.
+
+A generated PR of `--files` files, one in `--issue-every` of them with an
+eval() call, is reviewed in full mode against a fake Ollama server twice:
+with REVIEW_OUTPUT_FORMAT=text (a free-form paragraph per hunk with an
+issue, a short clean note per other hunk, num_predict sized by
+FREE_TEXT_TOKENS_PER_HUNK) and with REVIEW_OUTPUT_FORMAT=json (schema
+findings only for hunks with an issue, num_predict sized to the batch).
+Coverage counts the files with an issue that the review reports.
+
+Usage: python benchmarks/bench_structured_output.py [--files 60] [--issue-every 3] [--parallel 4]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_ollama import FakeOllamaServer
+
+MODEL = 'bench-coder'
+ISSUE_MARKER = 'eval('
+PROSE = ("This hunk passes request data straight to eval(), which lets any caller run arbitrary code on the server. "
+         "The values come from the query string and are not validated anywhere before this point, so a crafted "
+         "request is enough to exploit it. Consider parsing the value with ast.literal_eval or, better, mapping "
+         "the allowed options explicitly and rejecting everything else with a 400 response. It would also be "
+         "worth adding a test that sends an unexpected value and checks that it is rejected.")
+FINDING = "eval() on request data allows code execution; parse with ast.literal_eval or an explicit allow-list."
+
+
+def synthetic_diff(count, issue_every, hunks=2, lines=6):
+    chunks = []
+    for i in range(count):
+        path = f"src/service_{i}/handlers.py"
+        chunks.append(f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n")
+        for h in range(hunks):
+            start = 1 + h * lines * 3
+            chunks.append(f"@@ -{start},{lines} +{start},{lines} @@ def handler_{h}(request):\n")
+            for n in range(lines):
+                value = f"eval(request.args['{n}'])" if i % issue_every == 0 and h == 0 and n == 2 else f"request.args.get('{n}')"
+                chunks.append(f"-    value_{n} = request.args['{n}']\n+    value_{n} = {value}\n")
+    return ''.join(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=60)
+    parser.add_argument('--issue-every', type=int, default=3, help="every n-th file has an issue")
+    parser.add_argument('--parallel', type=int, default=4, help="generations the fake server runs at once")
+    parser.add_argument('--latency', type=float, default=0.1, help="seconds before the first token")
+    parser.add_argument('--token-rate', type=float, default=400.0)
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(latency=args.latency, tokens_per_second=args.token_rate, parallel=args.parallel,
+                              response_text=PROSE, finding_text=FINDING, issue_marker=ISSUE_MARKER, severity='critical')
+    server.pulled_models.add(MODEL)
+    server.start()
+    host, port = server.httpd.server_address[:2]
+    os.environ.update({
+        'OLLAMA_HOST': host,
+        'OLLAMA_PORT': str(port),
+        'MODEL_NAME': MODEL,
+        'REVIEW_CACHE_ENABLED': 'false'
+    })
+
+    from controllers import pr_review
+
+    changed_files = pr_review.parse_diff(synthetic_diff(args.files, args.issue_every))
+    issue_files = {file_info['path'] for file_info in changed_files if ISSUE_MARKER in file_info['changes']}
+    report = {'files': len(changed_files), 'files_with_issues': len(issue_files), 'runs': []}
+
+    for output_format in ('text', 'json'):
+        pr_review.REVIEW_OUTPUT_FORMAT = output_format
+        pr_review.STRUCTURED_OUTPUT = output_format == 'json'
+        before = server.stats()
+        started = time.perf_counter()
+        results = pr_review.analyze_files(changed_files, concurrency=args.parallel)
+        seconds = time.perf_counter() - started
+        after = server.stats()
+        comment = pr_review.format_analysis_results(results, changed_files)
+        found = {result['file_path'] for result in results if 'eval' in result['analysis']}
+        run = {
+            'output_format': output_format,
+            'seconds': round(seconds, 3),
+            'ms_per_file': round(seconds * 1000 / len(changed_files), 1),
+            'model_requests': after['requests'] - before['requests'],
+            'generated_tokens': after['generated_tokens'] - before['generated_tokens'],
+            'generated_tokens_per_file': round((after['generated_tokens'] - before['generated_tokens']) / len(changed_files), 1),
+            'issue_files_covered': len(found & issue_files),
+            'comment_chars': len(comment)
+        }
+        report['runs'].append(run)
+        print(f"{output_format:<5} {run['ms_per_file']:7.1f} ms/file  {run['generated_tokens_per_file']:6.1f} tokens/file  "
+              f"covered={run['issue_files_covered']}/{len(issue_files)} requests={run['model_requests']}", file=sys.stderr)
+
+    server.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
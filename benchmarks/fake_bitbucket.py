@@ -0,0 +1,210 @@
+"""Local stand-in for the Bitbucket REST API, for benchmarks.
+
+Serves PR metadata, the PR diff and `src` file contents for any
+workspace/repo/PR, generated deterministically from the PR coordinates,
+and records posted comments, inline ones with their path and line.
+Response latency is configurable. With `rate_limit` set, requests beyond
+`rate_limit` per second (after a burst of `rate_burst`) are answered
+429 with a Retry-After header, like Bitbucket does. GET /_stats reports
+request, comment and rate-limited counts.
+Set `pull_requests[(repo_full_name, pr_id)] = (source, destination)` to
+report real commits, e.g. of a local git repository.
+"""
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PR_PATH_RE = re.compile(r'^/repositories/([^/]+)/([^/]+)/pullrequests/(\d+)(/diff|/comments)?$')
+SRC_PATH_RE = re.compile(r'^/repositories/([^/]+)/([^/]+)/src/([^/]+)/(.+)$')
+
+EXTENSIONS = ['.py', '.js', '.ts', '.go', '.java']
+
+
+def commit_hash(repo_full_name, pr_id, side='source'):
+    """Commit the fake reports for a PR; payloads built by the harness use the same"""
+    suffix = '' if side == 'source' else f"#{side}"
+    return hashlib.sha1(f"{repo_full_name}#{pr_id}{suffix}".encode()).hexdigest()
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    # Concurrent reviews open many connections at once; the default backlog of 5 resets some of them
+    request_queue_size = 128
+
+
+class FakeBitbucketServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.02, files=5, hunks=2, lines=12, rate_limit=0,
+                 rate_burst=10):
+        self.latency = latency
+        self.files = files
+        self.hunks = hunks
+        self.lines = lines
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self._tokens = float(rate_burst)
+        self._refilled = time.monotonic()
+        self.requests = 0
+        self.rate_limited = 0
+        self.comments = []
+        self.pull_requests = {}
+        self._lock = threading.Lock()
+        self.httpd = _HTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'rate_limited': self.rate_limited, 'comments': len(self.comments),
+                    'inline_comments': sum(1 for comment in self.comments if comment['inline'])}
+
+    def take_token(self):
+        """Count a request against the rate limit; returns None if allowed, else the seconds to Retry-After"""
+        with self._lock:
+            self.requests += 1
+            if not self.rate_limit:
+                return None
+            now = time.monotonic()
+            self._tokens = min(self.rate_burst, self._tokens + (now - self._refilled) * self.rate_limit)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return None
+            self.rate_limited += 1
+            return max(1, math.ceil((1 - self._tokens) / self.rate_limit))
+
+    def file_paths(self, repo_full_name, pr_id):
+        return [f"src/{repo_full_name.split('/')[-1]}/pr{pr_id}/module_{i}{EXTENSIONS[i % len(EXTENSIONS)]}"
+                for i in range(self.files)]
+
+    def diff(self, repo_full_name, pr_id):
+        """A unified diff with `files` files of `hunks` hunks each; lines are unique per PR"""
+        chunks = []
+        for path in self.file_paths(repo_full_name, pr_id):
+            chunks.append(f"diff --git a/{path} b/{path}\nindex 1111111..2222222 100644\n--- a/{path}\n+++ b/{path}\n")
+            for h in range(self.hunks):
+                start = 1 + h * (self.lines * 3)
+                chunks.append(f"@@ -{start},{self.lines} +{start},{self.lines + self.lines // 2} @@ def handler_{h}():\n")
+                for n in range(self.lines):
+                    if n % 2:
+                        chunks.append(f"-    value_{n} = compute({n})\n")
+                        chunks.append(f"+    value_{n} = compute({n}, pr={pr_id})\n")
+                    else:
+                        chunks.append(f"     context_{n} = load({n})\n")
+                for n in range(self.lines // 2):
+                    chunks.append(f"+    extra_{n} = validate(value_{n}, '{repo_full_name}#{pr_id}')\n")
+        return ''.join(chunks)
+
+    def file_content(self, commit, path):
+        return ''.join(f"line_{n} = '{commit[:8]}:{path}'\n" for n in range(self.lines * self.hunks * 3))
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately; don't let Nagle delay the body
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _send(self, status, body, content_type='application/json'):
+                data = body.encode() if isinstance(body, str) else body
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _begin(self):
+                """Account for a request; returns False after answering 429 when it is over the rate limit"""
+                retry_after = server.take_token()
+                if retry_after is not None:
+                    data = json.dumps({'type': 'error',
+                                       'error': {'message': 'Rate limit for this resource has been exceeded'}}).encode()
+                    self.send_response(429)
+                    self.send_header('Retry-After', str(retry_after))
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return False
+                if server.latency:
+                    time.sleep(server.latency)
+                return True
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/_stats':
+                    self._send(200, json.dumps(server.stats()))
+                    return
+                if not self._begin():
+                    return
+                match = PR_PATH_RE.match(path)
+                if match and match.group(4) in (None, '/diff'):
+                    workspace, slug, pr_id, suffix = match.groups()
+                    repo_full_name = f"{workspace}/{slug}"
+                    if suffix == '/diff':
+                        self._send(200, server.diff(repo_full_name, int(pr_id)), 'text/plain')
+                        return
+                    source, destination = server.pull_requests.get(
+                        (repo_full_name, int(pr_id)),
+                        (commit_hash(repo_full_name, int(pr_id)), commit_hash(repo_full_name, int(pr_id), 'destination')))
+                    self._send(200, json.dumps({
+                        'id': int(pr_id),
+                        'source': {'branch': {'name': f"feature/{pr_id}"}, 'commit': {'hash': source}},
+                        'destination': {'branch': {'name': 'main'}, 'commit': {'hash': destination},
+                                        'repository': {'full_name': repo_full_name}}
+                    }))
+                    return
+                match = SRC_PATH_RE.match(path)
+                if match:
+                    _, _, commit, file_path = match.groups()
+                    self._send(200, server.file_content(commit, file_path), 'text/plain')
+                    return
+                self._send(404, json.dumps({'error': 'not found'}))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                if not self._begin():
+                    return
+                match = PR_PATH_RE.match(self.path)
+                if not match or match.group(4) != '/comments':
+                    self._send(404, json.dumps({'error': 'not found'}))
+                    return
+                workspace, slug, pr_id, _ = match.groups()
+                with server._lock:
+                    server.comments.append({
+                        'repository': f"{workspace}/{slug}",
+                        'pr_id': int(pr_id),
+                        'length': len(body.get('content', {}).get('raw', '')),
+                        'inline': body.get('inline'),
+                        'posted_at': time.time()
+                    })
+                self._send(201, json.dumps({'id': len(server.comments)}))
+
+        return Handler
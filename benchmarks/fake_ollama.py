@@ -0,0 +1,207 @@
+"""Local stand-in for the Ollama HTTP API, for benchmarks.
+
+Serves /api/generate as NDJSON with a configurable first-token latency and
+token rate, and at most `parallel` generations at once (like
+OLLAMA_NUM_PARALLEL); further requests wait for a free slot. When the
+prompt contains [HUNK n] labels, the canned answer is repeated per label.
+With `issue_marker` set, only hunks containing it get the canned answer
+and the others a short clean one. Requests with a `format` are answered
+with findings JSON: one finding per hunk with an issue, at its first
+numbered added line. Generations of models that are not pulled are
+answered 404, like Ollama; `models` are pulled from the start.
+"""
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The service's default MODEL_NAME
+DEFAULT_MODEL = 'deepseek-coder-v2'
+HUNK_LABEL_RE = re.compile(r'^\[HUNK (\d+)\]', re.MULTILINE)
+ADDED_LINE_RE = re.compile(r'^\s*(\d+) \+', re.MULTILINE)
+
+
+class FakeOllamaServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.2, tokens_per_second=200.0,
+                 tokens=60, parallel=4, response_text='No issues found in this change.',
+                 issue_marker=None, clean_text='No issues found in this change.', severity='medium',
+                 finding_text=None, models=(DEFAULT_MODEL,)):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+        self.response_text = response_text
+        self.issue_marker = issue_marker
+        self.clean_text = clean_text
+        self.severity = severity
+        # Message of JSON findings; defaults to response_text
+        self.finding_text = finding_text or response_text
+        self.generated_tokens = 0
+        self.pulled_models = set(models)
+        self.loaded_models = set()
+        self.slots = threading.BoundedSemaphore(parallel)
+        self.requests = 0
+        self.max_in_flight = 0
+        # When set, /api/generate answers with this HTTP status, e.g. 503 to simulate a failing GPU node
+        self.error_status = None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'max_in_flight': self.max_in_flight,
+                    'generated_tokens': self.generated_tokens}
+
+    def hunk_sections(self, prompt):
+        """(label, section text, has issue) for each [HUNK n] section of a prompt"""
+        matches = list(HUNK_LABEL_RE.finditer(prompt))
+        sections = []
+        for i, match in enumerate(matches):
+            text = prompt[match.start():matches[i + 1].start() if i + 1 < len(matches) else len(prompt)]
+            has_issue = self.issue_marker is None or self.issue_marker in text
+            sections.append((match.group(1), text, has_issue))
+        return sections
+
+    def answer(self, request):
+        """Text of the full answer to a generate request, and its token count"""
+        sections = self.hunk_sections(request.get('prompt', ''))
+        if request.get('format'):
+            findings = []
+            for label, text, has_issue in sections:
+                if has_issue and not self.response_text.startswith('No issues'):
+                    line = ADDED_LINE_RE.search(text)
+                    findings.append({'hunk': int(label), 'severity': self.severity,
+                                     'line': int(line.group(1)) if line else 1, 'message': self.finding_text})
+            text = json.dumps({'has_issues': bool(findings), 'findings': findings})
+            return text, len(text.split(' '))
+        if sections:
+            text = '\n'.join(f"[HUNK {label}] {self.response_text if has_issue else self.clean_text}"
+                             for label, _, has_issue in sections)
+            return text, len(text.split(' '))
+        return self.response_text, self.tokens
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately; don't let Nagle delay the body
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _send_json(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/api/version':
+                    self._send_json(200, {'version': 'fake'})
+                elif self.path == '/api/tags':
+                    self._send_json(200, {'models': [{'name': name} for name in sorted(server.pulled_models)]})
+                elif self.path == '/api/ps':
+                    self._send_json(200, {'models': [{'name': name} for name in sorted(server.loaded_models)]})
+                elif self.path == '/_stats':
+                    self._send_json(200, server.stats())
+                else:
+                    self._send_json(404, {'error': 'not found'})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                if self.path == '/api/pull':
+                    server.pulled_models.add(request.get('name'))
+                    self._send_json(200, {'status': 'success'})
+                    return
+                if self.path != '/api/generate':
+                    self._send_json(404, {'error': 'not found'})
+                    return
+                if server.error_status:
+                    self._send_json(server.error_status, {'error': 'simulated failure'})
+                    return
+                model = request.get('model') or ''
+                if model not in server.pulled_models and model.split(':')[0] not in server.pulled_models:
+                    self._send_json(404, {'error': f"model '{model}' not found, try pulling it first"})
+                    return
+                server.loaded_models.add(request.get('model'))
+                if not request.get('prompt') and request.get('stream') is False:
+                    # Warm-up request: load the model without generating
+                    self._send_json(200, {'model': request.get('model'), 'response': '', 'done': True})
+                    return
+                with server.slots:
+                    with server._lock:
+                        server.requests += 1
+                        server._in_flight += 1
+                        server.max_in_flight = max(server.max_in_flight, server._in_flight)
+                    try:
+                        self._generate(request)
+                    finally:
+                        with server._lock:
+                            server._in_flight -= 1
+
+            def _generate(self, request):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                started = time.monotonic()
+                time.sleep(server.latency)
+                text, count = server.answer(request)
+                words = text.split(' ')
+                num_predict = (request.get('options') or {}).get('num_predict') or count
+                count = min(count, num_predict)
+                try:
+                    for i in range(count):
+                        time.sleep(1.0 / server.tokens_per_second)
+                        token = words[i % len(words)] + ' '
+                        with server._lock:
+                            server.generated_tokens += 1
+                        self._write_chunk({'model': request.get('model'), 'response': token, 'done': False})
+                    elapsed = time.monotonic() - started
+                    self._write_chunk({
+                        'model': request.get('model'), 'response': '', 'done': True,
+                        'prompt_eval_count': len(request.get('prompt', '')) // 4,
+                        'prompt_eval_duration': int(server.latency * 1e9),
+                        'eval_count': count,
+                        'eval_duration': int(max(elapsed - server.latency, 0) * 1e9),
+                        'total_duration': int(elapsed * 1e9)
+                    })
+                    self.wfile.write(b'0\r\n\r\n')
+                except (BrokenPipeError, ConnectionResetError):
+                    # Client stopped reading, e.g. an early stop; Ollama aborts generation here too
+                    pass
+
+            def _write_chunk(self, payload):
+                data = (json.dumps(payload) + '\n').encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b'\r\n')
+                self.wfile.flush()
+
+        return Handler